@@ -6,6 +6,7 @@ create table if not exists event (
 	headline varchar(200) NOT NULL,
 	body varchar(4192),
 	index idx_time(event_time),
+	index idx_app_time(application_id, event_time),
 	index idx_type_time(application_id, event_type_id, event_time),
 	primary key (id)
 ) Engine=InnoDB;
@@ -16,6 +17,34 @@ create table if not exists event_entity (
 	entity_type INT NOT NULL,
 	entity_id BIGINT NOT NULL,
 	UNIQUE idx_ee(event_id, entity_type, entity_id),
-	INDEX idx_entity(entity_id),
+	INDEX idx_entity(entity_type, entity_id, event_id),
 	primary key (id)
 ) Engine=InnoDB;
+
+create table if not exists event_count (
+	application_id INT NOT NULL,
+	event_type_id INT NOT NULL,
+	resolution INT NOT NULL,
+	bucket_time BIGINT NOT NULL,
+	event_count BIGINT NOT NULL,
+	primary key (application_id, resolution, bucket_time, event_type_id)
+) Engine=InnoDB;
+
+create table if not exists event_entity_count (
+	application_id INT NOT NULL,
+	event_type_id INT NOT NULL,
+	entity_type INT NOT NULL,
+	resolution INT NOT NULL,
+	bucket_time BIGINT NOT NULL,
+	event_count BIGINT NOT NULL,
+	primary key (application_id, resolution, bucket_time, event_type_id,
+	             entity_type)
+) Engine=InnoDB;
+
+create table if not exists event_key (
+	application_id INT NOT NULL,
+	idempotency_key VARBINARY(128) NOT NULL,
+	event_id BIGINT UNSIGNED NOT NULL,
+	INDEX idx_key_event(event_id),
+	primary key (application_id, idempotency_key)
+) Engine=InnoDB;
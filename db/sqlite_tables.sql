@@ -7,6 +7,13 @@ create table if not exists event (
         body varchar(4192)
 );
 
+create index if not exists idx_time on event(event_time);
+
+create index if not exists idx_app_time on event(application_id, event_time);
+
+create index if not exists idx_type_time
+        on event(application_id, event_type_id, event_time);
+
 create table if not exists event_entity (
         id integer primary key autoincrement,
         event_id integer unsigned not null,
@@ -14,3 +21,35 @@ create table if not exists event_entity (
         entity_id integer not null,
         unique (event_id, entity_type, entity_id)
 );
+
+create index if not exists idx_entity
+        on event_entity(entity_type, entity_id, event_id);
+
+create table if not exists event_count (
+        application_id integer not null,
+        event_type_id integer not null,
+        resolution integer not null,
+        bucket_time integer not null,
+        event_count integer not null,
+        primary key (application_id, resolution, bucket_time, event_type_id)
+);
+
+create table if not exists event_entity_count (
+        application_id integer not null,
+        event_type_id integer not null,
+        entity_type integer not null,
+        resolution integer not null,
+        bucket_time integer not null,
+        event_count integer not null,
+        primary key (application_id, resolution, bucket_time, event_type_id,
+                     entity_type)
+);
+
+create table if not exists event_key (
+        application_id integer not null,
+        idempotency_key varchar(128) not null,
+        event_id integer not null,
+        primary key (application_id, idempotency_key)
+);
+
+create index if not exists idx_key_event on event_key(event_id);
@@ -5,7 +5,23 @@
 __version__ = "0.5"
 __author__ = "Mike Prentice <mprentice@gmail.com>"
 
+import archive
+import batch
+import bus
+import cache
+import codec
 import config
+import entityindex
 import event
+import idempotency
+import ingest
+import metrics
+import partition
+import pool
+import prefork
+import recent
+import replica
+import retention
+import rollup
 import server
 import util
@@ -0,0 +1,355 @@
+"""Bulk import and export of events as NDJSON archives
+
+An archive holds one JSON event per line, in the format of /newEvent
+and of the events /getEvents returns. Archives ending in .gz are
+gzip-compressed.
+
+Importing streams the archive and saves it in large batches with
+Event.save_many; when a batch fails, its events are saved one by one
+so a bad line only rejects itself. With every batch a checkpoint (the
+position in the archive) is saved in the import_checkpoint table, in
+the same transaction, so an interrupted import resumes exactly where
+it stopped. Optionally the
+secondary indexes of the event tables are dropped for the import and
+rebuilt at the end, which is much faster for large loads.
+
+Exporting streams the events of one application in [start, end) with
+keyset pages, so memory stays constant however many there are.
+
+Functions:
+  - import_events: load an NDJSON archive into the database
+  - export_events: write an application's events to an NDJSON archive
+  - main: command line interface (bin/event_archive)
+"""
+
+import argparse
+import gzip
+import logging
+import os
+import sys
+import time
+import web
+
+import gupta.codec
+import gupta.config
+from gupta.event import Event
+from gupta.util import committing
+
+_log = logging.getLogger(__name__)
+
+_SQLITE_CHECKPOINT = """
+CREATE TABLE IF NOT EXISTS import_checkpoint (
+        name varchar(255) primary key,
+        position integer not null,
+        line integer not null,
+        imported integer not null,
+        rejected integer not null,
+        updated integer not null
+)"""
+
+_MYSQL_CHECKPOINT = """
+CREATE TABLE IF NOT EXISTS import_checkpoint (
+        name varchar(255) NOT NULL,
+        position BIGINT NOT NULL,
+        line BIGINT NOT NULL,
+        imported BIGINT NOT NULL,
+        rejected BIGINT NOT NULL,
+        updated BIGINT NOT NULL,
+        primary key (name)
+) Engine=InnoDB"""
+
+# secondary indexes of db/*_tables.sql that an import may defer:
+# (table, index name, columns)
+_DEFERRABLE_INDEXES = (
+    ('event', 'idx_time', 'event_time'),
+    ('event', 'idx_app_time', 'application_id, event_time'),
+    ('event', 'idx_type_time', 'application_id, event_type_id, event_time'),
+    ('event_entity', 'idx_entity', 'entity_type, entity_id, event_id'),
+)
+
+def _is_mysql(db):
+    return getattr(db, 'dbname', None) == 'mysql'
+
+def _open_archive(filename, mode):
+    if filename == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+class _Progress(object):
+    """Log counts and rates at most every `interval' seconds"""
+
+    def __init__(self, verb, interval=10, size=None, base=0):
+        self.verb = verb
+        self.interval = interval
+        self.size = size
+        self.base = base # count before this run, e.g. when resuming
+        self.started = time.time()
+        self.last = self.started
+
+    def report(self, count, position=None, rejected=0, force=False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - self.started, 1e-6)
+        rate = (count - self.base) / elapsed
+        msg = '%s %d events (%.0f/s)' % (self.verb, count, rate)
+        if rejected:
+            msg += ', %d rejected' % rejected
+        if position is not None and self.size:
+            msg += ', %.1f%%' % (100.0 * position / self.size)
+        _log.info(msg)
+
+def _load_checkpoint(db, name):
+    db.query(_MYSQL_CHECKPOINT if _is_mysql(db) else _SQLITE_CHECKPOINT)
+    rows = list(db.select('import_checkpoint', where='name = $name',
+                          vars={'name' : name}))
+    if not rows:
+        return None
+    return rows[0]
+
+def _save_checkpoint(db, name, position, line, imported, rejected):
+    db.query('REPLACE INTO import_checkpoint ' +
+             '(name, position, line, imported, rejected, updated) ' +
+             'VALUES ($name, $position, $line, $imported, $rejected, ' +
+             '$updated)',
+             vars={'name' : name, 'position' : position, 'line' : line,
+                   'imported' : imported, 'rejected' : rejected,
+                   'updated' : int(time.time() * 1000)})
+
+def _drop_indexes(db):
+    for table, index, columns in _DEFERRABLE_INDEXES:
+        if _is_mysql(db):
+            try:
+                db.query('ALTER TABLE %s DROP INDEX %s' % (table, index))
+            except Exception:
+                # already dropped by an interrupted import
+                pass
+        else:
+            db.query('DROP INDEX IF EXISTS %s' % index)
+
+def _create_indexes(db):
+    for table, index, columns in _DEFERRABLE_INDEXES:
+        if _is_mysql(db):
+            try:
+                db.query('ALTER TABLE %s ADD INDEX %s(%s)' %
+                         (table, index, columns))
+            except Exception:
+                # never dropped, e.g. the import was resumed without
+                # deferring indexes
+                pass
+        else:
+            db.query('CREATE INDEX IF NOT EXISTS %s ON %s(%s)' %
+                     (index, table, columns))
+
+def import_events(db, filename, batch_size=5000, checkpoint=None,
+                  restart=False, defer_indexes=False, rejects=None,
+                  progress_interval=10):
+    """Import the NDJSON archive filename ('-' for stdin) into db.
+
+    Events are saved batch_size at a time. If checkpoint names a
+    checkpoint, the import resumes after the last batch committed
+    under that name, unless restart is true. Lines that can't be
+    parsed or saved are written to the file rejects, if given, and
+    otherwise only counted.
+
+    With defer_indexes, the secondary indexes of the (unpartitioned)
+    event tables are dropped first and rebuilt once everything is
+    imported; queries are slow in the meantime.
+
+    Return (imported, rejected) counts, including those of earlier
+    runs under the same checkpoint.
+    """
+    partitioning = getattr(db, 'partitioning', None)
+    if defer_indexes and partitioning is not None:
+        raise ValueError("Can't defer the indexes of partitioned tables")
+    imported = rejected = line = position = 0
+    if checkpoint is not None:
+        if filename == '-':
+            raise ValueError("Can't resume an import from stdin")
+        saved = _load_checkpoint(db, checkpoint)
+        if saved is not None and not restart:
+            position, line = saved.position, saved.line
+            imported, rejected = saved.imported, saved.rejected
+            _log.info('Resuming %s at line %d', filename, line)
+    size = None
+    if filename != '-':
+        size = os.path.getsize(filename)
+    f = _open_archive(filename, 'rb')
+    rejectFile = None
+    if rejects is not None:
+        rejectFile = open(rejects, 'ab')
+    progress = _Progress('Imported', progress_interval, size, imported)
+    if defer_indexes:
+        _drop_indexes(db)
+    try:
+        if position:
+            # seeking a gzip file decompresses up to the position
+            f.seek(position)
+        done = False
+        while not done:
+            events = []
+            lines = []  # (line number, raw line, position after it)
+            while len(events) < batch_size:
+                raw = f.readline()
+                if not raw:
+                    done = True
+                    break
+                line += 1
+                if filename != '-':
+                    position = f.tell()
+                if not raw.strip():
+                    continue
+                try:
+                    events.append(Event.from_json(raw))
+                    lines.append((line, raw, position))
+                except Exception as e:
+                    rejected += 1
+                    _reject(rejectFile, line, raw, e)
+            if partitioning is not None:
+                # DDL, so before the transaction starts
+                for name in set(partitioning.name_for(int(evt.eventTime))
+                                for evt in events):
+                    partitioning.ensure(db, name)
+            try:
+                # save_many joins this transaction, so the checkpoint
+                # commits with the batch, and the save listeners only
+                # hear of it once it has
+                with committing(db):
+                    Event.save_many(db, events)
+                    if checkpoint is not None:
+                        _save_checkpoint(db, checkpoint, position, line,
+                                         imported + len(events), rejected)
+                imported += len(events)
+            except Exception:
+                # find the bad events: one transaction per event
+                for evt, (n, raw, pos) in zip(events, lines):
+                    evt.eventId = None
+                    try:
+                        with committing(db):
+                            evt.save(db)
+                            if checkpoint is not None:
+                                _save_checkpoint(db, checkpoint, pos, n,
+                                                 imported + 1, rejected)
+                        imported += 1
+                    except Exception as e:
+                        rejected += 1
+                        _reject(rejectFile, n, raw, e)
+                if checkpoint is not None:
+                    with db.transaction():
+                        _save_checkpoint(db, checkpoint, position, line,
+                                         imported, rejected)
+            progress.report(imported, _compressed_tell(f), rejected)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        if rejectFile is not None:
+            rejectFile.close()
+    if defer_indexes:
+        _log.info('Rebuilding indexes')
+        _create_indexes(db)
+    progress.report(imported, size, rejected, force=True)
+    return imported, rejected
+
+def _reject(rejectFile, line, raw, error):
+    if rejectFile is not None:
+        rejectFile.write(raw if raw.endswith('\n') else raw + '\n')
+    else:
+        _log.warning('Rejected line %d: %s', line, error)
+
+def _compressed_tell(f):
+    # progress through a gzip file is measured on the compressed size
+    fileobj = getattr(f, 'fileobj', f)
+    try:
+        return fileobj.tell()
+    except (AttributeError, IOError):
+        return None
+
+def export_events(db, filename, applicationId, start, end=None,
+                  chunk_size=1000, progress_interval=10):
+    """Write the events of applicationId in [start, end) to filename.
+
+    filename is '-' for stdout. Events are written one JSON object per
+    line, in (eventTime, eventId) order, and read chunk_size at a
+    time. Return the number of events written.
+    """
+    f = _open_archive(filename, 'wb')
+    progress = _Progress('Exported', progress_interval)
+    count = 0
+    try:
+        # queries exclude start itself
+        for evt in Event.stream_from_db(db, applicationId, int(start) - 1,
+                                        end, as_dicts=True,
+                                        chunk_size=chunk_size):
+            f.write(gupta.codec.dumps(evt))
+            f.write('\n')
+            count += 1
+            if count % chunk_size == 0:
+                progress.report(count)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+        else:
+            f.flush()
+    progress.report(count, force=True)
+    return count
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(prog='event_archive')
+    parser.add_argument('--config', default=None,
+                        help='config file of the database (default: '
+                             'event.cfg)')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't report progress")
+    commands = parser.add_subparsers(dest='command')
+    imp = commands.add_parser('import', help='load an NDJSON archive')
+    imp.add_argument('file', help="NDJSON or .gz file, '-' for stdin")
+    imp.add_argument('--batch-size', type=int, default=5000)
+    imp.add_argument('--checkpoint', default=None,
+                     help='checkpoint name (default: the absolute path '
+                          'of the file)')
+    imp.add_argument('--restart', action='store_true',
+                     help='ignore an existing checkpoint')
+    imp.add_argument('--defer-indexes', action='store_true',
+                     help='drop secondary indexes until the end')
+    imp.add_argument('--rejects', default=None,
+                     help='append lines that fail to this file')
+    exp = commands.add_parser('export', help='write an NDJSON archive')
+    exp.add_argument('file', help="output file (.gz to compress), '-' "
+                                  "for stdout")
+    exp.add_argument('--application-id', type=int, required=True)
+    exp.add_argument('--start', type=int, required=True,
+                     help='first eventTime (inclusive, epoch millis)')
+    exp.add_argument('--end', type=int, default=None,
+                     help='last eventTime (exclusive, epoch millis)')
+    exp.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARNING if args.quiet
+                        else logging.INFO,
+                        format='%(asctime)s %(message)s')
+    web.config.debug = False
+    if args.config is not None:
+        db = gupta.config.EventConfig(args.config).get_database()
+    else:
+        db = gupta.config.get_database()
+
+    if args.command == 'import':
+        checkpoint = args.checkpoint
+        if checkpoint is None and args.file != '-':
+            checkpoint = os.path.abspath(args.file)
+        imported, rejected = import_events(
+            db, args.file, batch_size=args.batch_size,
+            checkpoint=checkpoint, restart=args.restart,
+            defer_indexes=args.defer_indexes, rejects=args.rejects)
+        return 1 if rejected else 0
+    export_events(db, args.file, args.application_id, args.start, args.end,
+                  chunk_size=args.chunk_size)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
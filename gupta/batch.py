@@ -0,0 +1,187 @@
+"""Batched event queries for Gupta Event API
+
+Dashboards show many small event lists at once, e.g. one per event
+type or per entity, of one application over the same time range.
+/getEventsBatch takes all of their queries in one request, and
+load_batch answers them with as few SQL queries as it can.
+
+A query spec holds the keyword arguments of Event.load_from_db. Specs
+that filter on the same dimensions (event type, entities or both) and
+only differ in their eventTypeId and entityIds are merged into one
+query for the union of what they ask for: event_type_id IN (...)
+and any of their entities. The events it returns are then fanned back
+out to every spec they match. Specs filtering on different dimensions
+are not merged, since the union of their filters would be no filter
+at all, a scan of the application's whole time range. A spec with a limit or a cursor pages
+through its own results, so it is always run alone.
+
+Functions:
+  - plan: group query specs into the queries that answer them
+  - load_batch: run query specs, return the result of each
+"""
+
+from gupta.event import Event
+
+def _group_key(spec):
+    """Return what specs must share to be merged, or None"""
+    if spec.get('limit') is not None or spec.get('cursor') is not None:
+        return None
+    end = spec.get('end')
+    if end is not None:
+        end = long(end)
+    fields = spec.get('fields')
+    if fields is not None:
+        fields = tuple(sorted(set(fields)))
+    return (int(spec['applicationId']), long(spec['start']), end, fields,
+            spec.get('eventTypeId') is not None,
+            spec.get('entityIds') is not None)
+
+def _merge(specs):
+    """Return the query selecting what any of specs selects.
+
+    The specs filter on the same dimensions (see _group_key).
+    """
+    first = specs[0]
+    query = {'applicationId' : int(first['applicationId']),
+             'start' : long(first['start']),
+             'end' : first.get('end'),
+             'fields' : first.get('fields')}
+    if first.get('eventTypeId') is not None:
+        types = set()
+        for spec in specs:
+            types.update(_type_ids(spec['eventTypeId']))
+        query['eventTypeId'] = sorted(types)
+    if first.get('entityIds') is not None:
+        wanted = {}
+        for spec in specs:
+            for entityType, entityId in _entity_pairs(spec['entityIds']):
+                wanted.setdefault(str(entityType), set()).add(entityId)
+        query['entityIds'] = dict((entityType, sorted(ids))
+                                  for entityType, ids in wanted.items())
+    if query['fields'] is not None:
+        # fanning out needs the fields the specs filter on
+        fields = set(query['fields'])
+        if first.get('eventTypeId') is not None:
+            fields.add('eventTypeId')
+        if first.get('entityIds') is not None:
+            fields.add('relatedEntities')
+        query['fields'] = tuple(sorted(fields))
+    return query
+
+def _type_ids(eventTypeId):
+    if isinstance(eventTypeId, (list, tuple, set, frozenset)):
+        return set(int(t) for t in eventTypeId)
+    return set([int(eventTypeId)])
+
+def _entity_pairs(entityIds):
+    pairs = set()
+    for entityType in entityIds:
+        for entityId in entityIds[entityType]:
+            pairs.add((int(entityType), int(entityId)))
+    if len(pairs) == 0:
+        raise ValueError("entityIds must name at least one entity")
+    return pairs
+
+def _matcher(spec):
+    """Return a function telling if an event dict matches spec"""
+    types = None
+    if spec.get('eventTypeId') is not None:
+        types = _type_ids(spec['eventTypeId'])
+    wanted = None
+    if spec.get('entityIds') is not None:
+        wanted = _entity_pairs(spec['entityIds'])
+    entityMatch = spec.get('entityMatch', 'any')
+    if entityMatch not in ('any', 'all'):
+        raise ValueError("entityMatch must be 'any' or 'all'")
+    def matches(evt):
+        if types is not None and evt['eventTypeId'] not in types:
+            return False
+        if wanted is None:
+            return True
+        linked = set()
+        for entityType, ids in evt.get('relatedEntities', {}).items():
+            for entityId in ids:
+                linked.add((int(entityType), entityId))
+        if entityMatch == 'all':
+            return wanted <= linked
+        return len(wanted & linked) > 0
+    return matches
+
+def plan(specs):
+    """Return the queries answering specs as (query, indexes) pairs.
+
+    query holds the keyword arguments of one Event.iter_from_db call,
+    and indexes are the positions in specs of the specs it answers.
+    Queries come in the order of their first spec.
+    """
+    groups = {}
+    order = []
+    for index, spec in enumerate(specs):
+        key = _group_key(spec)
+        if key is None:
+            # never shared, and unlike tuples never equal to a key
+            key = index
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(index)
+    queries = []
+    for key in order:
+        indexes = groups[key]
+        if len(indexes) == 1:
+            queries.append((dict(specs[indexes[0]]), indexes))
+        else:
+            queries.append((_merge([specs[i] for i in indexes]), indexes))
+    return queries
+
+def load_batch(db, specs, recent=None):
+    """Run the query specs with as few queries as possible.
+
+    Return one {'events': [...], 'nextCursor': ...} dict per spec, in
+    order, as /getEvents answers it: the events are to_dict dicts and
+    nextCursor is set when the spec's limit cut its result short.
+    `recent' is passed on to Event.iter_from_db.
+
+    Raise ValueError for a malformed spec, before anything is read.
+    """
+    queries = plan(specs)
+    matchers = [_matcher(spec) for spec in specs]
+    for spec in specs:
+        Event._check_fields(spec.get('fields'))
+    results = [{'events' : [], 'nextCursor' : None} for spec in specs]
+    for query, indexes in queries:
+        if len(indexes) == 1:
+            results[indexes[0]] = _load_one(db, query, recent)
+            continue
+        members = []
+        for index in indexes:
+            fields = specs[index].get('fields')
+            extra = ()
+            if fields is not None:
+                extra = set(query['fields']).difference(fields)
+            members.append((results[index]['events'], matchers[index],
+                            extra))
+        for evt in Event.iter_from_db(db, recent=recent, as_dicts=True,
+                                      **query):
+            for events, matches, extra in members:
+                if matches(evt):
+                    if extra:
+                        events.append(dict((k, v) for k, v in evt.items()
+                                           if k not in extra))
+                    else:
+                        events.append(evt)
+    return results
+
+def _load_one(db, spec, recent):
+    limit = spec.get('limit')
+    query = dict(spec)
+    if limit is not None:
+        # one extra event tells if there's a next page
+        query['limit'] = int(limit) + 1
+    events = list(Event.iter_from_db(db, recent=recent, as_dicts=True,
+                                     **query))
+    nextCursor = None
+    if limit is not None and len(events) > int(limit):
+        events = events[:int(limit)]
+        nextCursor = Event._cursor_of(events[-1])
+    return {'events' : events, 'nextCursor' : nextCursor}
@@ -0,0 +1,9 @@
+"""Gupta Event API benchmarks
+
+Modules:
+  - micro: time the Event model and database layer in process
+  - load: drive a running gupta.server over HTTP
+  - results: summarize timings and write them to a JSON file
+
+Run them with bin/bench; see README.txt.
+"""
@@ -0,0 +1,121 @@
+"""Command line entry point for the benchmarks (bin/bench)
+
+Usage:
+    bin/bench micro [options]
+    bin/bench load [options]
+
+Both take the synthetic data options, --config to benchmark the
+database of a config file instead of a temporary SQLite file, and
+--output to name the JSON results file. Run `bin/bench micro -h' for
+the full list.
+
+Functions:
+  - main: parse arguments and run a benchmark
+"""
+
+import argparse
+import os
+import sys
+import web
+
+from tempfile import NamedTemporaryFile
+
+from gupta.bench import micro
+from gupta.bench.results import write_results
+from gupta.config import EventConfig, get_test_database
+from gupta.test.data import SyntheticData
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='bench')
+    common = argparse.ArgumentParser(add_help=False)
+    data = common.add_argument_group('synthetic data')
+    data.add_argument('--count', type=int, default=10000,
+                      help='number of events (default: %(default)s)')
+    data.add_argument('--applications', type=int, default=10)
+    data.add_argument('--event-types', type=int, default=20)
+    data.add_argument('--days', type=float, default=30,
+                      help='time spread of the events in days')
+    data.add_argument('--entities-per-event', type=int, default=3)
+    data.add_argument('--entity-types', type=int, default=5)
+    data.add_argument('--entity-ids', type=int, default=10000)
+    data.add_argument('--skew', type=float, default=1.1,
+                      help='Zipf exponent of entity popularity, 0 for uniform')
+    data.add_argument('--seed', type=int, default=0)
+    run = common.add_argument_group('run')
+    run.add_argument('--batch-size', type=int, default=100)
+    run.add_argument('--queries', type=int, default=100)
+    run.add_argument('--limit', type=int, default=None)
+    run.add_argument('--config', default=None,
+                     help='benchmark the [database] of this config file '
+                          '(its tables must exist and be empty)')
+    run.add_argument('--output', default='-',
+                     help='JSON results file (default: stdout)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('micro', parents=[common],
+                        help='time the Event model and database layer')
+    load = commands.add_parser('load', parents=[common],
+                               help='drive gupta.server over HTTP')
+    load.add_argument('--url', default=None,
+                      help='drive the server at this URL instead of '
+                           'starting one in process')
+    load.add_argument('--threads', type=int, default=4)
+    return parser
+
+def _synthetic_data(args):
+    return SyntheticData(count=args.count,
+                         applications=args.applications,
+                         event_types=args.event_types,
+                         time_spread=int(args.days * 86400000),
+                         entities_per_event=args.entities_per_event,
+                         entity_types=args.entity_types,
+                         entity_ids=args.entity_ids,
+                         skew=args.skew,
+                         seed=args.seed)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = _parser().parse_args(argv)
+    web.config.debug = False
+    data = _synthetic_data(args)
+    url = getattr(args, 'url', None)
+    db_file = None
+    if args.config is not None:
+        db = EventConfig(args.config).get_database()
+    elif url is None:
+        # a file rather than :memory:, as the server drops its
+        # thread-local connections after every request
+        db_file = NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        db = get_test_database(db_file.name)
+    try:
+        if args.command == 'micro':
+            results = micro.run(db, data, batch_size=args.batch_size,
+                                queries=args.queries, limit=args.limit)
+        else:
+            from gupta.bench import load
+            if url is not None:
+                results = load.run(url, data, threads=args.threads,
+                                   batch_size=args.batch_size,
+                                   queries=args.queries, limit=args.limit)
+            else:
+                server = load.LocalServer(db)
+                server.start()
+                try:
+                    results = load.run(server.url, data,
+                                       threads=args.threads,
+                                       batch_size=args.batch_size,
+                                       queries=args.queries,
+                                       limit=args.limit)
+                finally:
+                    server.stop()
+    finally:
+        if db_file is not None:
+            os.unlink(db_file.name)
+    options = dict((k, v) for k, v in vars(args).items() if k != 'output')
+    options['target'] = url or args.config or 'sqlite'
+    write_results(args.output, args.command, options, results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
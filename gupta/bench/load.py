@@ -0,0 +1,164 @@
+"""End-to-end HTTP load driver for gupta.server
+
+The driver posts synthetic events and then queries them back, from a
+number of client threads, and reports throughput and p50/p99 latency
+per phase. It drives either a server at a given URL or one it starts
+in this process on a free port, using the same WSGI server as
+`bin/event_server'.
+
+Classes:
+  - LocalServer: gupta.server on a background thread
+
+Functions:
+  - run: run the write and read phases against a server URL
+  - drive: send requests from client threads and time them
+"""
+
+import json
+import socket
+import threading
+import time
+
+import requests
+import web
+
+import gupta.server
+from gupta.bench.micro import make_queries
+from gupta.bench.results import summarize
+
+class LocalServer(object):
+    """Serve gupta.server with database db on a background thread
+
+    Usage:
+        server = LocalServer(db)
+        server.start()
+        ... requests to server.url ...
+        server.stop()
+    """
+    def __init__(self, db, host='127.0.0.1', port=0):
+        self.db = db
+        self.host = host
+        self.port = port or _free_port(host)
+        self.url = 'http://%s:%d' % (self.host, self.port)
+        self._server = None
+        self._thread = None
+        self._saved_db = None
+
+    def start(self, timeout=10.0):
+        self._saved_db = gupta.server._db
+        gupta.server._db = self.db
+        app = web.application(gupta.server._urls, vars(gupta.server),
+                              autoreload=False)
+        self._server = web.httpserver.WSGIServer((self.host, self.port),
+                                                 app.wsgifunc())
+        self._thread = threading.Thread(target=self._server.start)
+        self._thread.daemon = True
+        self._thread.start()
+        deadline = time.time() + timeout
+        while not self._server.ready:
+            if time.time() > deadline:
+                raise RuntimeError("server did not start on %s" % self.url)
+            time.sleep(0.01)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._thread.join()
+            self._server = None
+            gupta.server._db = self._saved_db
+
+def _free_port(host):
+    s = socket.socket()
+    try:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def drive(requests_list, threads=4, items=None):
+    """Send each request from `threads' client threads; return a summary
+
+    A request is a (method, url, body) tuple. A response that is not
+    200 OK with {"status": "ok"} counts as an error. Each thread keeps
+    one HTTP session, so connections are reused as a real client
+    would. items is the number of events the requests carry, if
+    that differs from the number of requests.
+    """
+    timings = []
+    errors = [0]
+    lock = threading.Lock()
+    pending = list(reversed(requests_list))
+
+    def worker():
+        session = requests.Session()
+        my_timings = []
+        my_errors = 0
+        while True:
+            with lock:
+                if not pending:
+                    break
+                method, url, body = pending.pop()
+            t0 = time.time()
+            try:
+                response = session.request(method, url, data=body)
+                ok = (response.status_code == 200 and
+                      _status_ok(response.content))
+            except requests.RequestException:
+                ok = False
+            my_timings.append(time.time() - t0)
+            if not ok:
+                my_errors += 1
+        session.close()
+        with lock:
+            timings.extend(my_timings)
+            errors[0] += my_errors
+
+    t0 = time.time()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return summarize(timings, elapsed=time.time() - t0, items=items,
+                     errors=errors[0])
+
+def _status_ok(content):
+    try:
+        return json.loads(content).get('status') == 'ok'
+    except ValueError:
+        return False
+
+def _query_url(url, kw):
+    params = dict((k, v) for k, v in kw.items() if v is not None)
+    if 'entityIds' in params:
+        params['entityIds'] = json.dumps(params['entityIds'])
+    return url + '/getEvents?' + '&'.join(
+        '%s=%s' % (k, requests.utils.quote(str(v), safe=''))
+        for k, v in sorted(params.items()))
+
+def run(url, data, threads=4, batch_size=100, queries=1000, limit=100):
+    """Run the load phases against the server at url
+
+    The phases are:
+      - newEvent: post the first half of the events one at a time
+      - newEvents: post the second half in batches of batch_size
+      - getEvents_time: query one application over a one day window
+      - getEvents_entity: query one of the most popular entities
+    """
+    strings = data.json_strings()
+    half = len(strings) // 2
+    results = {}
+    results['newEvent'] = drive(
+        [('POST', url + '/newEvent', s) for s in strings[:half]], threads)
+    batches = [strings[i:i + batch_size]
+               for i in range(half, len(strings), batch_size)]
+    results['newEvents'] = drive(
+        [('POST', url + '/newEvents', '\n'.join(b)) for b in batches],
+        threads, items=len(strings) - half)
+    time_queries, entity_queries = make_queries(data, queries, limit=limit)
+    results['getEvents_time'] = drive(
+        [('GET', _query_url(url, kw), None) for kw in time_queries], threads)
+    results['getEvents_entity'] = drive(
+        [('GET', _query_url(url, kw), None) for kw in entity_queries],
+        threads)
+    return results
@@ -0,0 +1,138 @@
+"""Micro-benchmarks of the Event model and database layer
+
+Each benchmark times one operation many times in a single thread,
+against the database it is given: an in-memory SQLite database by
+default, or the [database] of a config file (e.g. a local MySQL or
+MariaDB). The database must be empty, since the queries assume they
+only see the synthetic events.
+
+Functions:
+  - run: run every micro-benchmark and return the summaries
+  - bench_from_json: time Event.from_json
+  - bench_from_dict: time Event.from_dict (event validation)
+  - bench_codecs: time decoding and encoding with each installed JSON
+    library (see gupta.codec)
+  - bench_save: time Event.save, one event per transaction
+  - bench_save_many: time Event.save_many in batches
+  - bench_load: time Event.load_from_db for time and entity queries
+  - bench_iter_dicts: time Event.iter_from_db with as_dicts=True
+  - bench_to_dict: time Event.to_dict
+"""
+
+import random
+import time
+
+import gupta.codec
+from gupta.event import Event
+from gupta.bench.results import summarize
+
+def _timed(fn, args_list):
+    """Call fn(*args) for each args in args_list; return the timings"""
+    timings = []
+    clock = time.time
+    for args in args_list:
+        t0 = clock()
+        fn(*args)
+        timings.append(clock() - t0)
+    return timings
+
+def bench_from_json(strings):
+    return summarize(_timed(Event.from_json, [(s,) for s in strings]))
+
+def bench_from_dict(dicts):
+    return summarize(_timed(Event.from_dict, [(d,) for d in dicts]))
+
+def bench_codecs(strings, dicts, page_size=100):
+    """Time each installed JSON library on the two hot paths
+
+    Decoding is timed through Event.from_json, encoding on /getEvents
+    style responses of page_size event dicts. The library in use is
+    restored afterwards.
+    """
+    results = {}
+    pages = [({'status' : 'ok', 'events' : dicts[i:i + page_size]},)
+             for i in range(0, len(dicts), page_size)]
+    previous = gupta.codec.name
+    try:
+        for library in gupta.codec.available():
+            gupta.codec.use(library)
+            results['from_json_%s' % library] = bench_from_json(strings)
+            results['encode_%s' % library] = summarize(
+                _timed(gupta.codec.dumps, pages), items=len(dicts))
+    finally:
+        gupta.codec.use(previous)
+    return results
+
+def bench_save(db, events):
+    return summarize(_timed(lambda e: e.save(db), [(e,) for e in events]))
+
+def bench_save_many(db, events, batch_size=100):
+    batches = [(db, events[i:i + batch_size])
+               for i in range(0, len(events), batch_size)]
+    return summarize(_timed(Event.save_many, batches), items=len(events))
+
+def bench_load(db, queries):
+    """Time load_from_db once per dict of keyword arguments"""
+    counts = []
+    def load(kw):
+        counts.append(len(Event.load_from_db(db, **kw)))
+    timings = _timed(load, [(kw,) for kw in queries])
+    return summarize(timings, items=sum(counts))
+
+def bench_iter_dicts(db, queries):
+    counts = []
+    def load(kw):
+        counts.append(len(list(Event.iter_from_db(db, as_dicts=True, **kw))))
+    timings = _timed(load, [(kw,) for kw in queries])
+    return summarize(timings, items=sum(counts))
+
+def bench_to_dict(events):
+    return summarize(_timed(Event.to_dict, [(e,) for e in events]))
+
+def make_queries(data, count=100, window_ms=86400000, limit=None, seed=0):
+    """Return load_from_db keyword arguments for time and entity queries
+
+    Time queries ask for one application over a window of window_ms;
+    entity queries ask for one of the most popular entities over the
+    whole time spread of the synthetic data.
+    """
+    rand = random.Random(seed)
+    time_queries = []
+    entity_queries = []
+    popular = data.popular_entities(10)
+    for i in range(count):
+        start = data.time_start + rand.randrange(
+            max(data.time_spread - window_ms, 1))
+        time_queries.append({'applicationId' : rand.randint(1, data.applications),
+                             'start' : start,
+                             'end' : start + window_ms,
+                             'limit' : limit})
+        entityType = str(rand.randint(1, data.entity_types))
+        entity_queries.append({'applicationId' : rand.randint(1, data.applications),
+                               'start' : data.time_start,
+                               'end' : data.time_start + data.time_spread,
+                               'entityIds' : {entityType : [rand.choice(popular)]},
+                               'limit' : limit})
+    return time_queries, entity_queries
+
+def run(db, data, batch_size=100, queries=100, limit=None):
+    """Run the micro-benchmarks on db with SyntheticData data
+
+    Half of the events are saved one at a time and half with
+    save_many, then the queries run against all of them.
+    """
+    strings = data.json_strings()
+    results = {}
+    results['from_json'] = bench_from_json(strings)
+    results['from_dict'] = bench_from_dict(data.test_data)
+    events = [Event.from_json(s) for s in strings]
+    half = len(events) // 2
+    results['save'] = bench_save(db, events[:half])
+    results['save_many'] = bench_save_many(db, events[half:], batch_size)
+    results['to_dict'] = bench_to_dict(events)
+    results.update(bench_codecs(strings, [e.to_dict() for e in events]))
+    time_queries, entity_queries = make_queries(data, queries, limit=limit)
+    results['load_from_db_time'] = bench_load(db, time_queries)
+    results['load_from_db_entity'] = bench_load(db, entity_queries)
+    results['iter_dicts_time'] = bench_iter_dicts(db, time_queries)
+    return results
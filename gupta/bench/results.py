@@ -0,0 +1,87 @@
+"""Benchmark timings and machine-readable results
+
+Every run is written as one JSON document that records the git
+revision, time and Python version along with the timings, so results
+from different commits can be compared.
+
+Functions:
+  - summarize: throughput and latency percentiles of a list of timings
+  - percentile: the p-th percentile of a sorted list
+  - run_info: describe the code and machine a benchmark ran on
+  - write_results: write a benchmark run to a JSON file
+"""
+
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+
+def percentile(sorted_values, p):
+    """Return the p-th percentile (0-100) of a sorted list
+
+    Uses the nearest-rank method. Return None for an empty list.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    rank = min(max(rank, 0), len(sorted_values) - 1)
+    return sorted_values[rank]
+
+def summarize(timings, elapsed=None, items=None, errors=0):
+    """Summarize a list of per-operation timings in seconds
+
+    elapsed is the wall-clock time of the whole run (the sum of the
+    timings if not given, which is only right for a single thread).
+    items is the number of events handled, if an operation handles
+    more than one. Latencies are reported in milliseconds.
+    """
+    timings = sorted(timings)
+    if elapsed is None:
+        elapsed = sum(timings)
+    ops = len(timings)
+    summary = {'operations' : ops,
+               'errors' : errors,
+               'seconds' : round(elapsed, 6),
+               'opsPerSecond' : round(ops / elapsed, 2) if elapsed else None}
+    if items is not None:
+        summary['items'] = items
+        summary['itemsPerSecond'] = (round(items / elapsed, 2)
+                                     if elapsed else None)
+    for name, p in (('p50Ms', 50), ('p99Ms', 99)):
+        value = percentile(timings, p)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    summary['maxMs'] = round(timings[-1] * 1000, 3) if timings else None
+    return summary
+
+def run_info():
+    """Return a dict describing the code revision and the machine"""
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=open('/dev/null', 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision' : revision,
+            'timestamp' : int(time.time() * 1000),
+            'python' : platform.python_version(),
+            'platform' : platform.platform()}
+
+def write_results(filename, benchmark, options, results):
+    """Write one benchmark run as JSON to filename ('-' for stdout)
+
+    options are the settings the benchmark ran with; results maps a
+    benchmark name to its summary.
+    """
+    doc = run_info()
+    doc['benchmark'] = benchmark
+    doc['options'] = options
+    doc['results'] = results
+    text = json.dumps(doc, indent=2, sort_keys=True)
+    if filename == '-':
+        sys.stdout.write(text + '\n')
+    else:
+        with open(filename, 'w') as f:
+            f.write(text + '\n')
+    return doc
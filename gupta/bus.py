@@ -0,0 +1,185 @@
+"""In-process fan-out of newly saved events for Gupta Event API
+
+Consumers that want new events as they arrive subscribe to an EventBus
+instead of polling the database. The bus is a save listener: every
+committed batch is matched against the subscriptions of its
+application and appended to the queues of those that want it.
+Waiting subscribers block on their own condition variable, so an idle
+subscription costs neither database queries nor CPU.
+
+Each subscription queues at most `max_queue' events. When a slow
+consumer falls further behind, further events are dropped and the
+subscription is marked as overflowed, so that the consumer can catch
+up from the database instead (see /subscribe in gupta.server).
+
+Like the recent-event store, the bus only sees events saved through
+this process.
+
+Classes:
+  - EventBus: registry of subscriptions, fed by Event save listeners
+  - Subscription: filter and queue of one subscriber
+"""
+
+import collections
+import threading
+import time
+
+class Subscription(object):
+    """Filter and queue of new events for one subscriber.
+
+    Made by EventBus.subscribe. An event matches if it has the
+    subscription's applicationId, its eventTypeId if one is given, and
+    is linked to any of its entityIds if they are given.
+    """
+
+    def __init__(self, applicationId, eventTypeId=None, entityIds=None,
+                 max_queue=1000):
+        self.applicationId = int(applicationId)
+        self.eventTypeId = None
+        if eventTypeId is not None:
+            self.eventTypeId = int(eventTypeId)
+        self.entities = None
+        if entityIds is not None:
+            self.entities = set()
+            for entityType in entityIds:
+                for entityId in entityIds[entityType]:
+                    self.entities.add((int(entityType), int(entityId)))
+            if len(self.entities) == 0:
+                raise ValueError("entityIds must name at least one entity")
+        self.max_queue = max_queue
+        self.overflowed = False
+        self.closed = False
+        self._events = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+
+    def matches(self, evt):
+        """Return True if the Event evt is wanted here"""
+        if (self.eventTypeId is not None and
+            int(evt.eventTypeId) != self.eventTypeId):
+            return False
+        if self.entities is None:
+            return True
+        for ent in evt.relatedEntities:
+            if (int(ent.entityType), int(ent.entityId)) in self.entities:
+                return True
+        return False
+
+    def put(self, evt):
+        """Queue evt, or drop it and mark overflow if the queue is full"""
+        with self._cond:
+            if len(self._events) >= self.max_queue:
+                self.overflowed = True
+                return False
+            self._events.append(evt)
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Wait up to timeout seconds for events.
+
+        Return (events, overflowed): the queued events, oldest first,
+        and whether events were dropped since the last call. Return
+        as soon as there are events, the subscription overflowed or
+        was closed, or the timeout expires.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while not (self._events or self.overflowed or self.closed):
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            events = list(self._events)
+            self._events.clear()
+            overflowed = self.overflowed
+            self.overflowed = False
+            return events, overflowed
+
+    def close(self):
+        """Wake up a waiting get for good"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+class EventBus(object):
+    """Registry of subscriptions, fed by Event save listeners.
+
+    Example usage:
+      bus = EventBus(max_queue=1000)
+      Event.add_save_listener(bus.publish)
+      sub = bus.subscribe(applicationId=1, eventTypeId=3)
+      try:
+          events, overflowed = sub.get(timeout=15)
+      finally:
+          bus.unsubscribe(sub)
+    """
+
+    def __init__(self, max_queue=1000):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # applicationId -> set of Subscriptions
+        self._published = 0
+        self._delivered = 0
+        self._dropped = 0
+
+    def subscribe(self, applicationId, eventTypeId=None, entityIds=None):
+        """Return a new Subscription to matching events saved from now on"""
+        sub = Subscription(applicationId, eventTypeId, entityIds,
+                           self.max_queue)
+        with self._lock:
+            self._subscriptions.setdefault(sub.applicationId,
+                                           set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        """Stop delivering to sub and wake it up"""
+        with self._lock:
+            subs = self._subscriptions.get(sub.applicationId)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscriptions[sub.applicationId]
+        sub.close()
+
+    def publish(self, events):
+        """Deliver newly saved events to the matching subscriptions"""
+        delivered = dropped = 0
+        with self._lock:
+            self._published += len(events)
+            if not self._subscriptions:
+                return
+            byApp = dict((appId, list(subs))
+                         for appId, subs in self._subscriptions.items())
+        for evt in events:
+            for sub in byApp.get(int(evt.applicationId), ()):
+                if sub.matches(evt):
+                    if sub.put(evt):
+                        delivered += 1
+                    else:
+                        dropped += 1
+        with self._lock:
+            self._delivered += delivered
+            self._dropped += dropped
+
+    def close(self):
+        """Wake up and drop every subscription, e.g. on shutdown"""
+        with self._lock:
+            subs = [sub for appSubs in self._subscriptions.values()
+                    for sub in appSubs]
+            self._subscriptions.clear()
+        for sub in subs:
+            sub.close()
+
+    def stats(self):
+        """Return counters: subscriptions, published, delivered, dropped"""
+        with self._lock:
+            return {'subscriptions' : sum(len(subs) for subs in
+                                          self._subscriptions.values()),
+                    'published' : self._published,
+                    'delivered' : self._delivered,
+                    'dropped' : self._dropped}
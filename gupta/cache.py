@@ -0,0 +1,161 @@
+"""Query result cache for Gupta Event API
+
+Dashboards poll /getEvents with the same parameters every few seconds.
+A QueryCache keeps the serialized JSON responses of recent queries.
+
+Entries are evicted least recently used first, to stay under a byte
+limit, and expire after a time to live. Saving an event invalidates
+only the entries of its application whose time range covers the
+event's eventTime. Writes made by other processes are only picked up
+when entries expire.
+
+Classes:
+  - QueryCache: LRU cache of serialized query results
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+class QueryCache:
+    """LRU cache of serialized query results with byte and TTL limits.
+
+    Example usage:
+      cache = QueryCache(max_bytes=64 * 1024 * 1024, ttl_ms=5000)
+      Event.add_save_listener(cache.invalidate_events)
+      key = QueryCache.key(applicationId=1, start=0)
+      body = cache.get(key)
+      if body is None:
+          generation = cache.generation(key)
+          body = ...
+          cache.put(key, body, generation)
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_ms=5000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_ms / 1000.0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # key -> (expires, applicationId, start, end, body)
+        self._entries = OrderedDict()
+        # applicationId -> set of keys
+        self._keysForApp = {}
+        # applicationId -> number of invalidating writes
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(applicationId, start, end=None, eventTypeId=None, entityIds=None,
+            **options):
+        """Return a normalized cache key for query parameters.
+
+        Extra keyword options that change the response (limit, cursor,
+        entityMatch, ...) are part of the key; None values are ignored.
+        """
+        entities = None
+        if entityIds is not None:
+            entities = tuple(sorted(set(
+                (int(entityType), int(entId))
+                for entityType in entityIds
+                for entId in entityIds[entityType])))
+        if eventTypeId is not None:
+            eventTypeId = int(eventTypeId)
+        if end is not None:
+            end = int(end)
+        extra = tuple(sorted((k, v) for k, v in options.items()
+                             if v is not None))
+        return (int(applicationId), int(start), end, eventTypeId, entities,
+                extra)
+
+    def get(self, key):
+        """Return the cached body for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[4]
+
+    def generation(self, key):
+        """Return a token to pass to put for a result computed now.
+
+        It changes whenever an event is saved for key's application,
+        so a result computed while a write was happening isn't cached.
+        """
+        with self._lock:
+            return self._generations.get(key[0], 0)
+
+    def put(self, key, body, generation):
+        """Cache body, the serialized result of the query for key.
+
+        generation is the token from generation(key), taken before the
+        query was run.
+        """
+        if len(body) > self.max_bytes:
+            return
+        applicationId, start, end = key[0], key[1], key[2]
+        with self._lock:
+            if self._generations.get(applicationId, 0) != generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, applicationId,
+                                  start, end, body)
+            self._keysForApp.setdefault(applicationId, set()).add(key)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_events(self, events):
+        """Drop entries whose results could include any of events.
+
+        Only entries of the events' applications whose [start, end)
+        covers an eventTime are dropped. Meant as a save listener.
+        """
+        with self._lock:
+            for evt in events:
+                applicationId = int(evt.applicationId)
+                self._generations[applicationId] = \
+                    self._generations.get(applicationId, 0) + 1
+                keys = self._keysForApp.get(applicationId, ())
+                for key in list(keys):
+                    entry = self._entries[key]
+                    start, end = entry[2], entry[3]
+                    if evt.eventTime > start and \
+                            (end is None or evt.eventTime < end):
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def stats(self):
+        """Return a dict of cache counters."""
+        with self._lock:
+            return {'entries' : len(self._entries),
+                    'bytes' : self.size,
+                    'hits' : self.hits,
+                    'misses' : self.misses,
+                    'evictions' : self.evictions,
+                    'expirations' : self.expirations,
+                    'invalidations' : self.invalidations}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry[4])
+        keys = self._keysForApp[entry[1]]
+        keys.discard(key)
+        if not keys:
+            del self._keysForApp[entry[1]]
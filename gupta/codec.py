@@ -0,0 +1,90 @@
+"""Pluggable JSON codec for Gupta Event API
+
+Parsing event payloads and encoding query results are a large part of
+the CPU cost of every request. This module decodes and encodes JSON
+with ujson when it is installed and otherwise with the standard json
+module. simplejson can be picked explicitly, but with Python 2.7's C
+accelerated json module it decodes barely faster and encodes slower
+(see bench_codecs in gupta.bench.micro), so it is never picked
+automatically. The API behaves the same with any of them.
+
+Callers use gupta.codec.loads and gupta.codec.dumps through the module
+(not `from gupta.codec import loads'), so that use() switches every
+caller at once. Until use() picks a library they are the standard json
+module's.
+
+Functions:
+  - loads: decode a JSON string
+  - dumps: encode an object as a JSON string
+  - use: pick the library by name
+  - available: names of the installed libraries
+"""
+
+import json
+
+def _ujson():
+    import ujson
+    def dumps(obj):
+        # like the json module, don't escape '/'
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return ujson.loads, dumps
+
+def _simplejson():
+    import simplejson
+    # pure-Python simplejson is slower than the standard module
+    from simplejson import _speedups
+    return simplejson.loads, simplejson.dumps
+
+def _json():
+    return json.loads, json.dumps
+
+# (name, loader of (loads, dumps))
+_LIBRARIES = (
+    ('ujson', _ujson),
+    ('simplejson', _simplejson),
+    ('json', _json),
+)
+
+# picked by use('auto'), in order of preference
+_AUTO = ('ujson', 'json')
+
+# name of the library in use, and its functions: decode a JSON string
+# (raising ValueError if it isn't valid) and encode an object
+name = 'json'
+loads, dumps = _json()
+
+def available():
+    """Return the names of the installed libraries"""
+    names = []
+    for libname, loader in _LIBRARIES:
+        try:
+            loader()
+        except ImportError:
+            continue
+        names.append(libname)
+    return names
+
+def use(library='auto'):
+    """Encode and decode with library from now on.
+
+    library is 'ujson', 'simplejson', 'json' or 'auto' for ujson if
+    it is installed and json otherwise. Raise ValueError if it isn't
+    installed. Return the name of the library in use.
+    """
+    global name, loads, dumps
+    for libname, loader in _LIBRARIES:
+        if library != libname and (library != 'auto' or
+                                   libname not in _AUTO):
+            continue
+        try:
+            loads, dumps = loader()
+        except ImportError:
+            if library == libname:
+                raise ValueError("JSON library '%s' is not installed" %
+                                 library)
+            continue
+        name = libname
+        return name
+    raise ValueError("Unknown JSON library '%s'" % library)
+
+use()
@@ -1,20 +1,55 @@
 """Configuration information for Gupta Event API
 
 Configuration information is read from event.cfg in the project's root
-directory.
+directory, or from the file named by the GUPTA_CONFIG environment
+variable, or from the file passed to init(). Nothing is read until
+the global config is first used, and the database and other
+components are only built when they are asked for, so importing the
+package needs neither a config file nor a database.
 
 Classes:
   - EventConfig: wrapper objects for config information.
 
 Convenience functions:
   - get_database: web.py database object from global config
-  - get_test_database: in-memory sqlite temporary database for testing
+  - get_replica_set: ReplicaSet of read replicas, or None
+  - get_ingest_queue: write-behind IngestQueue, or None for
+    synchronous ingest
+  - get_recent_store: in-memory RecentEventStore, or None
+  - get_query_cache: QueryCache of /getEvents responses, or None
+  - get_event_bus: EventBus of new events for /subscribe, or None
+  - get_entity_index: EntityIndex of the database, or None
+  - get_retention: Retention policies and purge, or None
+  - get_metrics: installed Metrics instrumentation, or None
+  - init: read the global config from a given file now
+  - get_config: the global EventConfig, read on first use
+  - reload: re-read the global config file
+  - get_test_database: sqlite temporary database for testing
 """
 
+import atexit
+import logging
+import os
 import re
+import shutil
+import tempfile
+import threading
 import web
 from ConfigParser import ConfigParser
 
+from gupta.bus import EventBus
+from gupta.cache import QueryCache
+from gupta.entityindex import EntityIndex
+from gupta.event import Event
+from gupta.idempotency import KeyCache
+from gupta.ingest import IngestQueue
+from gupta.metrics import Metrics, install as install_metrics
+from gupta.partition import Partitioning
+from gupta.pool import install_pool, tune_sqlite
+from gupta.rollup import Rollups
+from gupta.recent import RecentEventStore
+from gupta.replica import ReplicaSet
+from gupta.retention import Retention, RetentionPolicy, parse_age
 from gupta.util import nostderr
 
 class EventConfig(ConfigParser):
@@ -35,6 +70,14 @@ class EventConfig(ConfigParser):
         self._config_file = config_file
         self._read_config_file()
         self._db = None
+        self._replica_set = None
+        self._ingest_queue = None
+        self._recent_store = None
+        self._query_cache = None
+        self._event_bus = None
+        self._entity_index = None
+        self._retention = None
+        self._metrics = None
 
     def get_database(self):
         """Return database object constructed from config"""
@@ -42,40 +85,441 @@ class EventConfig(ConfigParser):
             self._build_db()
         return self._db
 
+    def get_replica_set(self):
+        """Return the ReplicaSet of the [database:NAME] sections.
+
+        Return None if there are none. Its replicas are used for
+        reads; get_database() is the primary, for writes.
+        """
+        self.get_database()
+        return self._replica_set
+
+    def get_ingest_queue(self):
+        """Return the started IngestQueue from the [ingest] section.
+
+        Return None unless the section sets `mode = queue', in which
+        case events are written behind by a group-commit flusher.
+        """
+        if self._ingest_queue is None and self.ingest_mode() == 'queue':
+            self._build_ingest_queue()
+        return self._ingest_queue
+
+    def get_recent_store(self):
+        """Return the RecentEventStore from the [recent] section.
+
+        Return None if the section is missing. The store is registered
+        as a save listener so it sees every event saved here.
+        """
+        if self._recent_store is None and self.has_section('recent'):
+            self._build_recent_store()
+        return self._recent_store
+
+    def get_query_cache(self):
+        """Return the QueryCache from the [cache] section.
+
+        Return None if the section is missing. The cache is registered
+        as a save listener so writes invalidate it.
+        """
+        if self._query_cache is None and self.has_section('cache'):
+            self._build_query_cache()
+        return self._query_cache
+
+    def get_event_bus(self):
+        """Return the EventBus from the [subscribe] section.
+
+        Return None if the section is missing. The bus is registered
+        as a save listener so it sees every event saved here.
+        """
+        if self._event_bus is None and self.has_section('subscribe'):
+            self._build_event_bus()
+        return self._event_bus
+
+    def get_entity_index(self):
+        """Return the EntityIndex from the [entity_index] section.
+
+        Return None if the section is missing. The index is loaded
+        from its snapshot or built from the database, set on the
+        database as `db.entity_index' and registered as a save
+        listener.
+        """
+        if self._entity_index is None and self.has_section('entity_index'):
+            self._build_entity_index()
+        return self._entity_index
+
+    def get_retention(self):
+        """Return the Retention from the [retention] section.
+
+        Return None if the section is missing. Nothing is purged until
+        the caller runs it (see retention_background).
+        """
+        if self._retention is None and self.has_section('retention'):
+            self._build_retention()
+        return self._retention
+
+    def retention_background(self):
+        """Return True if the server should run the purge itself"""
+        return self._get_option('retention', 'background', 'true').lower() \
+            in ('true', 'yes', 'on', '1')
+
+    def get_metrics(self):
+        """Return the Metrics from the [metrics] section.
+
+        Return None if the section is missing. Otherwise the Metrics
+        object is installed, so instrumentation is recorded from now
+        on.
+        """
+        if self._metrics is None and self.has_section('metrics'):
+            self._build_metrics()
+        return self._metrics
+
+    def ingest_mode(self):
+        """Return 'sync' (default) or 'queue'"""
+        return self._get_option('ingest', 'mode', 'sync')
+
+    def ingest_ack(self):
+        """Return the default ack mode: 'commit' (default) or 'enqueue'"""
+        return self._get_option('ingest', 'ack', 'commit')
+
+    def ingest_commit_timeout(self):
+        """Return seconds to wait for a queued event to commit"""
+        return self._get_option('ingest', 'commit_timeout_ms', 30000,
+                                int) / 1000.0
+
+    def subscribe_heartbeat(self):
+        """Return seconds between keep-alive comments of /subscribe"""
+        return self._get_option('subscribe', 'heartbeat_s', 15, float)
+
+    def subscribe_max_seconds(self):
+        """Return seconds after which /subscribe ends a stream"""
+        return self._get_option('subscribe', 'max_stream_s', 300, float)
+
+    def _get_option(self, section, option, default, convert=str):
+        if not self.has_option(section, option):
+            return default
+        return convert(self.get(section, option))
+
     def _read_config_file(self):
         with open(self._config_file, 'r') as f:
             self.readfp(f)
 
+    # [database] options handled here rather than passed to web.py,
+    # with their defaults
+    _POOL_OPTIONS = {'pool_size' : None,
+                     'pool_max_overflow' : 10,
+                     'pool_timeout' : 30,
+                     'pool_recycle' : 3600}
+    _KEY_CACHE_OPTIONS = {'key_cache_size' : 10000}
+    _SQLITE_OPTIONS = {'sqlite_tuned' : 'false',
+                       'sqlite_synchronous' : 'NORMAL',
+                       'sqlite_mmap_size' : 268435456,
+                       'sqlite_cache_size' : -65536}
+
+    _REPLICA_OPTIONS = {'read_policy' : 'round_robin',
+                        'replica_check_s' : 10}
+
     def _build_db(self):
         items = self.items('database')
         
         # build database parameter list
         parms = dict(items)
+        partition_by = parms.pop('partition_by', None)
+        rollups = parms.pop('rollups', None)
+        keyCache = dict((k, parms.pop(k, v))
+                        for k, v in self._KEY_CACHE_OPTIONS.items())
+        replica = dict((k, parms.pop(k, v))
+                       for k, v in self._REPLICA_OPTIONS.items())
+
+        db = self._connect(parms)
+        if int(keyCache['key_cache_size']) > 0:
+            # keys are forgotten when their events may be purged
+            db.key_cache = KeyCache(int(keyCache['key_cache_size']),
+                                    retention=self.get_retention())
+        if partition_by is not None:
+            db.partitioning = Partitioning(partition_by)
+        if rollups is not None:
+            db.rollups = Rollups([r.strip() for r in rollups.split(',')])
+        self._db = db
+
+        # read replicas: [database:NAME] sections, with the connection
+        # options of [database]; data options follow the primary
+        replicas = []
+        for section in sorted(self.sections()):
+            if not section.startswith('database:'):
+                continue
+            replicaDb = self._connect(dict(self.items(section)))
+            replicaDb.primary = db
+            if partition_by is not None:
+                replicaDb.partitioning = Partitioning(partition_by)
+            if rollups is not None:
+                replicaDb.rollups = db.rollups
+            replicas.append((section[len('database:'):], replicaDb))
+        if replicas:
+            self._replica_set = ReplicaSet(
+                db, replicas, policy=replica['read_policy'],
+                check_interval_s=float(replica['replica_check_s']))
+
+    def _connect(self, parms):
+        """Return a web.py database from the options of a [database]
+        section, without the ones handled by _build_db"""
+        pool = dict((k, parms.pop(k, v))
+                    for k, v in self._POOL_OPTIONS.items())
+        sqlite = dict((k, parms.pop(k, v))
+                      for k, v in self._SQLITE_OPTIONS.items())
 
         # pass parameters through to web.database creator
-        self._db = web.database(**parms)
+        db = web.database(**parms)
+
+        if sqlite['sqlite_tuned'].lower() in ('true', 'yes', 'on', '1'):
+            tune_sqlite(db, synchronous=sqlite['sqlite_synchronous'],
+                        mmap_size=int(sqlite['sqlite_mmap_size']),
+                        cache_size=int(sqlite['sqlite_cache_size']))
+        if pool['pool_size'] is not None:
+            install_pool(db, size=int(pool['pool_size']),
+                         max_overflow=int(pool['pool_max_overflow']),
+                         timeout=float(pool['pool_timeout']),
+                         recycle=float(pool['pool_recycle']))
+        return db
+
+    def _build_ingest_queue(self):
+        queue = IngestQueue(
+            self.get_database(),
+            batch_size=self._get_option('ingest', 'batch_size', 500, int),
+            flush_interval_ms=self._get_option('ingest',
+                                               'flush_interval_ms', 50, int),
+            max_queue=self._get_option('ingest', 'max_queue', 10000, int),
+            enqueue_timeout_ms=self._get_option('ingest',
+                                                'enqueue_timeout_ms', 1000,
+                                                int))
+        queue.start()
+        # flush whatever is still queued when the process exits
+        atexit.register(queue.stop)
+        self._ingest_queue = queue
 
-# setup private global configuration
-_default_config_file = 'event.cfg'
-_default_config = EventConfig()
+    def _build_recent_store(self):
+        store = RecentEventStore(
+            window_ms=self._get_option('recent', 'window_ms', 300000, int),
+            max_events=self._get_option('recent', 'max_events', 100000, int),
+            buckets=self._get_option('recent', 'buckets', 60, int))
+        Event.add_save_listener(store.add)
+        self._recent_store = store
+
+    def _build_query_cache(self):
+        cache = QueryCache(
+            max_bytes=self._get_option('cache', 'max_bytes',
+                                       64 * 1024 * 1024, int),
+            ttl_ms=self._get_option('cache', 'ttl_ms', 5000, int))
+        Event.add_save_listener(cache.invalidate_events)
+        self._query_cache = cache
+
+    def _build_event_bus(self):
+        bus = EventBus(
+            max_queue=self._get_option('subscribe', 'max_queue', 1000, int))
+        Event.add_save_listener(bus.publish)
+        self._event_bus = bus
+
+    def _build_entity_index(self):
+        db = self.get_database()
+        index = EntityIndex(
+            snapshot=self._get_option('entity_index', 'snapshot', None),
+            refresh_s=self._get_option('entity_index', 'refresh_s', 1,
+                                       float),
+            refresh_lag_s=self._get_option('entity_index', 'refresh_lag_s',
+                                           10, float))
+        if index.load_snapshot():
+            index.refresh(db)
+        else:
+            index.rebuild(db)
+        Event.add_save_listener(index.add)
+        db.entity_index = index
+        self._entity_index = index
+
+    # policy options of the [retention] section: max_age (default),
+    # app.<applicationId> and app.<applicationId>.type.<eventTypeId>
+    _RETENTION_POLICY = re.compile(r'^app\.(\d+)(?:\.type\.(\d+))?$')
+
+    def _build_retention(self):
+        policies = []
+        for option, value in self.items('retention'):
+            if option == 'max_age':
+                policies.append(RetentionPolicy(parse_age(value)))
+                continue
+            match = self._RETENTION_POLICY.match(option)
+            if match is None:
+                continue
+            applicationId, eventTypeId = match.groups()
+            if eventTypeId is not None:
+                eventTypeId = int(eventTypeId)
+            policies.append(RetentionPolicy(parse_age(value),
+                                            int(applicationId), eventTypeId))
+        self._retention = Retention(
+            policies,
+            batch_size=self._get_option('retention', 'batch_size', 1000, int),
+            pause_ms=self._get_option('retention', 'pause_ms', 100, int),
+            interval_s=self._get_option('retention', 'interval_s', 3600,
+                                        int))
+
+    def _build_metrics(self):
+        metrics = Metrics(
+            slow_query_ms=self._get_option('metrics', 'slow_query_ms', None,
+                                           int))
+        logfile = self._get_option('metrics', 'slow_query_log', None)
+        if logfile is not None:
+            handler = logging.FileHandler(logfile)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logging.getLogger('gupta.slowquery').addHandler(handler)
+        install_metrics(metrics)
+        self._metrics = metrics
+
+# private global configuration, read on first use
+_CONFIG_ENV = 'GUPTA_CONFIG'
+_default_config_file = None # set by init(), else $GUPTA_CONFIG or event.cfg
+_default_config = None
+# get_config reads the config with init() while holding it
+_config_lock = threading.RLock()
+
+def _config_file():
+    if _default_config_file is not None:
+        return _default_config_file
+    return os.environ.get(_CONFIG_ENV, 'event.cfg')
+
+def init(config_file=None):
+    """Read the global config from config_file now and return it.
+
+    Without config_file, read $GUPTA_CONFIG or event.cfg. Components
+    built from an earlier global config are not stopped. Raise IOError
+    if the file can't be read.
+    """
+    global _default_config_file, _default_config
+    with _config_lock:
+        if config_file is not None:
+            _default_config_file = config_file
+        _default_config = EventConfig(_config_file())
+        return _default_config
 
 def get_database():
     """Return web.database object built from global config"""
-    return _default_config.get_database()
+    return get_config().get_database()
+
+def get_replica_set():
+    """Return ReplicaSet built from global config, or None"""
+    return get_config().get_replica_set()
+
+def get_ingest_queue():
+    """Return IngestQueue built from global config, or None"""
+    return get_config().get_ingest_queue()
+
+def get_recent_store():
+    """Return RecentEventStore built from global config, or None"""
+    return get_config().get_recent_store()
+
+def get_query_cache():
+    """Return QueryCache built from global config, or None"""
+    return get_config().get_query_cache()
 
-def get_test_database():
-    """Return in-memory sqlite temporary database for testing"""
+def get_event_bus():
+    """Return EventBus built from global config, or None"""
+    return get_config().get_event_bus()
 
-    # create a temporary sqlite db in memory
-    db = web.database(dbn='sqlite', db=':memory:')
+def get_entity_index():
+    """Return EntityIndex built from global config, or None"""
+    return get_config().get_entity_index()
 
-    # setup tables (poor man's sql split, no parsing)
-    with open('db/sqlite_tables.sql', 'r') as f:
-        sql_str = f.read()
-    sql = re.split(';$', sql_str, flags=re.M) # $ matches end of line
-    sql = [s.strip() for s in sql if s.strip() != '']
-    with nostderr():
-        for stmt in sql:
-            db.query(stmt)
+def get_retention():
+    """Return Retention built from global config, or None"""
+    return get_config().get_retention()
 
-    return db
+def get_metrics():
+    """Return Metrics built from global config, or None"""
+    return get_config().get_metrics()
+
+def get_config():
+    """Return the global EventConfig, reading it on first use.
+
+    Raise IOError if the config file can't be read.
+    """
+    config = _default_config
+    if config is None:
+        with _config_lock:
+            if _default_config is None:
+                return init()
+            config = _default_config
+    return config
+
+def reload():
+    """Re-read the global config file on its next use
+
+    Components built from the old config are not stopped; call this
+    before building any, e.g. in a freshly forked worker.
+    """
+    global _default_config
+    with _config_lock:
+        _default_config = None
+
+# temporary directory of test databases, and template files by seed flag
+_test_dir = None
+_test_templates = {}
+_test_templates_lock = threading.Lock()
+
+def _test_file(name=None):
+    """Return a path in this process's directory of test databases"""
+    global _test_dir
+    if _test_dir is None:
+        _test_dir = tempfile.mkdtemp(prefix='gupta-test-')
+        atexit.register(shutil.rmtree, _test_dir, True)
+    if name is not None:
+        return os.path.join(_test_dir, name)
+    fd, path = tempfile.mkstemp(suffix='.db', dir=_test_dir)
+    os.close(fd)
+    return path
+
+def _test_template(seed):
+    """Return the file of a test database, building it once.
+
+    The template holds the tables of db/sqlite_tables.sql and, if
+    seed is true, the events of TestData. It is written once per
+    process; test databases are copies of its file.
+    """
+    with _test_templates_lock:
+        template = _test_templates.get(seed)
+        if template is not None:
+            return template
+        template = _test_file('template%s.db' % ('-seeded' if seed else ''))
+        db = web.database(dbn='sqlite', db=template)
+        # setup tables (poor man's sql split, no parsing)
+        with open('db/sqlite_tables.sql', 'r') as f:
+            sql_str = f.read()
+        sql = re.split(';$', sql_str, flags=re.M) # $ matches end of line
+        sql = [s.strip() for s in sql if s.strip() != '']
+        with nostderr():
+            for stmt in sql:
+                db.query(stmt)
+            if seed:
+                # imported here: the test package imports this module
+                import gupta.test.data
+                events = [Event.from_dict(d) for d in
+                          gupta.test.data.TestData().json_objects()]
+                # not save_many: nothing is listening to this database
+                with db.transaction():
+                    Event._insert_events(db, 'event', 'event_entity',
+                                         events)
+        db.ctx.db.close()
+        _test_templates[seed] = template
+        return template
+
+def get_test_database(filename=':memory:', seed=False):
+    """Return sqlite temporary database for testing
+
+    Pass a file name to get the database in that file. Otherwise it
+    is in a temporary file, removed when the process exits; either
+    way it survives web.py's per-request cleanup of thread-local
+    connections. With seed=True, the database holds the events of
+    gupta.test.data.TestData, with eventIds 1 to 16 in their order.
+
+    The database is a copy of a template file built on the first
+    call, so later calls cost one file copy.
+    """
+    if filename == ':memory:':
+        # an in-memory database can't be copied into
+        filename = _test_file()
+    shutil.copyfile(_test_template(seed), filename)
+    return web.database(dbn='sqlite', db=filename)
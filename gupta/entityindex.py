@@ -0,0 +1,388 @@
+"""In-memory inverted index of event entities for Gupta Event API
+
+Queries with entityIds normally find their events by joining
+event_entity for every query. An EntityIndex keeps, for every (entity
+type, entity id), the sorted ids of the events linked to it in a
+compact array (a posting list), plus the application, event type and
+time of every indexed event. An entity filter, whether any or all of
+its entities must match, is then resolved in memory together with the
+applicationId, eventTypeId, time range and cursor of the query, and
+only the matching events are read from the database, by id.
+
+The index is built from the event tables on startup, or loaded from a
+snapshot file written on shutdown and then brought up to date with
+the events saved since. It is a save listener, so events saved through
+this process are indexed as they commit; events saved by other
+processes are picked up by reading the newer event ids at most every
+refresh_s seconds. Auto-increment ids can commit out of order (a
+transaction with a lower id commits after a higher id was read), so
+every refresh reads again the ids read in the last refresh_lag_s
+seconds; events already indexed are skipped. Events deleted by
+another process are dropped when a query doesn't find them in the
+database.
+
+The index is a property of a database: EventConfig sets it on the
+web.py database object as `db.entity_index' (see the [entity_index]
+section).
+
+Classes:
+  - EntityIndex: posting lists of entities and attributes of events
+"""
+
+import bisect
+import collections
+import marshal
+import os
+import sys
+import threading
+import time
+from array import array
+
+from gupta.event import Event
+
+# Ids and times are stored as C longs, which are 64 bits on the
+# platforms we run on; snapshots record the size and are only loaded
+# where it matches
+_TYPECODE = 'l'
+_SNAPSHOT_VERSION = 1
+
+# linked (event, entity) pairs of the events after some id
+_CATCH_UP_SQL = ('SELECT ent.event_id, event.application_id, ' +
+                 'event.event_type_id, event.event_time, ' +
+                 'ent.entity_type, ent.entity_id ' +
+                 'FROM %s ent JOIN %s event ON event.id = ent.event_id ' +
+                 'WHERE ent.event_id > %d ORDER BY ent.event_id')
+
+def _contains(ids, eventId):
+    pos = bisect.bisect_left(ids, eventId)
+    return pos < len(ids) and ids[pos] == eventId
+
+class EntityIndex(object):
+    """Posting lists of entities and attributes of indexed events.
+
+    Only events with related entities are indexed, since no others
+    can match an entity filter.
+
+    Example usage:
+      index = EntityIndex(snapshot='data/entity_index.snapshot')
+      if index.load_snapshot():
+          index.refresh(db)
+      else:
+          index.rebuild(db)
+      Event.add_save_listener(index.add)
+      db.entity_index = index   # used by Event.load_from_db
+    """
+
+    def __init__(self, snapshot=None, refresh_s=1, refresh_lag_s=10):
+        self.snapshot = snapshot
+        self.refresh_s = refresh_s
+        self.refresh_lag_s = refresh_lag_s
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._clear()
+        self._last_refresh = None
+        self._lookups = 0
+
+    def _clear(self):
+        # parallel arrays, sorted by event id
+        self._ids = array(_TYPECODE)
+        self._apps = array(_TYPECODE)
+        self._types = array(_TYPECODE)
+        self._times = array(_TYPECODE)
+        self._postings = {}  # (entityType, entityId) -> array of ids
+        self._max_id = 0     # highest event id read by refresh
+        self._marks = collections.deque()  # (time, _max_id) of refreshes
+        self._discarded = 0  # discarded ids still in postings
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, events):
+        """Index newly saved Events (a save listener)"""
+        with self._lock:
+            for evt in events:
+                if evt.relatedEntities:
+                    self._insert(evt.eventId, int(evt.applicationId),
+                                 int(evt.eventTypeId), int(evt.eventTime),
+                                 set((int(ent.entityType), int(ent.entityId))
+                                     for ent in evt.relatedEntities))
+
+    def _insert(self, eventId, applicationId, eventTypeId, eventTime, pairs):
+        """Index one event; return False if it already is"""
+        ids = self._ids
+        if not ids or ids[-1] < eventId:
+            pos = len(ids)
+        else:
+            pos = bisect.bisect_left(ids, eventId)
+            if pos < len(ids) and ids[pos] == eventId:
+                return False
+        # events mostly come in id order, so this appends
+        ids.insert(pos, eventId)
+        self._apps.insert(pos, applicationId)
+        self._types.insert(pos, eventTypeId)
+        self._times.insert(pos, eventTime)
+        for pair in pairs:
+            posting = self._postings.get(pair)
+            if posting is None:
+                self._postings[pair] = array(_TYPECODE, [eventId])
+            elif posting[-1] < eventId:
+                posting.append(eventId)
+            elif not _contains(posting, eventId):
+                posting.insert(bisect.bisect_left(posting, eventId), eventId)
+        return True
+
+    def discard(self, eventIds):
+        """Forget events that are no longer in the database"""
+        with self._lock:
+            for eventId in eventIds:
+                pos = bisect.bisect_left(self._ids, eventId)
+                if pos == len(self._ids) or self._ids[pos] != eventId:
+                    continue
+                for values in (self._ids, self._apps, self._types,
+                               self._times):
+                    del values[pos]
+                self._discarded += 1
+            # their ids are skipped by lookups; drop them from the
+            # posting lists once there are many
+            if self._discarded > max(1000, len(self._ids) // 10):
+                self._compact()
+
+    def _compact(self):
+        if not self._discarded:
+            return
+        ids = self._ids
+        for pair, posting in self._postings.items():
+            kept = array(_TYPECODE, [eventId for eventId in posting
+                                     if _contains(ids, eventId)])
+            if kept:
+                self._postings[pair] = kept
+            else:
+                del self._postings[pair]
+        self._discarded = 0
+
+    def lookup(self, db, applicationId, start, end=None, eventTypeId=None,
+               entityIds=None, entityMatch='any', cursor=None):
+        """Return (eventTime, eventId) of the matching events, in order.
+
+        Takes the filters of Event.load_from_db; entityIds is required
+        and eventTypeId may be a list. Refreshes the index first if it
+        is more than refresh_s seconds old. Raise ValueError for a
+        malformed filter.
+        """
+        if entityMatch not in ('any', 'all'):
+            raise ValueError("entityMatch must be 'any' or 'all'")
+        wanted = set()
+        for entityType in entityIds:
+            for entityId in entityIds[entityType]:
+                wanted.add((int(entityType), int(entityId)))
+        if len(wanted) == 0:
+            raise ValueError("entityIds must name at least one entity")
+        types = None
+        if isinstance(eventTypeId, (list, tuple, set, frozenset)):
+            types = set(int(t) for t in eventTypeId)
+            if len(types) == 0:
+                raise ValueError("eventTypeId must name at least one type")
+        elif eventTypeId is not None:
+            types = set([int(eventTypeId)])
+        after = None
+        if cursor is not None:
+            after = Event._decode_cursor(cursor)
+        applicationId = int(applicationId)
+        start = int(start)
+        if end is not None:
+            end = int(end)
+        if (self.refresh_s is not None and
+            time.time() - (self._last_refresh or 0) >= self.refresh_s):
+            self.refresh(db)
+        with self._lock:
+            self._lookups += 1
+            postings = [self._postings.get(pair) for pair in wanted]
+            if entityMatch == 'all':
+                if any(posting is None for posting in postings):
+                    return []
+                # walk the shortest list, probe the others
+                postings.sort(key=len)
+                candidates = [eventId for eventId in postings[0]
+                              if all(_contains(posting, eventId)
+                                     for posting in postings[1:])]
+            else:
+                candidates = set()
+                for posting in postings:
+                    if posting is not None:
+                        candidates.update(posting)
+            ids, apps, times = self._ids, self._apps, self._times
+            eventTypes = self._types
+            matches = []
+            for eventId in candidates:
+                pos = bisect.bisect_left(ids, eventId)
+                if pos == len(ids) or ids[pos] != eventId:
+                    continue  # discarded
+                if apps[pos] != applicationId:
+                    continue
+                if types is not None and eventTypes[pos] not in types:
+                    continue
+                eventTime = times[pos]
+                if eventTime <= start or (end is not None and
+                                          eventTime >= end):
+                    continue
+                if after is not None and (eventTime, eventId) <= after:
+                    continue
+                matches.append((eventTime, eventId))
+        matches.sort()
+        return matches
+
+    def rebuild(self, db):
+        """Index every event with entities in db from scratch"""
+        with self._lock:
+            self._clear()
+        return self.refresh(db)
+
+    def refresh(self, db):
+        """Index the events saved since the last refresh, by any process.
+
+        Also reads again the ids read in the last refresh_lag_s
+        seconds, for events that committed after higher ids. Return
+        the number of events newly indexed. A refresh that is already
+        running in another thread is not repeated.
+        """
+        if not self._refresh_lock.acquire(False):
+            return 0
+        try:
+            now = time.time()
+            after = self._lag_mark(now)
+            count = 0
+            maxId = self._max_id
+            for eventTable, entityTable in self._tables(db):
+                rows = Event._execute_rows(db, _CATCH_UP_SQL % (
+                    entityTable, eventTable, after))
+                for events in self._group_rows(rows):
+                    with self._lock:
+                        for event in events:
+                            if self._insert(*event):
+                                count += 1
+                    maxId = max(maxId, events[-1][0])
+            self._max_id = maxId
+            self._marks.append((now, maxId))
+            self._last_refresh = now
+            return count
+        finally:
+            self._refresh_lock.release()
+
+    def _lag_mark(self, now):
+        """Return the highest id read by the newest refresh at least
+        refresh_lag_s old (or by the oldest one kept), dropping older
+        marks"""
+        marks = self._marks
+        if not self.refresh_lag_s or not marks:
+            marks.clear()
+            return self._max_id
+        while len(marks) > 1 and marks[1][0] <= now - self.refresh_lag_s:
+            marks.popleft()
+        return marks[0][1]
+
+    @staticmethod
+    def _tables(db):
+        partitioning = getattr(db, 'partitioning', None)
+        if partitioning is None:
+            return [('event', 'event_entity')]
+        return [partitioning.tables(name)
+                for name in partitioning.overlapping(db, -1)]
+
+    @staticmethod
+    def _group_rows(rows, size=1000):
+        """Generate lists of up to size _insert argument tuples"""
+        events = []
+        last = None
+        for row in rows:
+            if last is None or last[0] != row[0]:
+                if last is not None:
+                    events.append(last)
+                    if len(events) == size:
+                        yield events
+                        events = []
+                last = (row[0], row[1], row[2], row[3], set())
+            last[4].add((row[4], row[5]))
+        if last is not None:
+            events.append(last)
+        if events:
+            yield events
+
+    def save_snapshot(self):
+        """Write the index to the snapshot file; return False if there
+        is none"""
+        if self.snapshot is None:
+            return False
+        # per process: pre-fork workers all write on shutdown
+        tmp = '%s.%d.tmp' % (self.snapshot, os.getpid())
+        with self._lock:
+            self._compact()
+            data = (_SNAPSHOT_VERSION, array(_TYPECODE).itemsize,
+                    self._max_id, self._ids.tostring(),
+                    self._apps.tostring(), self._types.tostring(),
+                    self._times.tostring(),
+                    [(pair[0], pair[1], posting.tostring())
+                     for pair, posting in self._postings.items()])
+            with open(tmp, 'wb') as f:
+                marshal.dump(data, f)
+        # never leave a half-written snapshot behind
+        os.rename(tmp, self.snapshot)
+        return True
+
+    def load_snapshot(self):
+        """Replace the index with the snapshot file.
+
+        Return False, keeping the index as it is, if there is no
+        usable snapshot. Events saved since it was written are only
+        indexed by the next refresh.
+        """
+        if self.snapshot is None:
+            return False
+        try:
+            with open(self.snapshot, 'rb') as f:
+                data = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if (not isinstance(data, tuple) or len(data) != 8 or
+            data[0] != _SNAPSHOT_VERSION or
+            data[1] != array(_TYPECODE).itemsize):
+            return False
+        arrays = []
+        for values in data[3:7]:
+            arrays.append(array(_TYPECODE))
+            arrays[-1].fromstring(values)
+        postings = {}
+        for entityType, entityId, values in data[7]:
+            posting = postings[(entityType, entityId)] = array(_TYPECODE)
+            posting.fromstring(values)
+        with self._lock:
+            self._clear()
+            self._ids, self._apps, self._types, self._times = arrays
+            self._postings = postings
+            self._max_id = data[2]
+        return True
+
+    def stats(self):
+        """Return sizes and counters, for /stats.
+
+        `bytes' estimates the memory of the arrays and of the dict of
+        posting lists with its keys.
+        """
+        with self._lock:
+            size = sys.getsizeof(self._postings)
+            for values in (self._ids, self._apps, self._types, self._times):
+                size += sys.getsizeof(values)
+            postings = 0
+            for pair, posting in self._postings.items():
+                postings += len(posting)
+                size += sys.getsizeof(posting) + sys.getsizeof(pair)
+            # the key's two ints
+            size += len(self._postings) * 2 * sys.getsizeof(0)
+            lastRefresh = None
+            if self._last_refresh is not None:
+                lastRefresh = int(self._last_refresh * 1000)
+            return {'events' : len(self._ids),
+                    'entities' : len(self._postings),
+                    'postings' : postings,
+                    'bytes' : size,
+                    'lookups' : self._lookups,
+                    'lastRefresh' : lastRefresh}
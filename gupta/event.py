@@ -10,16 +10,24 @@ Event.from_json(json_obj)
 
 To load events from the database, see:
 Event.load_from_db( ... )
+Event.iter_from_db( ... )
+Event.stream_from_db( ... )
 """
 
-import json
+import base64
+import logging
+import time
+import web
 from datetime import datetime
-from gupta.util import millis
+from gupta import codec, metrics
+from gupta.util import after_commit, millis, transaction
+
+_log = logging.getLogger(__name__)
 
 class EventError(Exception):
     pass
 
-class Event:
+class Event(object):
     """A representation of an event.
 
     Attributes:
@@ -30,10 +38,18 @@ class Event:
     - body (text)
     - eventTime (optional, epoch time in milliseconds, default: now)
     - relatedEntities (optional, list of Entity objects, default: empty list)
+    - idempotencyKey (optional, text unique per application, default: None)
+    - duplicate (True once a save found the idempotencyKey already saved)
     """
 
+    # no per-instance __dict__: large query results build many Events
+    __slots__ = ('eventId', 'applicationId', 'eventTypeId', 'eventTime',
+                 'headline', 'body', 'relatedEntities', 'idempotencyKey',
+                 'duplicate')
+
     def __init__(self, applicationId, eventTypeId, headline, body,
-                 eventId=None, eventTime=None, relatedEntities=None):
+                 eventId=None, eventTime=None, relatedEntities=None,
+                 idempotencyKey=None):
         """Create a new Event object.
 
         Required parameters:
@@ -46,6 +62,7 @@ class Event:
         - `eventId' (default: None)
         - `eventTime' (epoch time in millis, default: now)
         - `relatedEntities' (a list of Entity objects, default: empty list).
+        - `idempotencyKey' (default: None, see save_many).
         """
         self.applicationId = applicationId
         self.eventTypeId = eventTypeId
@@ -60,11 +77,46 @@ class Event:
             self.relatedEntities = []
         else:
             self.relatedEntities = relatedEntities
+        self.idempotencyKey = idempotencyKey
+        self.duplicate = False
 
     def is_saved(self):
         """Return True if this event is already saved to the database."""
         return self.eventId is not None
 
+    def cursor(self):
+        """Return an opaque cursor for the page that follows this event.
+
+        Results are ordered by (eventTime, eventId), so the cursor
+        just encodes that pair; see load_from_db.
+        """
+        return Event._make_cursor(self.eventTime, self.eventId)
+
+    @staticmethod
+    def _make_cursor(eventTime, eventId):
+        key = '%d:%d' % (eventTime, eventId)
+        return base64.urlsafe_b64encode(key)
+
+    @staticmethod
+    def _cursor_of(item):
+        """Return the cursor after an Event or an event dict."""
+        if isinstance(item, dict):
+            return Event._make_cursor(item['eventTime'], item['eventId'])
+        return item.cursor()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """Return (eventTime, eventId) from a cursor.
+
+        Raise ValueError if the cursor is malformed.
+        """
+        try:
+            key = base64.urlsafe_b64decode(str(cursor))
+            eventTime, eventId = key.split(':')
+            return long(eventTime), long(eventId)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor '%s'" % cursor)
+
     def save(self, db):
         """Save Event and related Entities to database.
 
@@ -72,24 +124,322 @@ class Event:
 
         Raise EventError if object is already saved.
         """
-        if self.is_saved():
-            raise EventError("Event with ID %d already exists" % self.eventId)
-        with db.transaction():
-            self.eventId = db.insert('event',
-                                     application_id = self.applicationId,
-                                     event_time = self.eventTime,
-                                     event_type_id = self.eventTypeId,
-                                     headline = self.headline,
-                                     body = self.body)
-            entities = [ {'event_id' : self.eventId,
-                          'entity_type' : ent.entityType,
-                          'entity_id' : ent.entityId}
-                         for ent in self.relatedEntities ]
-            if len(entities) > 0:
-                db.multiple_insert('event_entity', values=entities)
-
-    def to_dict(self):
-        """Return a dict representation of this event."""
+        Event.save_many(db, [self])
+
+    @staticmethod
+    def save_many(db, events):
+        """Save a batch of Events and their Entities in one transaction.
+
+        Rows are written with multi-row inserts, so the cost of a
+        batch is a handful of statements rather than two per event.
+        Each event's eventId is set, and the list of assigned
+        eventIds is returned in the same order as `events'.
+
+        An event whose idempotencyKey is already saved for its
+        application (or earlier in the batch) isn't saved again: it
+        gets the eventId of the original and its `duplicate' flag is
+        set. Keys recently saved through db are found in its
+        key_cache, if it has one, without a query.
+
+        The batch is atomic: if any insert fails nothing is saved.
+        Called inside a transaction, the batch joins it; the save
+        listeners are then only called when it commits if it was
+        opened with gupta.util.committing. See save_batch for per-event
+        error reporting.
+
+        Raise EventError if any event is already saved.
+        """
+        for evt in events:
+            if evt.is_saved():
+                raise EventError("Event with ID %d already exists" %
+                                 evt.eventId)
+        if len(events) == 0:
+            return []
+        m = metrics.current
+        if m is not None:
+            t0 = time.time()
+        cache = getattr(db, 'key_cache', None)
+        # (applicationId, idempotencyKey) -> eventId of saved keys
+        saved = {}
+        if cache is not None:
+            for evt in events:
+                if evt.idempotencyKey is not None:
+                    eventId = cache.get(evt.applicationId,
+                                        evt.idempotencyKey)
+                    if eventId is not None:
+                        saved[Event._key_of(evt)] = eventId
+        pending = [evt for evt in events if Event._key_of(evt) not in saved]
+        fresh = []
+        if pending:
+            joined = bool(db.ctx.transactions)
+            partitioning = getattr(db, 'partitioning', None)
+            if partitioning is not None:
+                # DDL, so before the transaction starts
+                for name in set(partitioning.name_for(int(evt.eventTime))
+                                for evt in pending):
+                    partitioning.ensure(db, name)
+            retried = False
+            while True:
+                try:
+                    with transaction(db):
+                        fresh, freshIds = Event._insert_new(db, pending,
+                                                            saved)
+                    break
+                except Exception:
+                    # a concurrent save of the same key may have won:
+                    # look the keys up again, once, in a new transaction
+                    if (joined or retried or
+                        all(evt.idempotencyKey is None for evt in pending)):
+                        raise
+                    retried = True
+            for evt, evtId in zip(fresh, freshIds):
+                evt.eventId = evtId
+                if evt.idempotencyKey is not None:
+                    saved[Event._key_of(evt)] = evtId
+                    # uncommitted until the caller's transaction is
+                    if cache is not None and not joined:
+                        cache.put(evt.applicationId, evt.idempotencyKey,
+                                  evtId, evt.eventTypeId, evt.eventTime)
+        for evt in events:
+            if evt.eventId is None:
+                evt.eventId = saved[Event._key_of(evt)]
+                evt.duplicate = True
+        if m is not None:
+            m.observe('gupta_stage_seconds', time.time() - t0, stage='save')
+            m.increment('gupta_events_total', len(fresh), stage='save')
+        if fresh:
+            # inside gupta.util.committing, once the caller commits
+            after_commit(db, lambda: Event._notify_saved(fresh))
+        return [evt.eventId for evt in events]
+
+    @staticmethod
+    def _key_of(evt):
+        """Return (applicationId, idempotencyKey) of evt, or None"""
+        if evt.idempotencyKey is None:
+            return None
+        return (int(evt.applicationId), evt.idempotencyKey)
+
+    @staticmethod
+    def _insert_new(db, events, saved):
+        """Insert the events whose keys aren't saved yet.
+
+        Looks up the keys missing from `saved' and adds them to it.
+        Must be called inside a transaction. Return the list of
+        inserted events and the list of their ids.
+        """
+        wanted = {}
+        for evt in events:
+            key = Event._key_of(evt)
+            if key is not None and key not in saved:
+                wanted.setdefault(key[0], set()).add(key[1])
+        for applicationId, keys in wanted.items():
+            keys = sorted(keys)
+            # one parameter per key, plus the applicationId
+            chunkSize = Event._MAX_INSERT_PARAMS - 1
+            for i in range(0, len(keys), chunkSize):
+                rows = db.select('event_key',
+                                 what='idempotency_key, event_id',
+                                 where='application_id = $a AND '
+                                       'idempotency_key IN $keys',
+                                 vars={'a' : applicationId,
+                                       'keys' : keys[i:i + chunkSize]})
+                for row in rows:
+                    saved[(applicationId, row.idempotency_key)] = \
+                        row.event_id
+        fresh = []
+        firsts = set()
+        for evt in events:
+            key = Event._key_of(evt)
+            if key is not None:
+                if key in saved or key in firsts:
+                    continue
+                firsts.add(key)
+            fresh.append(evt)
+        if not fresh:
+            return [], []
+        partitioning = getattr(db, 'partitioning', None)
+        if partitioning is None:
+            eventIds = Event._insert_events(db, 'event', 'event_entity',
+                                            fresh)
+        else:
+            eventIds = partitioning.allocate_ids(db, len(fresh))
+            byName = {}
+            for evt, evtId in zip(fresh, eventIds):
+                name = partitioning.name_for(int(evt.eventTime))
+                byName.setdefault(name, []).append((evt, evtId))
+            for name, pairs in byName.items():
+                eventTable, entityTable = partitioning.tables(name)
+                Event._insert_events(db, eventTable, entityTable,
+                                     [evt for evt, evtId in pairs],
+                                     [evtId for evt, evtId in pairs])
+        keyRows = [{'application_id' : evt.applicationId,
+                    'idempotency_key' : evt.idempotencyKey,
+                    'event_id' : evtId}
+                   for evt, evtId in zip(fresh, eventIds)
+                   if evt.idempotencyKey is not None]
+        if keyRows:
+            Event._insert_rows(db, 'event_key', keyRows, ids=False)
+        rollups = getattr(db, 'rollups', None)
+        if rollups is not None:
+            rollups.update(db, fresh)
+        return fresh, eventIds
+
+    # Callables notified with each list of newly committed events
+    _save_listeners = []
+
+    @staticmethod
+    def add_save_listener(listener):
+        """Call listener(events) after every committed save.
+
+        Listeners keep in-process views of the data (caches, recent
+        event windows) up to date. An exception raised by a listener
+        is logged and doesn't fail the save.
+        """
+        Event._save_listeners.append(listener)
+
+    @staticmethod
+    def remove_save_listener(listener):
+        """Stop notifying a listener added with add_save_listener."""
+        Event._save_listeners.remove(listener)
+
+    @staticmethod
+    def _notify_saved(events):
+        for listener in list(Event._save_listeners):
+            try:
+                listener(events)
+            except Exception:
+                _log.exception("Save listener %r failed", listener)
+
+    @staticmethod
+    def save_batch(db, events):
+        """Save a batch of Events, reporting failures per event.
+
+        The whole batch is first tried with save_many. If that fails,
+        each event is saved on its own so that one bad record does
+        not reject the rest.
+
+        Return a list with one entry per event: None if the event was
+        saved (its eventId is set), otherwise the exception raised.
+        """
+        try:
+            Event.save_many(db, events)
+            return [None] * len(events)
+        except Exception:
+            pass
+        errors = []
+        for evt in events:
+            try:
+                evt.save(db)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    @staticmethod
+    def _insert_events(db, eventTable, entityTable, events, eventIds=None):
+        """Insert events and their entities into the given tables.
+
+        Ids are assigned by the database unless eventIds are given.
+        Must be called inside a transaction. Return the event ids.
+        """
+        eventRows = [ {'application_id' : evt.applicationId,
+                       'event_time' : evt.eventTime,
+                       'event_type_id' : evt.eventTypeId,
+                       'headline' : evt.headline,
+                       'body' : evt.body}
+                      for evt in events ]
+        if eventIds is None:
+            eventIds = Event._insert_rows(db, eventTable, eventRows)
+        else:
+            for row, evtId in zip(eventRows, eventIds):
+                row['id'] = evtId
+            Event._insert_rows(db, eventTable, eventRows, ids=False)
+        entities = [ {'event_id' : evtId,
+                      'entity_type' : ent.entityType,
+                      'entity_id' : ent.entityId}
+                     for evt, evtId in zip(events, eventIds)
+                     for ent in evt.relatedEntities ]
+        if len(entities) > 0:
+            Event._insert_rows(db, entityTable, entities, ids=False)
+        return eventIds
+
+    # Rows per INSERT statement are capped so a statement never binds
+    # more than 999 parameters (SQLite's default limit).
+    _MAX_INSERT_PARAMS = 999
+
+    @staticmethod
+    def _insert_rows(db, tablename, rows, ids=True):
+        """Insert a list of row dicts with multi-row INSERT statements.
+
+        All rows must have the same keys. Must be called inside a
+        transaction. Return the list of ids assigned to the rows, or
+        None if `ids' is false (for tables without an id column).
+        Where a multi-row INSERT may not assign consecutive ids, rows
+        whose ids are needed are inserted one at a time.
+        """
+        keys = sorted(rows[0].keys())
+        chunkSize = max(1, Event._MAX_INSERT_PARAMS // len(keys))
+        if ids and not Event._consecutive_ids(db):
+            chunkSize = 1
+        rowIds = []
+        for i in range(0, len(rows), chunkSize):
+            chunk = rows[i:i + chunkSize]
+            sql = web.SQLQuery('INSERT INTO %s (%s) VALUES ' %
+                               (tablename, ', '.join(keys)))
+            for j, row in enumerate(chunk):
+                if j != 0:
+                    sql.append(', ')
+                web.SQLQuery.join([web.SQLParam(row[k]) for k in keys],
+                                  sep=', ', target=sql,
+                                  prefix='(', suffix=')')
+            db.query(sql)
+            if ids:
+                rowIds.extend(Event._inserted_ids(db, len(chunk)))
+        if ids:
+            return rowIds
+        return None
+
+    @staticmethod
+    def _consecutive_ids(db):
+        """Return whether a multi-row INSERT into db assigns consecutive
+        ids, remembered as `db.consecutive_ids'.
+
+        SQLite has a single writer. MySQL only guarantees it with
+        innodb_autoinc_lock_mode 0 or 1; 2 (interleaved, the default
+        since MySQL 8.0) lets concurrent inserts take ids in between.
+        """
+        consecutive = getattr(db, 'consecutive_ids', None)
+        if consecutive is None:
+            consecutive = True
+            if getattr(db, 'dbname', None) == 'mysql':
+                rows = db.query('SELECT @@innodb_autoinc_lock_mode AS mode')
+                consecutive = int(rows[0].mode) in (0, 1)
+            db.consecutive_ids = consecutive
+        return consecutive
+
+    @staticmethod
+    def _inserted_ids(db, count):
+        """Return ids assigned by the last multi-row INSERT of count rows.
+
+        MySQL's last_insert_id() is the first id of the statement,
+        while SQLite's last_insert_rowid() is the last one. The ids
+        must be consecutive (see _consecutive_ids).
+        """
+        if getattr(db, 'dbname', None) == 'mysql':
+            first = db.query('SELECT last_insert_id() AS id')[0].id
+            return range(first, first + count)
+        last = db.query('SELECT last_insert_rowid() AS id')[0].id
+        return range(last - count + 1, last + 1)
+
+    def to_dict(self, fields=None):
+        """Return a dict representation of this event.
+
+        With a list of field names (see Event.FIELDS), only those
+        fields are included.
+        """
+        m = metrics.current
+        if m is not None:
+            t0 = time.time()
         myDict = {'eventId' : self.eventId,
                   'applicationId' : self.applicationId,
                   'eventTypeId' : self.eventTypeId,
@@ -105,139 +455,629 @@ class Event:
             entities[entityType].append(ent.entityId)
         if len(entities.keys()) > 0:
             myDict['relatedEntities'] = entities
+        if fields is not None:
+            for name in Event.FIELDS:
+                if name not in fields and name in myDict:
+                    del myDict[name]
+        if m is not None:
+            m.observe('gupta_stage_seconds', time.time() - t0,
+                      stage='to_dict')
         return myDict
 
+    # Terms per compound SELECT (SQLITE_MAX_COMPOUND_SELECT's default)
+    _MAX_COMPOUND_SELECT = 500
+
     @staticmethod
-    def _sql_where_clause(applicationId, start, end, eventTypeId, entityIds):
+    def _sql_entity_subquery(entityIds, entityMatch='any',
+                             entityTable='event_entity'):
+        """Return SQL selecting ids of events linked to entityIds.
+
+        The wanted (entity_type, entity_id) pairs are joined as a value
+        list against event_entity, which uses the idx_entity index.
+        With entityMatch 'any' an event matches if it is linked to any
+        of the entities, with 'all' it must be linked to every one.
+        """
+        if entityMatch not in ('any', 'all'):
+            raise ValueError("entityMatch must be 'any' or 'all'")
+        wanted = set()
+        for entityType in entityIds:
+            for entId in entityIds[entityType]:
+                wanted.add((int(entityType), int(entId)))
+        if len(wanted) == 0:
+            raise ValueError("entityIds must name at least one entity")
+        selects = ['SELECT %d AS entity_type, %d AS entity_id' % pair
+                   for pair in sorted(wanted)]
+        size = Event._MAX_COMPOUND_SELECT
+        if len(selects) > size:
+            # SQLite caps the terms of one compound SELECT; nest chunks
+            # of them as derived tables
+            selects = ['SELECT * FROM (%s) w%d' %
+                       (' UNION ALL '.join(selects[i:i + size]), i // size)
+                       for i in range(0, len(selects), size)]
+        values = ' UNION ALL '.join(selects)
+        sql = ('SELECT ent2.event_id FROM %s ent2 ' +
+               'JOIN (%s) wanted ' +
+               'ON ent2.entity_type = wanted.entity_type ' +
+               'AND ent2.entity_id = wanted.entity_id') % (entityTable, values)
+        if entityMatch == 'all':
+            # (event_id, entity_type, entity_id) is unique, so an event
+            # has every wanted entity when all of them joined
+            sql += (' GROUP BY ent2.event_id HAVING COUNT(*) = %d' %
+                    len(wanted))
+        return sql
+
+    @staticmethod
+    def _sql_where_clause(applicationId, start, end, eventTypeId, entityIds,
+                          cursor=None, entityMatch='any',
+                          entityTable='event_entity'):
         wheres = []
 
         # application ID
         wheres.append('event.application_id = %d' % int(applicationId))
         # start time
         wheres.append('event.event_time > %d' % int(start))
+        # keyset pagination: only events after (eventTime, eventId) of
+        # the cursor. The redundant >= keeps it a range scan.
+        if cursor is not None:
+            cursorTime, cursorId = Event._decode_cursor(cursor)
+            wheres.append('event.event_time >= %d' % cursorTime)
+            wheres.append(('(event.event_time > %d OR ' +
+                           '(event.event_time = %d AND event.id > %d))') %
+                          (cursorTime, cursorTime, cursorId))
         # end time
         if end is not None:
             wheres.append('event.event_time < %d' % int(end))
-        # filter by event_type_id
-        if eventTypeId is not None:
+        # filter by event_type_id, or a list of them
+        if isinstance(eventTypeId, (list, tuple, set, frozenset)):
+            if len(eventTypeId) == 0:
+                raise ValueError("eventTypeId must name at least one type")
+            wheres.append('event.event_type_id IN (%s)' %
+                          ', '.join('%d' % t for t in
+                                    sorted(set(int(t) for t in eventTypeId))))
+        elif eventTypeId is not None:
             wheres.append('event.event_type_id = %d' % int(eventTypeId))
 
-        # Filters for entities in entityIds map. Build a complicated
-        # subquery only in the case where entityIds are specified.
+        # Filters for entities in entityIds map. Build a subquery only
+        # in the case where entityIds are specified.
         if entityIds is not None:
-            entityWheres = []
-            for entityType in entityIds:
-                for entId in entityIds[entityType]:
-                    typeClause = 'ent2.entity_type = %d' % int(entityType)
-                    idClause = 'ent2.entity_id = %d' % int(entId)
-                    entClause = ' AND '.join([typeClause, idClause])
-                    entityWheres.append('(' + entClause + ')')
-            if len(entityWheres) > 1:
-                entity_where_str = '(' + ' OR '.join(entityWheres) + ')'
-            else:
-                entity_where_str = entityWheres[0]
-            entity_cond = ('event.id IN ' +
-                           '(SELECT e2.id FROM event e2, ' +
-                           'event_entity ent2 ' +
-                           'WHERE e2.id = ent2.event_id ' +
-                           'AND %s)') % entity_where_str
-            wheres.append(entity_cond)
+            wheres.append('event.id IN (%s)' %
+                          Event._sql_entity_subquery(entityIds, entityMatch,
+                                                     entityTable))
 
         return ' AND '.join(wheres)
 
+    # Fields of to_dict, which queries can select with `fields'
+    FIELDS = ('eventId', 'applicationId', 'eventTime', 'eventTypeId',
+              'headline', 'body', 'relatedEntities')
+
+    # Results are ordered and paged by these, so they're always read
+    _KEY_FIELDS = ('eventId', 'eventTime')
+
+    # Event table columns read by _select_rows, in row tuple order,
+    # with their fields. The row ends with the entity type and id,
+    # which are NULL for events without related entities.
+    _FIELD_COLUMNS = (('eventId', 'id'),
+                      ('applicationId', 'application_id'),
+                      ('eventTime', 'event_time'),
+                      ('eventTypeId', 'event_type_id'),
+                      ('headline', 'headline'),
+                      ('body', 'body'))
+
+    @staticmethod
+    def _check_fields(fields):
+        """Return fields as a frozenset, or None for every field.
+
+        Raise ValueError for an unknown field name.
+        """
+        if fields is None:
+            return None
+        fields = frozenset(fields)
+        for name in fields:
+            if name not in Event.FIELDS:
+                raise ValueError("Unknown field '%s'" % name)
+        fields = fields.union(Event._KEY_FIELDS)
+        if len(fields) == len(Event.FIELDS):
+            return None
+        return fields
+
+    @staticmethod
+    def _select_columns(fields, prefix='event.'):
+        """Return the select list for fields (see _check_fields).
+
+        Columns of fields that aren't wanted are selected as NULL, so
+        rows keep their shape, and the entity columns are NULL unless
+        relatedEntities is wanted.
+        """
+        columns = []
+        for name, column in Event._FIELD_COLUMNS:
+            if fields is None or name in fields:
+                columns.append('%s%s AS %s' % (prefix, column, column))
+            else:
+                columns.append('NULL AS %s' % column)
+        if fields is None or 'relatedEntities' in fields:
+            columns.append('event_entity.entity_type AS entity_type')
+            columns.append('event_entity.entity_id AS entity_id')
+        else:
+            columns.append('NULL AS entity_type')
+            columns.append('NULL AS entity_id')
+        return ', '.join(columns)
+
+    @staticmethod
+    def _event_columns(fields):
+        """Return the event table columns of fields, for a derived table"""
+        return ', '.join('event.' + column
+                         for name, column in Event._FIELD_COLUMNS
+                         if fields is None or name in fields)
+
     @staticmethod
     def load_from_db(db, applicationId, start, end=None, eventTypeId=None,
-                     entityIds=None):
+                     entityIds=None, limit=None, cursor=None,
+                     entityMatch='any', recent=None, fields=None):
         """Return a list of matching Event objects from the db.
 
         Parameters to this method narrow the matches. Required
         parameters are applicationId and start time. Optional
         parameters are end time, eventTypeId, and entityIds.
+        eventTypeId may also be a list of ids, any of which matches.
+
+        entityIds maps entity types to lists of entity ids. By default
+        an event matches if it is linked to any of them; pass
+        entityMatch='all' to require every listed entity.
+
+        Events are ordered by (eventTime, eventId). To page through
+        results, pass a `limit' and the `cursor' of the last event of
+        the previous page (see Event.cursor). Every page costs the
+        same, however deep.
+
+        If `recent' is a RecentEventStore (see gupta.recent) and the
+        queried range lies in its window, it answers instead of the
+        database. Entity filters are resolved by the database's
+        EntityIndex (see gupta.entityindex), if it has one.
+
+        `fields' is a list of the fields (see Event.FIELDS) to read;
+        the others are left None, or empty for relatedEntities.
+        eventId and eventTime are always read. Without relatedEntities
+        the entity table isn't joined at all.
+        """
+        m = metrics.current
+        if m is not None:
+            t0 = time.time()
+        events = list(Event.iter_from_db(db, applicationId, start, end,
+                                         eventTypeId, entityIds, limit,
+                                         cursor, entityMatch, recent,
+                                         fields=fields))
+        if m is not None:
+            m.observe('gupta_stage_seconds', time.time() - t0,
+                      stage='load_from_db')
+            m.increment('gupta_events_total', len(events),
+                        stage='load_from_db')
+        return events
+
+    @staticmethod
+    def iter_from_db(db, applicationId, start, end=None, eventTypeId=None,
+                     entityIds=None, limit=None, cursor=None,
+                     entityMatch='any', recent=None, as_dicts=False,
+                     fields=None):
+        """Generate matching Event objects from the db.
+
+        Takes the same parameters as load_from_db. Events and their
+        entities are read with a single LEFT JOIN ordered by event
+        time and id, and rows are grouped into Events as they come
+        off the cursor.
+
+        With as_dicts=True, generate the dicts Event.to_dict would
+        return instead, built straight from the rows without any
+        Event or Entity objects in between. They only have the keys
+        of `fields', plus eventId and eventTime.
+
+        Raise ValueError for a malformed cursor, limit, entity filter
+        or field name.
+        """
+        fields = Event._check_fields(fields)
+        if recent is not None:
+            events = recent.query(db, applicationId, start, end,
+                                  eventTypeId, entityIds, limit, cursor,
+                                  entityMatch)
+            if events is not None:
+                for evt in events:
+                    if as_dicts:
+                        yield evt.to_dict(fields)
+                    else:
+                        yield evt
+                return
+        if entityIds is not None:
+            # replicas have no entity index: its lookups, and the reads
+            # of the ids it finds, go to the primary it indexes
+            primary = getattr(db, 'primary', None)
+            if getattr(primary, 'entity_index', None) is not None:
+                db = primary
+        index = getattr(db, 'entity_index', None)
+        if index is not None and entityIds is not None:
+            # resolve the filters in memory, read only the matches
+            if limit is not None and int(limit) < 1:
+                raise ValueError("limit must be a positive integer")
+            matches = index.lookup(db, applicationId, start, end,
+                                   eventTypeId, entityIds, entityMatch,
+                                   cursor)
+            rows = Event._select_id_rows(db, index, matches, limit, fields)
+        else:
+            rows = Event._select_rows(db, applicationId, start, end,
+                                      eventTypeId, entityIds, limit, cursor,
+                                      entityMatch, fields)
+        if as_dicts:
+            items = Event._group_dicts(rows, fields)
+        else:
+            items = Event._group_events(rows)
+        for item in items:
+            yield item
+
+    @staticmethod
+    def _select_rows(db, applicationId, start, end, eventTypeId, entityIds,
+                     limit, cursor, entityMatch, fields=None):
+        """Generate result rows as tuples, in _FIELD_COLUMNS order.
+
+        With a partitioned database, only the partitions overlapping
+        the queried range are read, one after the other. They hold
+        disjoint time ranges, so the rows stay in order.
         """
-        # get the events
+        partitioning = getattr(db, 'partitioning', None)
+        if partitioning is None:
+            return Event._select_table_rows(db, 'event', 'event_entity',
+                                            applicationId, start, end,
+                                            eventTypeId, entityIds, limit,
+                                            cursor, entityMatch, fields)
+        # check the arguments before any partition is read
+        Event._sql_where_clause(applicationId, start, end, eventTypeId,
+                                entityIds, cursor, entityMatch)
+        if limit is not None and int(limit) < 1:
+            raise ValueError("limit must be a positive integer")
+        first = start
+        if cursor is not None:
+            first = max(start, Event._decode_cursor(cursor)[0] - 1)
+        names = partitioning.overlapping(db, first, end)
+        return Event._select_partition_rows(db, partitioning, names,
+                                            applicationId, start, end,
+                                            eventTypeId, entityIds, limit,
+                                            cursor, entityMatch, fields)
+
+    @staticmethod
+    def _select_partition_rows(db, partitioning, names, applicationId, start,
+                               end, eventTypeId, entityIds, limit, cursor,
+                               entityMatch, fields=None):
+        remaining = limit
+        for name in names:
+            eventTable, entityTable = partitioning.tables(name)
+            count = 0
+            lastId = None
+            for row in Event._select_table_rows(db, eventTable, entityTable,
+                                                applicationId, start, end,
+                                                eventTypeId, entityIds,
+                                                remaining, cursor,
+                                                entityMatch, fields):
+                if row[0] != lastId:
+                    count += 1
+                    lastId = row[0]
+                yield row
+            if remaining is not None:
+                remaining -= count
+                if remaining <= 0:
+                    return
+
+    @staticmethod
+    def _select_table_rows(db, eventTable, entityTable, applicationId, start,
+                           end, eventTypeId, entityIds, limit, cursor,
+                           entityMatch, fields=None):
+        """Generate result rows from one pair of event tables."""
         whereClause = Event._sql_where_clause(applicationId, start, end,
-                                              eventTypeId, entityIds)
-        sqlIter = db.select(['event'], where=whereClause)
-        eventResults = [res for res in sqlIter]
-
-        # get events and entities
-        whereClause2 = whereClause + ' AND event.id = event_entity.event_id'
-        sqlIter = db.select(['event', 'event_entity'], where=whereClause2)
-        entityResults = [res for res in sqlIter]
-
-        # map event Ids to list of Entity objects
-        entitiesForEvent = {}
-        for entityResult in entityResults:
-            evtId = entityResult['event_id']
-            if evtId not in entitiesForEvent:
-                entitiesForEvent[evtId] = []
-            ent = Entity(entityResult['entity_type'],
-                         entityResult['entity_id'])
-            entitiesForEvent[evtId].append(ent)
-
-        # build Event objects
-        eventList = []
-        for evtResult in eventResults:
-            relatedEntities = entitiesForEvent.get(evtResult['id'], None)
-            evt = Event(applicationId=evtResult['application_id'],
-                        eventTime=evtResult['event_time'],
-                        eventTypeId=evtResult['event_type_id'],
-                        headline=evtResult['headline'],
-                        body=evtResult['body'],
-                        eventId=evtResult['id'],
-                        relatedEntities=relatedEntities)
-            eventList.append(evt)
-
-        return eventList
-
-    @staticmethod
-    def _check_key(d, k):
-        """Helper function to verify required JSON keys.
-
-        Raise a ValueError if key k not found in dict d.
-        Otherwise return d[k].
+                                              eventTypeId, entityIds,
+                                              cursor, entityMatch,
+                                              entityTable)
+        order = 'event.event_time, event.id'
+        join = fields is None or 'relatedEntities' in fields
+        if limit is not None and int(limit) < 1:
+            raise ValueError("limit must be a positive integer")
+        if limit is None or not join:
+            events = eventTable + ' AS event'
+        else:
+            # limit events, not joined rows, in a derived table
+            events = ('(SELECT %s FROM %s AS event WHERE %s ' +
+                      'ORDER BY %s LIMIT %d) AS event') % (
+                          Event._event_columns(fields), eventTable,
+                          whereClause, order, int(limit))
+            whereClause = None
+        sql = 'SELECT ' + Event._select_columns(fields) + ' FROM ' + events
+        if join:
+            sql += (' LEFT JOIN ' + entityTable + ' AS event_entity' +
+                    ' ON event_entity.event_id = event.id')
+        if whereClause is not None:
+            sql += ' WHERE ' + whereClause
+        sql += ' ORDER BY ' + order
+        if join:
+            sql += ', event_entity.id'
+        elif limit is not None:
+            sql += ' LIMIT %d' % int(limit)
+        return Event._execute_rows(db, sql)
+
+    # events read per query by _select_id_rows
+    _ID_CHUNK = 500
+
+    @staticmethod
+    def _select_id_rows(db, index, matches, limit, fields=None):
+        """Generate result rows of the (eventTime, eventId) matches
+        of an EntityIndex lookup, reading the events by id.
+
+        Events missing from the database, e.g. deleted by another
+        process, are skipped and discarded from the index, so that
+        a limit still counts events that exist.
         """
+        partitioning = getattr(db, 'partitioning', None)
+        join = fields is None or 'relatedEntities' in fields
+        remaining = limit
+        pos = 0
+        while pos < len(matches) and (remaining is None or remaining > 0):
+            size = Event._ID_CHUNK
+            if remaining is not None:
+                size = min(size, remaining)
+            chunk = matches[pos:pos + size]
+            pos += size
+            if partitioning is None:
+                tables = [('event', 'event_entity', chunk)]
+            else:
+                # matches are in time order, and so are partitions
+                existing = set(partitioning.overlapping(
+                    db, chunk[0][0] - 1, chunk[-1][0] + 1))
+                tables = []
+                for match in chunk:
+                    name = partitioning.name_for(match[0])
+                    if name not in existing:
+                        continue
+                    if not tables or tables[-1][0] != name:
+                        tables.append((name, []))
+                    tables[-1][1].append(match)
+                tables = [partitioning.tables(name) + (part,)
+                          for name, part in tables]
+            found = set()
+            for eventTable, entityTable, part in tables:
+                sql = ('SELECT ' + Event._select_columns(fields) +
+                       ' FROM ' + eventTable + ' AS event')
+                if join:
+                    sql += (' LEFT JOIN ' + entityTable + ' AS event_entity' +
+                            ' ON event_entity.event_id = event.id')
+                sql += (' WHERE event.id IN (%s)' %
+                        ', '.join('%d' % eventId for t, eventId in part))
+                sql += ' ORDER BY event.event_time, event.id'
+                if join:
+                    sql += ', event_entity.id'
+                for row in Event._execute_rows(db, sql):
+                    found.add(row[0])
+                    yield row
+            if len(found) < len(chunk):
+                index.discard([eventId for t, eventId in chunk
+                               if eventId not in found])
+            if remaining is not None:
+                remaining -= len(found)
+
+    @staticmethod
+    def _execute_rows(db, sql):
+        """Run sql and generate its rows as tuples"""
+        # Plain cursor rows rather than db.query's per-row storage dicts
+        conn = db.ctx.db
+        dbCursor = conn.cursor()
+        m = metrics.current
+        if m is None:
+            db._db_execute(dbCursor, web.SQLQuery(sql))
+        else:
+            t0 = time.time()
+            db._db_execute(dbCursor, web.SQLQuery(sql))
+            m.query(sql, time.time() - t0)
+        if not db.ctx.transactions:
+            db.ctx.commit()
+        return Event._fetch_rows(conn, dbCursor, m)
+
+    @staticmethod
+    def _fetch_rows(conn, dbCursor, m=None):
+        # Holding conn until every row is read keeps a pooled connection
+        # from going back to the pool while its cursor is still in use.
+        if m is None:
+            for row in iter(dbCursor.fetchone, None):
+                yield row
+            return
+        count = 0
         try:
-            return d[k]
-        except KeyError as e:
-            raise ValueError("Can't find required attribute '%s'" % e.message)
+            for row in iter(dbCursor.fetchone, None):
+                count += 1
+                yield row
+        finally:
+            m.increment('gupta_rows_total', count)
+
+    @staticmethod
+    def _group_events(rows):
+        evt = None
+        for row in rows:
+            if evt is None or evt.eventId != row[0]:
+                if evt is not None:
+                    yield evt
+                evt = Event(row[1], row[3], row[4], row[5],
+                            eventId=row[0], eventTime=row[2])
+            if row[6] is not None:
+                evt.relatedEntities.append(Entity(row[6], row[7]))
+        if evt is not None:
+            yield evt
+
+    @staticmethod
+    def _group_dicts(rows, fields=None):
+        if fields is not None:
+            drop = [name for name, column in Event._FIELD_COLUMNS
+                    if name not in fields]
+            for evt in Event._group_dicts(rows):
+                for name in drop:
+                    del evt[name]
+                yield evt
+            return
+        typeNames = {}
+        evt = None
+        for row in rows:
+            if evt is None or evt['eventId'] != row[0]:
+                if evt is not None:
+                    yield evt
+                evt = {'eventId' : row[0],
+                       'applicationId' : row[1],
+                       'eventTime' : row[2],
+                       'eventTypeId' : row[3],
+                       'headline' : row[4],
+                       'body' : row[5]}
+                entities = None
+            if row[6] is not None:
+                if entities is None:
+                    entities = evt['relatedEntities'] = {}
+                entityType = typeNames.get(row[6])
+                if entityType is None:
+                    entityType = typeNames[row[6]] = str(row[6])
+                ids = entities.get(entityType)
+                if ids is None:
+                    ids = entities[entityType] = []
+                ids.append(row[7])
+        if evt is not None:
+            yield evt
+
+    @staticmethod
+    def stream_from_db(db, applicationId, start, end=None, eventTypeId=None,
+                       entityIds=None, limit=None, cursor=None,
+                       entityMatch='any', recent=None, as_dicts=False,
+                       chunk_size=1000, fields=None):
+        """Generate matching Event objects, chunk_size events per query.
+
+        Takes the same parameters as iter_from_db. Unlike
+        iter_from_db, which runs one query for the whole result, this
+        walks the result with keyset pages, so memory stays bounded
+        even with drivers that buffer a whole result set on the client
+        (such as MySQLdb's default cursor).
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size
+            if remaining is not None:
+                size = min(size, remaining)
+            count = 0
+            for evt in Event.iter_from_db(db, applicationId, start, end,
+                                          eventTypeId, entityIds,
+                                          size, cursor, entityMatch,
+                                          recent, as_dicts, fields):
+                count += 1
+                yield evt
+            if count < size:
+                return
+            if remaining is not None:
+                remaining -= count
+            cursor = Event._cursor_of(evt)
+
+    # (attribute, accepted types, description, required, maximum
+    # length) of an event dict, checked in one pass by from_dict. Exact
+    # types, so that True isn't taken for an ID; the lengths are those
+    # of the database columns.
+    _INTEGER = (int, long)
+    _TEXT = (unicode, str)
+    _SCHEMA = (
+        ('applicationId', _INTEGER, 'an integer', True, None),
+        ('eventTypeId', _INTEGER, 'an integer', True, None),
+        ('headline', _TEXT, 'a string', True, 200),
+        ('body', _TEXT + (type(None),), 'a string or null', True, 4192),
+        ('eventTime', _INTEGER + (type(None),), 'an integer or null', False,
+         None),
+        ('idempotencyKey', _TEXT + (type(None),), 'a string or null', False,
+         None),
+    )
+    # event_key.idempotency_key holds bytes: keys are limited in UTF-8
+    _MAX_KEY_BYTES = 128
 
     @staticmethod
     def from_json(event_json):
         """Return a new Event object from a string containing JSON.
 
-        Raise ValueError in case of missing keys in JSON object.
+        Raise ValueError in case of invalid JSON or an invalid event;
+        see from_dict.
         """
-        event_data = json.loads(event_json)
-        return Event.from_dict(event_data)
+        m = metrics.current
+        if m is None:
+            return Event.from_dict(codec.loads(event_json))
+        t0 = time.time()
+        evt = Event.from_dict(codec.loads(event_json))
+        m.observe('gupta_stage_seconds', time.time() - t0, stage='from_json')
+        m.observe('gupta_payload_bytes', len(event_json), stage='from_json')
+        return evt
 
     @staticmethod
     def from_dict(event_data):
         """Return a new Event object created from a dict.
 
-        Raise ValueError in case of missing keys in dict.
+        The dict is validated in a single pass before anything else is
+        done with it, so an invalid event never reaches the database.
+        Raise ValueError if a required attribute is missing, if an
+        attribute has the wrong type or if a headline or body is longer
+        than its column. relatedEntities must map entity types (digit
+        strings) to lists of integer entity IDs.
         """
-        applicationId = Event._check_key(event_data, 'applicationId')
-        eventTypeId = Event._check_key(event_data, 'eventTypeId')
-        headline = Event._check_key(event_data, 'headline')
-        body = Event._check_key(event_data, 'body')
-        eventTime = event_data.get('eventTime', None)
-        entities = event_data.get('relatedEntities', {})
+        if type(event_data) is not dict:
+            raise ValueError("An event must be a JSON object")
+        values = []
+        for key, types, description, required, maxLength in Event._SCHEMA:
+            try:
+                value = event_data[key]
+            except KeyError:
+                if required:
+                    raise ValueError("Can't find required attribute '%s'" %
+                                     key)
+                value = None
+            else:
+                if type(value) not in types:
+                    raise ValueError("Attribute '%s' must be %s" %
+                                     (key, description))
+                if (maxLength is not None and value is not None and
+                    len(value) > maxLength):
+                    raise ValueError("Attribute '%s' is longer than %d "
+                                     "characters" % (key, maxLength))
+            values.append(value)
+        key = values[-1]
+        if key is not None:
+            if type(key) is unicode:
+                key = key.encode('utf-8')
+            if len(key) > Event._MAX_KEY_BYTES:
+                raise ValueError("Attribute 'idempotencyKey' is longer "
+                                 "than %d bytes in UTF-8" %
+                                 Event._MAX_KEY_BYTES)
+        entities = event_data.get('relatedEntities')
         relatedEntities = []
-        for entityType in entities:
-            for entityId in entities[entityType]:
-                ent = Entity(entityType, entityId)
-                relatedEntities.append(ent)
+        if entities is not None:
+            if type(entities) is not dict:
+                raise ValueError("Attribute 'relatedEntities' must map "
+                                 "entity types to lists of entity IDs")
+            for entityType, entityIds in entities.iteritems():
+                if not (type(entityType) in Event._INTEGER or
+                        (type(entityType) in Event._TEXT and
+                         entityType.isdigit())):
+                    raise ValueError("Invalid entity type '%s'" % entityType)
+                if type(entityIds) is not list:
+                    raise ValueError("Entity IDs of type '%s' must be a list"
+                                     % entityType)
+                for entityId in entityIds:
+                    if type(entityId) not in Event._INTEGER:
+                        raise ValueError("Entity IDs of type '%s' must be "
+                                         "integers" % entityType)
+                    relatedEntities.append(Entity(entityType, entityId))
+        applicationId, eventTypeId, headline, body, eventTime, key = values
         evt = Event(applicationId, eventTypeId, headline, body,
                     eventTime=eventTime,
-                    relatedEntities=relatedEntities)
+                    relatedEntities=relatedEntities,
+                    idempotencyKey=key)
         return evt
 
-class Entity:
+class Entity(object):
     """A representation of an event entity.
 
     Simple objects that only have entityType and entityId attributes.
     """
+    __slots__ = ('entityType', 'entityId')
+
     def __init__(self, entityType, entityId):
         self.entityType = entityType
         self.entityId = entityId
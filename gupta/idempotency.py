@@ -0,0 +1,105 @@
+"""Recently saved idempotency keys for Gupta Event API
+
+An event may carry an idempotencyKey, unique per application: saving
+an event whose key is already saved doesn't store it again but
+returns the eventId of the original (see Event.save_many). The keys
+are kept in the event_key table.
+
+Producers retry soon after a timeout, so the keys saved last are the
+ones looked up most. A KeyCache remembers them, letting a retried
+event be answered without a database round trip. Only committed keys
+are cached, and a saved key never changes its eventId. Its row can
+only go away with its event, when retention purges it, possibly in
+another process; so with a Retention the cache forgets every key once
+its event is old enough to be purged. Dropping old partitions (see
+Partitioning.drop_before) deletes keys too, and makes the cache of
+the database forget the keys of events before the cutoff. The cache
+then can't give a wrong answer, only miss.
+
+The cache is a property of a database: EventConfig sets it on the
+web.py database object as `db.key_cache' (see key_cache_size in the
+[database] section).
+
+Classes:
+  - KeyCache: bounded LRU map of idempotency keys to eventIds
+"""
+
+import collections
+import threading
+
+from gupta.util import millis
+
+class KeyCache(object):
+    """Bounded, thread-safe LRU map of (applicationId, key) to eventId.
+
+    With a Retention, a key is only kept until the policy of its event
+    lets it be purged.
+
+    Example usage:
+      db.key_cache = KeyCache(max_keys=10000, retention=retention)
+    """
+
+    def __init__(self, max_keys=10000, retention=None):
+        self.max_keys = max_keys
+        self.retention = retention
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, applicationId, key):
+        """Return the eventId saved with key, or None if not cached"""
+        k = (int(applicationId), key)
+        with self._lock:
+            entry = self._keys.pop(k, None)
+            if entry is not None and entry[2] is not None and \
+                    millis() >= entry[2]:
+                # its event may be purged by now
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            # most recently used last
+            self._keys[k] = entry
+            self._hits += 1
+            return entry[0]
+
+    def put(self, applicationId, key, eventId, eventTypeId=None,
+            eventTime=None):
+        """Remember that key was saved as eventId.
+
+        With a retention, the eventTypeId and eventTime of the event
+        are needed to know when it may be purged; without them the key
+        isn't cached.
+        """
+        k = (int(applicationId), key)
+        expires = None
+        if self.retention is not None:
+            if eventTypeId is None or eventTime is None:
+                return
+            maxAge = self.retention.max_age(applicationId, eventTypeId)
+            if maxAge is not None:
+                expires = int(eventTime) + maxAge
+        with self._lock:
+            self._keys.pop(k, None)
+            self._keys[k] = (eventId, eventTime, expires)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+
+    def forget_before(self, cutoff):
+        """Forget the keys of events older than cutoff, and of events
+        of unknown time, once their keys are deleted"""
+        with self._lock:
+            for k, entry in self._keys.items():
+                if entry[1] is None or entry[1] < cutoff:
+                    del self._keys[k]
+
+    def stats(self):
+        """Return counters: keys, hits and misses"""
+        with self._lock:
+            return {'keys' : len(self._keys),
+                    'hits' : self._hits,
+                    'misses' : self._misses}
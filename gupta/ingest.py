@@ -0,0 +1,151 @@
+"""Write-behind ingest queue for Gupta Event API
+
+Instead of committing one transaction per event, CreateEvent can hand
+parsed Events to an IngestQueue. A background flusher thread coalesces
+queued events and saves them with Event.save_batch, one transaction
+every `batch_size' events or `flush_interval_ms' milliseconds,
+whichever comes first.
+
+Classes:
+  - IngestQueue: bounded queue plus background flusher
+  - PendingEvent: handle for an enqueued event, resolves to its eventId
+  - IngestError: raised when the queue is full or stopped, or when
+    waiting for a commit times out
+"""
+
+import threading
+import time
+import Queue
+
+from gupta.event import Event
+
+class IngestError(Exception):
+    pass
+
+class PendingEvent:
+    """Handle for an event waiting in an IngestQueue.
+
+    Call wait() to block until the event's transaction has committed.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        """Return True once the event was saved or failed to save."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Return the eventId once the event is durably committed.
+
+        timeout is in seconds (default: wait forever). Raise
+        IngestError on timeout, or the save error if saving failed.
+        """
+        if not self._done.wait(timeout):
+            raise IngestError("Timed out waiting for event to commit")
+        if self.error is not None:
+            raise self.error
+        return self.event.eventId
+
+    def _resolve(self, error=None):
+        self.error = error
+        self._done.set()
+
+class IngestQueue:
+    """Bounded in-process queue with a group-commit flusher thread.
+
+    Memory is bounded by `max_queue' events. When the queue is full,
+    submit() blocks for up to `enqueue_timeout_ms' milliseconds and
+    then raises IngestError, which pushes back on producers.
+
+    Example usage:
+      queue = IngestQueue(db, batch_size=500, flush_interval_ms=50)
+      queue.start()
+      eventId = queue.submit(evt).wait()
+    """
+
+    def __init__(self, db, batch_size=500, flush_interval_ms=50,
+                 max_queue=10000, enqueue_timeout_ms=1000):
+        self._db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.enqueue_timeout = enqueue_timeout_ms / 1000.0
+        self._queue = Queue.Queue(max_queue)
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        """Start the background flusher thread."""
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='gupta-ingest-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Flush everything already queued and stop the flusher."""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, event):
+        """Queue an unsaved Event and return its PendingEvent.
+
+        Raise IngestError if the queue is stopped or stays full for
+        longer than the enqueue timeout.
+        """
+        if self._thread is None or self._stopping:
+            raise IngestError("Ingest queue is not running")
+        pending = PendingEvent(event)
+        try:
+            self._queue.put(pending, True, self.enqueue_timeout)
+        except Queue.Full:
+            raise IngestError("Ingest queue is full, try again later")
+        return pending
+
+    def qsize(self):
+        """Return the approximate number of queued events."""
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        """Block for the first event, then gather a batch until the
+        batch is full or the flush interval has passed."""
+        try:
+            first = self._queue.get(True, self.flush_interval)
+        except Queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(True, remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        events = [pending.event for pending in batch]
+        try:
+            errors = Event.save_batch(self._db, events)
+        except Exception as e:
+            errors = [e] * len(batch)
+        for pending, err in zip(batch, errors):
+            pending._resolve(err)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            elif self._stopping:
+                return
@@ -0,0 +1,145 @@
+"""Latency and SQL instrumentation for Gupta Event API
+
+When a Metrics object is installed, the Event model and the server
+handlers record per-stage latency histograms, row and event counts
+and payload sizes in it, and /metrics exposes them in the Prometheus
+text format. Queries slower than a threshold are logged with their
+SQL to the `gupta.slowquery' logger.
+
+Instrumented code reads the module global `current' and skips all
+timing when it is None, so the cost with metrics disabled is one
+attribute lookup per call.
+
+Classes:
+  - Metrics: thread-safe registry of histograms and counters
+
+Functions:
+  - install: make a Metrics object current
+  - uninstall: disable instrumentation
+"""
+
+import bisect
+import logging
+import threading
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_HELP = {
+    'gupta_stage_seconds' : 'Latency of a processing stage',
+    'gupta_request_seconds' : 'Latency of an HTTP handler',
+    'gupta_request_bytes' : 'Size of a request body',
+    'gupta_payload_bytes' : 'Size of a parsed JSON event',
+    'gupta_response_bytes' : 'Size of a response body',
+    'gupta_rows_total' : 'Rows read from the database',
+    'gupta_events_total' : 'Events saved or loaded',
+    'gupta_slow_queries_total' : 'Queries slower than the threshold',
+}
+
+_slow_log = logging.getLogger('gupta.slowquery')
+
+# the installed Metrics object, or None when disabled
+current = None
+
+def install(metrics):
+    """Record instrumentation in metrics from now on"""
+    global current
+    current = metrics
+
+def uninstall():
+    """Stop recording instrumentation"""
+    global current
+    current = None
+
+class Metrics(object):
+    """Thread-safe registry of histograms and counters.
+
+    Metric names ending in `_seconds' are latency histograms and
+    names ending in `_bytes' are size histograms; names ending in
+    `_total' are counters. Every metric can have labels.
+
+    Example usage:
+      metrics = Metrics(slow_query_ms=500)
+      gupta.metrics.install(metrics)
+      ...
+      text = metrics.render()
+    """
+
+    def __init__(self, slow_query_ms=None):
+        self.slow_query = None
+        if slow_query_ms is not None:
+            self.slow_query = slow_query_ms / 1000.0
+        self._lock = threading.Lock()
+        # (name, sorted label items) -> per-bucket counts plus sum
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, value, **labels):
+        """Add value to the histogram name with labels"""
+        buckets = _buckets(name)
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(buckets, value)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                # one count per bucket, then +Inf, then the sum
+                h = self._histograms[key] = [0] * (len(buckets) + 2)
+            h[i] += 1
+            h[-1] += value
+
+    def increment(self, name, amount=1, **labels):
+        """Add amount to the counter name with labels"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def query(self, sql, seconds):
+        """Record a query's latency, logging it if it was slow"""
+        self.observe('gupta_stage_seconds', seconds, stage='sql')
+        if self.slow_query is not None and seconds >= self.slow_query:
+            self.increment('gupta_slow_queries_total')
+            _slow_log.warning("Slow query (%.1f ms): %s",
+                              seconds * 1000, sql)
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+        with self._lock:
+            histograms = [(k, list(v)) for k, v in self._histograms.items()]
+            counters = self._counters.items()
+        lines = []
+        described = set()
+        for (name, labels), count in sorted(counters):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, _HELP.get(name, name)))
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _labels(labels), count))
+        for (name, labels), h in sorted(histograms):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, _HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+            buckets = _buckets(name)
+            cumulative = 0
+            for le, n in zip(buckets + ('+Inf',), h[:-1]):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(labels + (('le', str(le)),)), cumulative))
+            lines.append('%s_sum%s %r' % (name, _labels(labels), h[-1]))
+            lines.append('%s_count%s %d' % (name, _labels(labels),
+                                            cumulative))
+        return '\n'.join(lines) + '\n'
+
+def _buckets(name):
+    if name.endswith('_seconds'):
+        return LATENCY_BUCKETS
+    return SIZE_BUCKETS
+
+def _labels(items):
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+                             for k, v in items)
@@ -0,0 +1,234 @@
+"""Time partitioning of event tables for Gupta Event API
+
+With partitioning, events are stored in one pair of tables per day or
+month of eventTime (for example event_p20130621 and
+event_entity_p20130621) instead of the single event and event_entity
+tables. Each pair is created on the first write into its period. A
+query only reads the partitions that overlap its [start, end) range,
+and old data is removed by dropping whole partitions.
+
+Partitions are listed in the event_partition table. Event ids stay
+unique across partitions because they are drawn from the shared
+event_id_seq table.
+
+Partitioning is a property of a database: EventConfig sets it on the
+web.py database object as `db.partitioning' when the [database]
+section has `partition_by = day' or `partition_by = month'.
+
+Classes:
+  - Partitioning: naming, creation, lookup and dropping of partitions
+"""
+
+import calendar
+import threading
+from datetime import datetime
+
+from gupta.event import Event
+from gupta.util import transaction
+
+_SQLITE_TABLES = [
+    '''create table if not exists %(event)s (
+        id integer primary key,
+        application_id integer not null,
+        event_time integer not null,
+        event_type_id integer not null,
+        headline varchar(200) not null,
+        body varchar(4192)
+    )''',
+    '''create index if not exists %(event)s_idx_app_time
+        on %(event)s(application_id, event_time)''',
+    '''create index if not exists %(event)s_idx_type_time
+        on %(event)s(application_id, event_type_id, event_time)''',
+    '''create table if not exists %(entity)s (
+        id integer primary key autoincrement,
+        event_id integer unsigned not null,
+        entity_type integer not null,
+        entity_id integer not null,
+        unique (event_id, entity_type, entity_id)
+    )''',
+    '''create index if not exists %(entity)s_idx_entity
+        on %(entity)s(entity_type, entity_id, event_id)''',
+]
+
+_MYSQL_TABLES = [
+    '''create table if not exists %(event)s (
+        id BIGINT UNSIGNED NOT NULL,
+        application_id INT NOT NULL,
+        event_time BIGINT NOT NULL,
+        event_type_id INT NOT NULL,
+        headline varchar(200) NOT NULL,
+        body varchar(4192),
+        index idx_app_time(application_id, event_time),
+        index idx_type_time(application_id, event_type_id, event_time),
+        primary key (id)
+    ) Engine=InnoDB''',
+    '''create table if not exists %(entity)s (
+        id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+        event_id BIGINT UNSIGNED NOT NULL,
+        entity_type INT NOT NULL,
+        entity_id BIGINT NOT NULL,
+        UNIQUE idx_ee(event_id, entity_type, entity_id),
+        INDEX idx_entity(entity_type, entity_id, event_id),
+        primary key (id)
+    ) Engine=InnoDB''',
+]
+
+_SQLITE_META = [
+    '''create table if not exists event_partition (
+        name varchar(32) primary key,
+        start_time integer not null,
+        end_time integer not null
+    )''',
+    '''create table if not exists event_id_seq (
+        id integer primary key autoincrement,
+        stub integer
+    )''',
+]
+
+_MYSQL_META = [
+    '''create table if not exists event_partition (
+        name varchar(32) NOT NULL,
+        start_time BIGINT NOT NULL,
+        end_time BIGINT NOT NULL,
+        primary key (name)
+    ) Engine=InnoDB''',
+    '''create table if not exists event_id_seq (
+        id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+        stub TINYINT,
+        primary key (id)
+    ) Engine=InnoDB''',
+]
+
+class Partitioning:
+    """Day or month partitions of the event tables.
+
+    Example usage:
+      db.partitioning = Partitioning('day')
+      Event.save_many(db, events)   # creates partitions as needed
+      Event.load_from_db(db, 1, start, end)   # reads overlapping ones
+      db.partitioning.drop_before(db, cutoff)
+    """
+
+    def __init__(self, period='day'):
+        if period not in ('day', 'month'):
+            raise ValueError("partition period must be 'day' or 'month'")
+        self.period = period
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def name_for(self, eventTime):
+        """Return the name of the partition holding eventTime."""
+        dt = datetime.utcfromtimestamp(eventTime // 1000)
+        if self.period == 'day':
+            return 'p' + dt.strftime('%Y%m%d')
+        return 'p' + dt.strftime('%Y%m')
+
+    def bounds(self, name):
+        """Return the [start, end) eventTime range of a partition."""
+        if self.period == 'day':
+            first = datetime.strptime(name[1:], '%Y%m%d')
+            start = calendar.timegm(first.timetuple())
+            end = start + 24 * 60 * 60
+        else:
+            first = datetime.strptime(name[1:], '%Y%m')
+            start = calendar.timegm(first.timetuple())
+            days = calendar.monthrange(first.year, first.month)[1]
+            end = start + days * 24 * 60 * 60
+        return start * 1000, end * 1000
+
+    @staticmethod
+    def tables(name):
+        """Return the (event table, entity table) names of a partition."""
+        return 'event_' + name, 'event_entity_' + name
+
+    def ensure(self, db, name):
+        """Create a partition's tables unless they already exist.
+
+        Runs DDL, so call it outside of any transaction.
+        """
+        if name in self._known:
+            return
+        with self._lock:
+            if name in self._known:
+                return
+            mysql = getattr(db, 'dbname', None) == 'mysql'
+            for stmt in (_MYSQL_META if mysql else _SQLITE_META):
+                db.query(stmt)
+            eventTable, entityTable = self.tables(name)
+            for stmt in (_MYSQL_TABLES if mysql else _SQLITE_TABLES):
+                db.query(stmt % {'event' : eventTable,
+                                 'entity' : entityTable})
+            start, end = self.bounds(name)
+            ignore = 'IGNORE' if mysql else 'OR IGNORE'
+            db.query(('INSERT %s INTO event_partition ' +
+                      '(name, start_time, end_time) VALUES ($n, $s, $e)') %
+                     ignore, vars={'n' : name, 's' : start, 'e' : end})
+            self._known.add(name)
+
+    def overlapping(self, db, start, end=None):
+        """Return names of partitions with events in (start, end).
+
+        The names are in time order. Like queries, start is exclusive
+        and end is exclusive.
+        """
+        if not self._has_registry(db):
+            return []
+        where = 'end_time > %d' % (int(start) + 1)
+        if end is not None:
+            where += ' AND start_time < %d' % int(end)
+        rows = db.select('event_partition', what='name', where=where,
+                         order='start_time')
+        return [row.name for row in rows]
+
+    def drop_before(self, db, cutoff):
+        """Drop every partition whose events are all older than cutoff.
+
+        The idempotency keys of their events are deleted with them, and
+        forgotten by the database's KeyCache. Return the names of the
+        dropped partitions.
+        """
+        if not self._has_registry(db):
+            return []
+        rows = db.select('event_partition', what='name',
+                         where='end_time <= %d' % int(cutoff),
+                         order='start_time')
+        names = [row.name for row in rows]
+        for name in names:
+            eventTable, entityTable = self.tables(name)
+            # keys first: they can't be found once their events are gone
+            # (MySQL commits at the DROP regardless)
+            with transaction(db):
+                db.query('DELETE FROM event_key WHERE event_id IN ' +
+                         '(SELECT id FROM %s)' % eventTable)
+                db.query('DROP TABLE IF EXISTS %s' % entityTable)
+                db.query('DROP TABLE IF EXISTS %s' % eventTable)
+                db.delete('event_partition', where='name = $n',
+                          vars={'n' : name})
+            with self._lock:
+                self._known.discard(name)
+        cache = getattr(db, 'key_cache', None)
+        if cache is not None and names:
+            cache.forget_before(cutoff)
+        return names
+
+    @staticmethod
+    def allocate_ids(db, count):
+        """Return count new event ids from event_id_seq.
+
+        Must be called inside a transaction, after ensure().
+        """
+        ids = Event._insert_rows(db, 'event_id_seq',
+                                 [{'stub' : 0}] * count)
+        # only the highest id has to stay to keep the sequence going
+        db.query('DELETE FROM event_id_seq WHERE id < %d' % ids[-1])
+        return ids
+
+    def _has_registry(self, db):
+        if self._known:
+            return True
+        if getattr(db, 'dbname', None) == 'mysql':
+            sql = "SHOW TABLES LIKE 'event_partition'"
+        else:
+            sql = ("SELECT name FROM sqlite_master WHERE type = 'table' " +
+                   "AND name = 'event_partition'")
+        return len(list(db.query(sql))) > 0
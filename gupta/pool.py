@@ -0,0 +1,167 @@
+"""Database connection pooling and SQLite tuning for Gupta Event API
+
+web.py keeps one connection per thread and drops it at the start of
+every request, so by default each request opens a new connection.
+install_pool makes a web.py database check connections out of a
+ConnectionPool instead. A connection goes back to the pool when web.py
+lets go of it.
+
+tune_sqlite makes every new SQLite connection use write-ahead logging,
+so readers never block the writer, along with synchronous=NORMAL,
+memory-mapped I/O and a larger page cache.
+
+Classes:
+  - ConnectionPool: bounded pool of DB-API connections
+  - PoolTimeout: raised when no connection frees up in time
+
+Functions:
+  - install_pool: pool the connections of a web.py database object
+  - tune_sqlite: run tuning PRAGMAs on each new SQLite connection
+"""
+
+import threading
+import time
+
+class PoolTimeout(Exception):
+    pass
+
+class _PooledConnection(object):
+    """Proxy for a checked-out connection.
+
+    Closing it, or dropping the last reference to it, returns the
+    underlying connection to its pool.
+    """
+
+    def __init__(self, pool, conn, created):
+        self._pool = pool
+        self._conn = conn
+        self._created = created
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool._release(conn, self._created)
+
+    def __del__(self):
+        self.close()
+
+class ConnectionPool:
+    """Bounded pool of DB-API connections.
+
+    Up to `size' idle connections are kept for reuse. Up to
+    `max_overflow' more can be open while the pool is busy; they are
+    closed when they come back. When `size + max_overflow' connections
+    are checked out, connection() waits up to `timeout' seconds and
+    then raises PoolTimeout. Connections older than `recycle' seconds
+    are closed instead of reused (0 disables recycling).
+    """
+
+    def __init__(self, connect, size=5, max_overflow=10, timeout=30,
+                 recycle=3600):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self._idle = [] # (connection, created) pairs
+        self._checked_out = 0
+        self._cond = threading.Condition()
+
+    def connection(self):
+        """Check out a connection; raise PoolTimeout if none frees up."""
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn, created = self._idle.pop()
+                    if self._expired(created):
+                        self._close(conn)
+                        continue
+                    self._checked_out += 1
+                    return _PooledConnection(self, conn, created)
+                if self._checked_out < self.size + self.max_overflow:
+                    self._checked_out += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("Timed out waiting for a database "
+                                      "connection")
+                self._cond.wait(remaining)
+        try:
+            return _PooledConnection(self, self._connect(), time.time())
+        except:
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+
+    def stats(self):
+        """Return a dict with the number of idle and checked-out connections."""
+        with self._cond:
+            return {'idle' : len(self._idle),
+                    'checkedOut' : self._checked_out}
+
+    def _release(self, conn, created):
+        try:
+            # don't hand a half-finished transaction to the next user
+            conn.rollback()
+        except Exception:
+            self._close(conn)
+            conn = None
+        with self._cond:
+            self._checked_out -= 1
+            if conn is not None:
+                if len(self._idle) < self.size and \
+                        not self._expired(created):
+                    self._idle.append((conn, created))
+                else:
+                    self._close(conn)
+            self._cond.notify()
+
+    def _expired(self, created):
+        return self.recycle > 0 and time.time() - created > self.recycle
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def install_pool(db, size=5, max_overflow=10, timeout=30, recycle=3600):
+    """Make web.py database object db check connections out of a pool.
+
+    Return the ConnectionPool.
+    """
+    if getattr(db, 'dbname', None) == 'sqlite':
+        # a pooled connection moves between threads, one at a time
+        db.keywords['check_same_thread'] = False
+    pool = ConnectionPool(lambda: db._connect(db.keywords), size,
+                          max_overflow, timeout, recycle)
+    db.pool = pool
+    db._connect_with_pooling = lambda keywords: pool.connection()
+    db.has_pooling = True
+    return pool
+
+def tune_sqlite(db, synchronous='NORMAL', mmap_size=268435456,
+                cache_size=-65536):
+    """Tune every new connection of a web.py SQLite database object.
+
+    Enables write-ahead logging (so readers never block the writer),
+    sets the synchronous level, the memory-mapped I/O size in bytes
+    and the page cache size (negative values are KiB, as in SQLite).
+    """
+    if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError("Unknown synchronous level '%s'" % synchronous)
+    connect = db._connect
+    def tuned_connect(keywords):
+        conn = connect(keywords)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=%s' % synchronous)
+        conn.execute('PRAGMA mmap_size=%d' % int(mmap_size))
+        conn.execute('PRAGMA cache_size=%d' % int(cache_size))
+        return conn
+    db._connect = tuned_connect
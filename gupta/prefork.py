@@ -0,0 +1,279 @@
+"""Pre-forking multi-process server for Gupta Event API
+
+A master process binds the listening socket and forks a number of
+worker processes that accept connections from it in turn. Each worker
+serves requests with the threaded WSGI server web.py itself uses, so
+throughput scales with the number of cores.
+
+The WSGI application is loaded in each worker after it is forked, so
+database connections and background threads are never shared between
+processes.
+
+Signals to the master:
+  - SIGTERM, SIGINT: graceful shutdown. Workers stop accepting, finish
+    the requests in flight (up to shutdown_timeout seconds) and exit.
+  - SIGHUP: graceful reload. A new set of workers is started, then
+    the old ones are shut down gracefully.
+
+A worker that dies unexpectedly is replaced.
+
+Work that must run once for the whole server, such as the retention
+purge, runs in one more child process (see `background' below),
+started, reloaded, replaced and shut down along with the workers.
+
+Classes:
+  - PreforkServer: the master process
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from web.wsgiserver import CherryPyWSGIServer
+
+_log = logging.getLogger(__name__)
+
+class _WorkerServer(CherryPyWSGIServer):
+    """CherryPy WSGI server accepting on an inherited listening socket"""
+
+    def __init__(self, listener, wsgi_app, master_pid, **kw):
+        CherryPyWSGIServer.__init__(self, listener.getsockname()[:2],
+                                    wsgi_app, **kw)
+        self._listener = listener
+        self._master_pid = master_pid
+        self.draining = False
+
+    def bind(self, family, type, proto=0):
+        self.socket = self._listener
+
+    def tick(self):
+        # a connection accepted just before draining is still served
+        if self.draining or os.getppid() != self._master_pid:
+            self.ready = False
+            return
+        CherryPyWSGIServer.tick(self)
+
+class PreforkServer(object):
+    """Master of a pool of pre-forked worker processes.
+
+    load_app is called in each worker after fork and returns the WSGI
+    application to serve. on_exit, if given, is called in a worker
+    after its last request, e.g. to flush queued writes. background,
+    if given, is called with a threading.Event in one extra child
+    process and should return soon after the event is set; it is
+    started again if it fails, but not if it returns normally.
+
+    Example usage:
+      server = PreforkServer(load_app, ('0.0.0.0', 8080), workers=4)
+      server.serve()
+    """
+
+    def __init__(self, load_app, address=('0.0.0.0', 8080), workers=2,
+                 threads=10, shutdown_timeout=30, on_exit=None,
+                 backlog=128, background=None):
+        self.load_app = load_app
+        self.address = address
+        self.workers = workers
+        self.threads = threads
+        self.shutdown_timeout = shutdown_timeout
+        self.on_exit = on_exit
+        self.backlog = backlog
+        self.background = background
+        self.socket = None
+        self._background_pid = None
+        self._pids = {}      # pid of current worker -> start time
+        self._retiring = {}  # pid of old worker -> time asked to stop
+        self._stopping = False
+        self._reloading = False
+        self._background_started = None
+        self._background_old = None  # retired on reload, not yet exited
+
+    def listen(self):
+        """Bind the listening socket (serve does this if needed)"""
+        if self.socket is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self.address)
+            sock.listen(self.backlog)
+            self.socket = sock
+            self.address = sock.getsockname()[:2]
+        return self.socket
+
+    def serve(self):
+        """Run the master until it is told to shut down"""
+        self.listen()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        _log.info("Listening on %s:%d with %d workers",
+                  self.address[0], self.address[1], self.workers)
+        for i in range(self.workers):
+            self._spawn()
+        self._spawn_background()
+        while not self._stopping:
+            if self._reloading:
+                self._reloading = False
+                self._reload()
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.1)
+        self._shutdown()
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self._reloading = True
+
+    def _spawn(self):
+        master_pid = os.getpid()
+        pid = os.fork()
+        if pid != 0:
+            self._pids[pid] = time.time()
+            return pid
+        # in the worker: never return into the master's code
+        status = 0
+        try:
+            self._run_worker(master_pid)
+        except BaseException:
+            _log.exception("Worker %d failed", os.getpid())
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _spawn_background(self):
+        if self.background is None:
+            return None
+        pid = os.fork()
+        if pid != 0:
+            self._background_pid = pid
+            self._background_started = time.time()
+            return pid
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            stopping = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame:
+                          stopping.set())
+            # the workers serve the listening socket
+            self.socket.close()
+            self.background(stopping)
+        except BaseException:
+            _log.exception("Background process %d failed", os.getpid())
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _run_worker(self, master_pid):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        servers = []
+        stopped = []
+        def drain(signum, frame):
+            stopped.append(signum)
+            for server in servers:
+                server.draining = True
+        signal.signal(signal.SIGTERM, drain)
+        server = _WorkerServer(self.socket, self.load_app(), master_pid,
+                               numthreads=self.threads,
+                               shutdown_timeout=self.shutdown_timeout)
+        servers.append(server)
+        server.draining = bool(stopped)
+        server.start()
+        # the listening socket is shared: only drop our own handle
+        server.socket = None
+        server.stop()
+        if self.on_exit is not None:
+            self.on_exit()
+
+    def _reload(self):
+        old = self._pids.keys()
+        _log.info("Reloading workers")
+        for i in range(self.workers):
+            self._spawn()
+        for pid in old:
+            del self._pids[pid]
+            self._retire(pid)
+        # only one may run at a time: the new one starts once the old
+        # one has exited (see _reap)
+        if self._background_pid is not None:
+            self._background_old = self._background_pid
+            self._background_pid = None
+            self._retire(self._background_old)
+
+    def _retire(self, pid):
+        self._retiring[pid] = time.time()
+        _kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    # no children left to wait for
+                    self._retiring.clear()
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self._retiring:
+                del self._retiring[pid]
+                if pid == self._background_old:
+                    self._background_old = None
+                    if not self._stopping:
+                        self._spawn_background()
+            elif pid == self._background_pid:
+                self._background_pid = None
+                if status != 0 and not self._stopping:
+                    _log.warning("Background process %d exited with "
+                                 "status %d, replacing it", pid, status)
+                    if time.time() - self._background_started < 1:
+                        time.sleep(1)
+                    self._spawn_background()
+            elif pid in self._pids:
+                started = self._pids.pop(pid)
+                if not self._stopping:
+                    _log.warning("Worker %d exited with status %d, "
+                                 "replacing it", pid, status)
+                    # don't spin if workers die on startup
+                    if time.time() - started < 1:
+                        time.sleep(1)
+                    self._spawn()
+
+    def _kill_overdue(self):
+        now = time.time()
+        for pid, asked in self._retiring.items():
+            if now - asked > self.shutdown_timeout + 5:
+                _kill(pid, signal.SIGKILL)
+
+    def _shutdown(self):
+        _log.info("Shutting down")
+        for pid in self._pids.keys():
+            del self._pids[pid]
+            self._retire(pid)
+        if self._background_pid is not None:
+            self._retire(self._background_pid)
+            self._background_pid = None
+        while self._retiring:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.1)
+        self.socket.close()
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
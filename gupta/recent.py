@@ -0,0 +1,199 @@
+"""In-memory store of recent events for Gupta Event API
+
+Most queries ask for the last few minutes of one application. A
+RecentEventStore keeps every event of the retention window in memory,
+so such queries don't have to touch the database.
+
+Each application has a ring of time buckets covering the window. Old
+buckets are dropped as the window moves forward, and the oldest
+buckets are evicted early when the store holds more than `max_events'
+events. The store only answers a query when it knows it holds every
+matching event; otherwise the caller goes to the database.
+
+The store only sees events saved through this process, so it must
+only be enabled when one process does all of the writing;
+bin/event_server refuses it with more than one worker.
+
+Classes:
+  - RecentEventStore: time-bucketed recent events per application
+"""
+
+import threading
+
+from gupta.event import Event, Entity
+from gupta.util import millis
+
+class _AppWindow:
+    """Recent events of one application.
+
+    `floor' is the time after which the window is complete: every
+    saved event with eventTime > floor is in `buckets'.
+    """
+
+    def __init__(self, floor):
+        self.floor = floor
+        self.buckets = {}
+        self.eventIds = set()
+
+class RecentEventStore:
+    """Time-bucketed ring buffer of recent events per application.
+
+    Example usage:
+      store = RecentEventStore(window_ms=300000, max_events=100000)
+      Event.add_save_listener(store.add)
+      events = Event.load_from_db(db, 1, start, recent=store)
+    """
+
+    def __init__(self, window_ms=300000, max_events=100000, buckets=60):
+        self.window = window_ms
+        self.max_events = max_events
+        self.bucket_ms = max(1, window_ms // buckets)
+        self._apps = {}
+        self._count = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, events):
+        """Add newly saved events to the windows that are loaded."""
+        with self._lock:
+            self._expire()
+            for evt in events:
+                window = self._apps.get(int(evt.applicationId))
+                if window is not None:
+                    self._insert(window, evt)
+            self._evict()
+
+    def query(self, db, applicationId, start, end=None, eventTypeId=None,
+              entityIds=None, limit=None, cursor=None, entityMatch='any'):
+        """Return matching events, or None if the window can't answer.
+
+        Takes the same parameters as Event.load_from_db and returns
+        the same events in the same order. The application's window
+        is loaded from db on its first query.
+        """
+        with self._lock:
+            self._expire()
+            window = self._apps.get(int(applicationId))
+            if window is None:
+                if start < millis() - self.window:
+                    return None
+                window = self._load(db, applicationId)
+            if start < window.floor:
+                return None
+            events = self._matches(window, start, end, eventTypeId,
+                                   entityIds, cursor, entityMatch)
+        events.sort(key=lambda evt: (evt.eventTime, evt.eventId))
+        if limit is not None:
+            events = events[:int(limit)]
+        return events
+
+    def _load(self, db, applicationId):
+        """Load an application's window from the database."""
+        floor = millis() - self.window
+        window = _AppWindow(floor)
+        self._apps[int(applicationId)] = window
+        # from the primary, not a lagging replica: the store's later
+        # events come from saves on the primary
+        for evt in Event.stream_from_db(getattr(db, 'primary', db),
+                                        applicationId, floor):
+            self._insert(window, evt)
+        self._evict()
+        return window
+
+    def _insert(self, window, evt):
+        if evt.eventTime <= window.floor or evt.eventId in window.eventIds:
+            return
+        # keep a copy with the same types the database returns
+        copy = Event(applicationId=int(evt.applicationId),
+                     eventTypeId=int(evt.eventTypeId),
+                     headline=evt.headline,
+                     body=evt.body,
+                     eventId=evt.eventId,
+                     eventTime=int(evt.eventTime),
+                     relatedEntities=[Entity(int(ent.entityType),
+                                             int(ent.entityId))
+                                      for ent in evt.relatedEntities])
+        key = copy.eventTime // self.bucket_ms
+        window.buckets.setdefault(key, []).append(copy)
+        window.eventIds.add(copy.eventId)
+        self._count += 1
+
+    def _drop_bucket(self, window, key):
+        bucket = window.buckets.pop(key)
+        for evt in bucket:
+            window.eventIds.discard(evt.eventId)
+        self._count -= len(bucket)
+        window.floor = max(window.floor, (key + 1) * self.bucket_ms - 1)
+
+    def _expire(self):
+        """Drop buckets that have fallen out of the window."""
+        cutoff = millis() - self.window
+        for window in self._apps.values():
+            for key in [k for k in window.buckets
+                        if (k + 1) * self.bucket_ms - 1 <= cutoff]:
+                self._drop_bucket(window, key)
+            window.floor = max(window.floor, cutoff)
+
+    def _evict(self):
+        """Drop the oldest buckets while the store is over max_events."""
+        while self._count > self.max_events:
+            oldest = None
+            for window in self._apps.values():
+                if window.buckets:
+                    key = min(window.buckets)
+                    if oldest is None or key < oldest[1]:
+                        oldest = (window, key)
+            if oldest is None:
+                return
+            self._drop_bucket(*oldest)
+
+    def _matches(self, window, start, end, eventTypeId, entityIds, cursor,
+                 entityMatch):
+        if entityMatch not in ('any', 'all'):
+            raise ValueError("entityMatch must be 'any' or 'all'")
+        wanted = None
+        if entityIds is not None:
+            wanted = set()
+            for entityType in entityIds:
+                for entId in entityIds[entityType]:
+                    wanted.add((int(entityType), int(entId)))
+            if len(wanted) == 0:
+                raise ValueError("entityIds must name at least one entity")
+        types = None
+        if isinstance(eventTypeId, (list, tuple, set, frozenset)):
+            types = set(int(t) for t in eventTypeId)
+            if len(types) == 0:
+                raise ValueError("eventTypeId must name at least one type")
+        elif eventTypeId is not None:
+            types = set([int(eventTypeId)])
+        after = None
+        if cursor is not None:
+            after = Event._decode_cursor(cursor)
+        first = start // self.bucket_ms
+        matches = []
+        for key, bucket in window.buckets.items():
+            if key < first or (end is not None and
+                               key * self.bucket_ms >= end):
+                continue
+            for evt in bucket:
+                if evt.eventTime <= start:
+                    continue
+                if end is not None and evt.eventTime >= end:
+                    continue
+                if types is not None and evt.eventTypeId not in types:
+                    continue
+                if after is not None and \
+                        (evt.eventTime, evt.eventId) <= after:
+                    continue
+                if wanted is not None:
+                    linked = set((ent.entityType, ent.entityId)
+                                 for ent in evt.relatedEntities)
+                    if entityMatch == 'all':
+                        if not wanted <= linked:
+                            continue
+                    elif not wanted & linked:
+                        continue
+                matches.append(evt)
+        return matches
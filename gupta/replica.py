@@ -0,0 +1,209 @@
+"""Read-replica routing for Gupta Event API
+
+Queries can be served by read replicas of the database so that large
+scans don't compete with ingest on the primary. A ReplicaSet hands out
+one of its healthy replicas for every read, in turn (round_robin) or
+the one with the fewest reads in flight (least_loaded), and the
+primary when none is healthy. Writes always go to the primary, and
+so do queries resolved by the primary's EntityIndex (see
+Event.iter_from_db).
+
+A replica is healthy while a trivial query on its event table
+succeeds. Replicas are checked every check_interval_s seconds by a
+background thread, and one whose read fails is taken out of rotation
+right away, until the next check finds it working again.
+
+Replicas lag behind the primary, so a client that must see its own
+writes pins its request to the primary (readYourWrites=true, see
+gupta.server). The ReplicaSet is built by EventConfig from the
+[database:NAME] sections (see get_replica_set).
+
+Classes:
+  - ReplicaSet: replicas of a primary database and their health
+"""
+
+import contextlib
+import logging
+import threading
+
+_log = logging.getLogger(__name__)
+
+def _is_driver_error(db, error):
+    """Return whether error is a DatabaseError of db's DB-API module
+    (sqlite3, MySQLdb, ...)"""
+    module = getattr(db, 'db_module', None)
+    errorClass = getattr(module, 'DatabaseError', None)
+    return errorClass is not None and isinstance(error, errorClass)
+
+class _Replica(object):
+    """A replica database with its health and counters"""
+
+    def __init__(self, name, db):
+        self.name = name
+        self.db = db
+        self.healthy = True
+        self.in_flight = 0
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+
+class ReplicaSet(object):
+    """Replicas of a primary database, picked for reads.
+
+    Example usage:
+      replicas = ReplicaSet(db, [('r1', db1), ('r2', db2)],
+                            policy='least_loaded')
+      replicas.start()                  # health checks
+      with replicas.reading() as readDb:
+          events = Event.load_from_db(readDb, 1, start)
+    """
+
+    POLICIES = ('round_robin', 'least_loaded')
+
+    def __init__(self, primary, replicas, policy='round_robin',
+                 check_interval_s=10):
+        if policy not in self.POLICIES:
+            raise ValueError("read policy must be 'round_robin' or "
+                             "'least_loaded'")
+        if len(replicas) == 0:
+            raise ValueError("A ReplicaSet needs at least one replica")
+        self.primary = primary
+        self.policy = policy
+        self.check_interval = check_interval_s
+        self._replicas = [_Replica(name, db) for name, db in replicas]
+        self._next = 0
+        self._primary_reads = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def acquire(self):
+        """Return the database to read from and count the read in flight.
+
+        Return the primary when no replica is healthy. Every acquire
+        must be followed by a release of the same database.
+        """
+        with self._lock:
+            healthy = [r for r in self._replicas if r.healthy]
+            if not healthy:
+                self._primary_reads += 1
+                return self.primary
+            if self.policy == 'least_loaded':
+                # ties go round the list, like round_robin
+                start = self._next % len(healthy)
+                ordered = healthy[start:] + healthy[:start]
+                replica = min(ordered, key=lambda r: r.in_flight)
+            else:
+                replica = healthy[self._next % len(healthy)]
+            self._next += 1
+            replica.in_flight += 1
+            replica.reads += 1
+            return replica.db
+
+    def release(self, db):
+        """End a read of db started with acquire"""
+        replica = self._find(db)
+        if replica is not None:
+            with self._lock:
+                replica.in_flight -= 1
+
+    @contextlib.contextmanager
+    def reading(self):
+        """Acquire a database for the with block, marking a replica
+        failed if the block raises a database driver error.
+
+        Other exceptions, such as those of malformed queries, leave
+        the replica in rotation.
+        """
+        db = self.acquire()
+        try:
+            yield db
+        except Exception as e:
+            if _is_driver_error(db, e):
+                self.failed(db, e)
+            raise
+        finally:
+            self.release(db)
+
+    def failed(self, db, error=None):
+        """Take the replica db out of rotation until it checks healthy"""
+        replica = self._find(db)
+        if replica is None:
+            return
+        with self._lock:
+            replica.failures += 1
+            replica.last_error = str(error)
+            if replica.healthy:
+                _log.warning('Replica %s failed: %s', replica.name, error)
+            replica.healthy = False
+
+    def _find(self, db):
+        for replica in self._replicas:
+            if replica.db is db:
+                return replica
+        return None
+
+    def check(self):
+        """Check every replica now; return {name: healthy}"""
+        results = {}
+        for replica in self._replicas:
+            try:
+                list(replica.db.query('SELECT 1 FROM event LIMIT 1'))
+                error = None
+            except Exception as e:
+                error = e
+            with self._lock:
+                if error is None:
+                    if not replica.healthy:
+                        _log.info('Replica %s is healthy again',
+                                  replica.name)
+                    replica.healthy = True
+                else:
+                    replica.failures += 1
+                    replica.last_error = str(error)
+                    if replica.healthy:
+                        _log.warning('Replica %s failed its check: %s',
+                                     replica.name, error)
+                    replica.healthy = False
+            results[replica.name] = error is None
+        return results
+
+    def start(self):
+        """Check the replicas every check_interval_s seconds in the
+        background, starting now"""
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='gupta-replica-check')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background checks"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.check()
+            except Exception:
+                _log.exception('Replica check failed')
+            self._stopping.wait(self.check_interval)
+
+    def stats(self):
+        """Return the health and counters of every replica, for /stats"""
+        with self._lock:
+            return {'policy' : self.policy,
+                    'primaryReads' : self._primary_reads,
+                    'replicas' : dict(
+                        (r.name, {'healthy' : r.healthy,
+                                  'inFlight' : r.in_flight,
+                                  'reads' : r.reads,
+                                  'failures' : r.failures,
+                                  'lastError' : r.last_error})
+                        for r in self._replicas)}
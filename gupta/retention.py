@@ -0,0 +1,334 @@
+"""Retention of old events for Gupta Event API
+
+Retention policies give the maximum age of the events of one
+application, or of one event type of an application, plus optionally
+a default for every other application. The most specific policy of an
+event applies, so a type can be kept longer or shorter than the rest
+of its application. Events no policy covers are kept forever.
+
+Policies are enforced by deleting the expired events in small batches:
+the ids of up to `batch_size' expired events are read through the time
+indexes, then those events and their event_entity rows are deleted by
+id in one short transaction, with their idempotency keys, followed
+by a pause of `pause_ms'. A
+batch only locks the rows it deletes, so ingest is never blocked for
+long. Event counts kept by rollups are not changed. Deleted events are
+also dropped from the database's EntityIndex, if it has one.
+
+On a partitioned database every partition older than the cutoff is
+purged the same way. When one age applies to everything,
+Partitioning.drop_before is much cheaper.
+
+Classes:
+  - RetentionPolicy: maximum age of some events
+  - Retention: policies plus the batched purge that enforces them
+
+Functions:
+  - parse_age: milliseconds from an age such as '90d'
+  - main: command line interface (bin/event_purge)
+"""
+
+import argparse
+import logging
+import re
+import sys
+import threading
+import time
+import web
+
+from gupta.util import millis, transaction
+
+_log = logging.getLogger(__name__)
+
+_UNITS = {'s' : 1000,
+          'm' : 60 * 1000,
+          'h' : 60 * 60 * 1000,
+          'd' : 24 * 60 * 60 * 1000,
+          'w' : 7 * 24 * 60 * 60 * 1000}
+
+def parse_age(text):
+    """Return milliseconds from an age such as '90d', '12h' or '30m'.
+
+    Units are s, m, h, d and w; a bare number is milliseconds. Raise
+    ValueError for anything else.
+    """
+    match = re.match(r'^\s*(\d+)\s*([smhdw]?)\s*$', str(text))
+    if match is None:
+        raise ValueError("Invalid age '%s'" % text)
+    number, unit = match.groups()
+    return int(number) * _UNITS.get(unit, 1)
+
+class RetentionPolicy(object):
+    """Maximum age in milliseconds of some events.
+
+    With applicationId None the policy is the default for every
+    application without one of its own. eventTypeId narrows a policy
+    to one event type of its application.
+    """
+
+    def __init__(self, max_age_ms, applicationId=None, eventTypeId=None):
+        if eventTypeId is not None and applicationId is None:
+            raise ValueError("A policy for an event type needs an "
+                             "applicationId")
+        self.max_age = int(max_age_ms)
+        self.applicationId = applicationId
+        self.eventTypeId = eventTypeId
+
+    def __str__(self):
+        if self.applicationId is None:
+            return 'default'
+        if self.eventTypeId is None:
+            return 'app %d' % self.applicationId
+        return 'app %d type %d' % (self.applicationId, self.eventTypeId)
+
+class Retention(object):
+    """Retention policies and the batched purge that enforces them.
+
+    Example usage:
+      retention = Retention([RetentionPolicy(parse_age('30d'), 1),
+                             RetentionPolicy(parse_age('7d'), 1, 5)])
+      retention.purge(db)       # one pass
+      retention.start(db)       # or a pass every interval_s seconds
+    """
+
+    def __init__(self, policies, batch_size=1000, pause_ms=100,
+                 interval_s=3600):
+        self.policies = list(policies)
+        seen = set()
+        for policy in self.policies:
+            key = (policy.applicationId, policy.eventTypeId)
+            if key in seen:
+                raise ValueError("Duplicate retention policy for %s" %
+                                 policy)
+            seen.add(key)
+        self.batch_size = batch_size
+        self.pause = pause_ms / 1000.0
+        self.interval = interval_s
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._purged = dict((str(p), 0) for p in self.policies)
+        self._running = False
+        self._last_run = None
+        self._last_duration = None
+
+    def max_age(self, applicationId, eventTypeId):
+        """Return the maximum age in milliseconds of the events of an
+        application and event type, or None if they are kept forever"""
+        applicationId = int(applicationId)
+        eventTypeId = int(eventTypeId)
+        default = app = None
+        for policy in self.policies:
+            if policy.applicationId is None:
+                default = policy
+            elif policy.applicationId == applicationId:
+                if policy.eventTypeId == eventTypeId:
+                    return policy.max_age
+                if policy.eventTypeId is None:
+                    app = policy
+        policy = app or default
+        if policy is None:
+            return None
+        return policy.max_age
+
+    def _where(self, policy):
+        """Return the SQL condition selecting the events of policy"""
+        apps = {}  # applicationId -> event types with their own policy
+        for p in self.policies:
+            if p.applicationId is not None:
+                types = apps.setdefault(p.applicationId, [])
+                if p.eventTypeId is not None:
+                    types.append(p.eventTypeId)
+        if policy.eventTypeId is not None:
+            return ('event.application_id = %d AND event.event_type_id = %d'
+                    % (policy.applicationId, policy.eventTypeId))
+        if policy.applicationId is not None:
+            where = 'event.application_id = %d' % policy.applicationId
+            types = apps[policy.applicationId]
+            if types:
+                where += (' AND event.event_type_id NOT IN (%s)' %
+                          ', '.join('%d' % t for t in sorted(types)))
+            return where
+        wheres = []
+        own = set(p.applicationId for p in self.policies
+                  if p.applicationId is not None and p.eventTypeId is None)
+        if own:
+            wheres.append('event.application_id NOT IN (%s)' %
+                          ', '.join('%d' % a for a in sorted(own)))
+        for appId, types in sorted(apps.items()):
+            if appId not in own and types:
+                wheres.append(('NOT (event.application_id = %d AND ' +
+                               'event.event_type_id IN (%s))') %
+                              (appId, ', '.join('%d' % t
+                                                for t in sorted(types))))
+        return ' AND '.join(wheres) or '1 = 1'
+
+    def _tables(self, db, cutoff):
+        """Return the (event, entity) table pairs that may hold events
+        older than cutoff"""
+        partitioning = getattr(db, 'partitioning', None)
+        if partitioning is None:
+            return [('event', 'event_entity')]
+        return [partitioning.tables(name)
+                for name in partitioning.overlapping(db, -1, cutoff)]
+
+    def count(self, db, now=None):
+        """Return {policy name: number of expired events} without
+        deleting anything"""
+        if now is None:
+            now = millis()
+        counts = {}
+        for policy in self.policies:
+            cutoff = now - policy.max_age
+            where = self._where(policy)
+            total = 0
+            for eventTable, entityTable in self._tables(db, cutoff):
+                rows = db.query(('SELECT COUNT(*) AS n FROM %s event ' +
+                                 'WHERE %s AND event.event_time < %d') %
+                                (eventTable, where, cutoff))
+                total += rows[0].n
+            counts[str(policy)] = total
+        return counts
+
+    def purge(self, db, now=None):
+        """Delete every expired event, one batch at a time.
+
+        Return the number of events deleted. A pass started with
+        start() stops between batches when stop() is called.
+        """
+        if now is None:
+            now = millis()
+        started = time.time()
+        with self._lock:
+            self._running = True
+        total = 0
+        try:
+            for policy in self.policies:
+                cutoff = now - policy.max_age
+                where = self._where(policy)
+                purged = 0
+                for eventTable, entityTable in self._tables(db, cutoff):
+                    while not self._stopping.is_set():
+                        n = self._purge_batch(db, eventTable, entityTable,
+                                              where, cutoff)
+                        if n == 0:
+                            break
+                        purged += n
+                        with self._lock:
+                            self._purged[str(policy)] += n
+                        _log.info('Purged %d events of %s (%d this pass)',
+                                  n, policy, purged)
+                        if n < self.batch_size:
+                            break
+                        self._stopping.wait(self.pause)
+                total += purged
+        finally:
+            with self._lock:
+                self._running = False
+                self._last_run = int(started * 1000)
+                self._last_duration = time.time() - started
+        if total:
+            _log.info('Retention pass purged %d events in %.1f s', total,
+                      time.time() - started)
+        return total
+
+    def _purge_batch(self, db, eventTable, entityTable, where, cutoff):
+        # read the ids first, outside the transaction, so that it only
+        # locks the rows it deletes
+        rows = db.query(('SELECT event.id AS id FROM %s event ' +
+                         'WHERE %s AND event.event_time < %d ' +
+                         'ORDER BY event.event_time LIMIT %d') %
+                        (eventTable, where, cutoff, self.batch_size))
+        eventIds = [row.id for row in rows]
+        if not eventIds:
+            return 0
+        ids = ', '.join('%d' % eventId for eventId in eventIds)
+        with transaction(db):
+            db.query('DELETE FROM %s WHERE event_id IN (%s)' %
+                     (entityTable, ids))
+            db.query('DELETE FROM event_key WHERE event_id IN (%s)' % ids)
+            count = db.query('DELETE FROM %s WHERE id IN (%s)' %
+                             (eventTable, ids))
+        index = getattr(db, 'entity_index', None)
+        if index is not None:
+            index.discard(eventIds)
+        return count
+
+    def start(self, db):
+        """Run a purge pass every interval_s seconds in the background"""
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, args=(db,),
+                                        name='gupta-retention')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background purge after its current batch"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self, db):
+        while not self._stopping.is_set():
+            try:
+                self.purge(db)
+            except Exception:
+                _log.exception('Retention pass failed')
+            self._stopping.wait(self.interval)
+
+    def stats(self):
+        """Return the progress of the purge, for /stats"""
+        with self._lock:
+            return {'running' : self._running,
+                    'lastRun' : self._last_run,
+                    'lastRunSeconds' : self._last_duration,
+                    'purged' : dict(self._purged)}
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(prog='event_purge')
+    parser.add_argument('--config', default=None,
+                        help='config file with the [database] and '
+                             '[retention] sections (default: event.cfg)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count the expired events')
+    parser.add_argument('--loop', action='store_true',
+                        help='purge every interval_s seconds until '
+                             'interrupted')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(message)s')
+    web.config.debug = False
+    # gupta.config imports this module
+    import gupta.config
+    if args.config is not None:
+        config = gupta.config.EventConfig(args.config)
+    else:
+        config = gupta.config.get_config()
+    retention = config.get_retention()
+    if retention is None:
+        parser.error('the config has no [retention] section')
+    db = config.get_database()
+    if args.dry_run:
+        for name, count in sorted(retention.count(db).items()):
+            print '%s: %d expired events' % (name, count)
+        return 0
+    if not args.loop:
+        retention.purge(db)
+        return 0
+    try:
+        while True:
+            retention.purge(db)
+            time.sleep(retention.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
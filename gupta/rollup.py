@@ -0,0 +1,166 @@
+"""Incrementally maintained event counts for Gupta Event API
+
+Counting events per eventTypeId over time by reading raw events moves
+every headline and body just to throw them away. With rollups enabled,
+Event.save adds each batch to per-bucket counts in the same
+transaction that stores the events. A histogram then reads one row
+per bucket, however many events it covers.
+
+Two tables hold the counts (see db/*_tables.sql):
+  - event_count: events per application, eventTypeId and bucket
+  - event_entity_count: events per application, eventTypeId, entity
+    type and bucket, counting each event once per entity type it has
+
+Rollups are a property of a database: EventConfig sets them on the
+web.py database object as `db.rollups' when the [database] section
+has a `rollups' option listing resolutions (e.g. minute, hour, day).
+
+Classes:
+  - Rollups: maintain and query bucketed counts
+"""
+
+RESOLUTIONS = {'minute' : 60 * 1000,
+               'hour' : 60 * 60 * 1000,
+               'day' : 24 * 60 * 60 * 1000}
+
+class Rollups:
+    """Bucketed event counts at a set of resolutions.
+
+    The upserts need SQLite 3.24 or later, or MySQL.
+
+    Example usage:
+      db.rollups = Rollups(['minute', 'hour'])
+      Event.save_many(db, events)   # also updates the counts
+      db.rollups.counts(db, 1, start, end, 'hour')
+    """
+
+    def __init__(self, resolutions=('minute', 'hour', 'day')):
+        for name in resolutions:
+            if name not in RESOLUTIONS:
+                raise ValueError("Unknown rollup resolution '%s'" % name)
+        self.resolutions = list(resolutions)
+
+    def update(self, db, events):
+        """Add saved events to the counts.
+
+        Called by Event.save_many inside its transaction.
+        """
+        counts = {}
+        entityCounts = {}
+        for evt in events:
+            eventTime = int(evt.eventTime)
+            entityTypes = set(int(ent.entityType)
+                              for ent in evt.relatedEntities)
+            for name in self.resolutions:
+                width = RESOLUTIONS[name]
+                bucket = eventTime - eventTime % width
+                key = (int(evt.applicationId), int(evt.eventTypeId),
+                       width, bucket)
+                counts[key] = counts.get(key, 0) + 1
+                for entityType in entityTypes:
+                    entityKey = key[:2] + (entityType,) + key[2:]
+                    entityCounts[entityKey] = \
+                        entityCounts.get(entityKey, 0) + 1
+        columns = ['application_id', 'event_type_id', 'resolution',
+                   'bucket_time']
+        self._add(db, 'event_count', columns, counts)
+        self._add(db, 'event_entity_count',
+                  columns[:2] + ['entity_type'] + columns[2:], entityCounts)
+
+    def counts(self, db, applicationId, start, end, resolution,
+               eventTypeId=None, byEntityType=False):
+        """Return a list of count dicts for buckets overlapping [start, end).
+
+        Each dict has bucketTime, eventTypeId and count, and also
+        entityType when byEntityType is True. They are ordered by
+        bucketTime, then eventTypeId (and entityType).
+
+        Raise ValueError for a resolution that isn't maintained.
+        """
+        if resolution not in self.resolutions:
+            raise ValueError("resolution must be one of: %s" %
+                             ', '.join(self.resolutions))
+        width = RESOLUTIONS[resolution]
+        start = int(start)
+        wheres = ['application_id = %d' % int(applicationId),
+                  'resolution = %d' % width,
+                  'bucket_time >= %d' % (start - start % width),
+                  'bucket_time < %d' % int(end)]
+        if eventTypeId is not None:
+            wheres.append('event_type_id = %d' % int(eventTypeId))
+        what = 'bucket_time, event_type_id, event_count'
+        order = 'bucket_time, event_type_id'
+        table = 'event_count'
+        if byEntityType:
+            what += ', entity_type'
+            order += ', entity_type'
+            table = 'event_entity_count'
+        rows = db.select(table, what=what, where=' AND '.join(wheres),
+                         order=order)
+        result = []
+        for row in rows:
+            count = {'bucketTime' : row.bucket_time,
+                     'eventTypeId' : row.event_type_id,
+                     'count' : row.event_count}
+            if byEntityType:
+                count['entityType'] = row.entity_type
+            result.append(count)
+        return result
+
+    def rebuild(self, db):
+        """Recompute all counts from the stored events.
+
+        Use it once when turning rollups on for a database that
+        already has events. Scans every event, in one transaction.
+        """
+        partitioning = getattr(db, 'partitioning', None)
+        if partitioning is None:
+            tables = [('event', 'event_entity')]
+        else:
+            tables = [partitioning.tables(name)
+                      for name in partitioning.overlapping(db, -2 ** 62)]
+        with db.transaction():
+            db.query('DELETE FROM event_count')
+            db.query('DELETE FROM event_entity_count')
+            # partitions are whole days, so no bucket spans two of them
+            for eventTable, entityTable in tables:
+                for name in self.resolutions:
+                    bucket = 'e.event_time - (e.event_time %% %d)' % \
+                        RESOLUTIONS[name]
+                    db.query(('INSERT INTO event_count (application_id, ' +
+                              'event_type_id, resolution, bucket_time, ' +
+                              'event_count) ' +
+                              'SELECT e.application_id, e.event_type_id, ' +
+                              '%d, %s, COUNT(*) FROM %s e ' +
+                              'GROUP BY e.application_id, e.event_type_id, ' +
+                              '%s') % (RESOLUTIONS[name], bucket,
+                                       eventTable, bucket))
+                    db.query(('INSERT INTO event_entity_count ' +
+                              '(application_id, event_type_id, ' +
+                              'entity_type, resolution, bucket_time, ' +
+                              'event_count) ' +
+                              'SELECT e.application_id, e.event_type_id, ' +
+                              'x.entity_type, %d, %s, COUNT(DISTINCT e.id) ' +
+                              'FROM %s e JOIN %s x ON x.event_id = e.id ' +
+                              'GROUP BY e.application_id, e.event_type_id, ' +
+                              'x.entity_type, %s') % (
+                                  RESOLUTIONS[name], bucket, eventTable,
+                                  entityTable, bucket))
+
+    @staticmethod
+    def _add(db, table, columns, counts):
+        if not counts:
+            return
+        values = ', '.join(
+            '(%s)' % ', '.join('%d' % v for v in key + (count,))
+            for key, count in sorted(counts.items()))
+        sql = 'INSERT INTO %s (%s, event_count) VALUES %s ' % (
+            table, ', '.join(columns), values)
+        if getattr(db, 'dbname', None) == 'mysql':
+            sql += ('ON DUPLICATE KEY UPDATE ' +
+                    'event_count = event_count + VALUES(event_count)')
+        else:
+            sql += ('ON CONFLICT (%s) DO UPDATE SET ' +
+                    'event_count = event_count + excluded.event_count') % \
+                ', '.join(columns)
+        db.query(sql)
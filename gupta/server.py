@@ -1,75 +1,797 @@
 #!/usr/bin/env python
 
+"""HTTP interface of Gupta Event API
+
+`application' is the WSGI callable for any WSGI server (mod_wsgi,
+gunicorn, ...). The database and the other in-process components are
+built from the config on the first request rather than at import, so
+the module can be imported before a server forks its workers.
+
+bin/event_server runs web.py's development server, or with --workers
+a pre-forked pool of worker processes (see gupta.prefork).
+"""
+
+import argparse
+import contextlib
+import logging
 import sys
+import threading
+import time
 import web
-import json
+import gupta.batch
+import gupta.codec
 import gupta.config
+import gupta.metrics
+import gupta.util
 from gupta.event import Event
+from gupta.ingest import IngestError
+
+_log = logging.getLogger(__name__)
+
+# built by init() on the first request
+_db = None
+_replicas = None
+_ingest_queue = None
+_recent_store = None
+_query_cache = None
+_event_bus = None
+_entity_index = None
+_retention = None
+_metrics = None
+_initialized = False
+_init_lock = threading.Lock()
 
-_db = gupta.config.get_database()
+# most query specs one /getEventsBatch request may hold
+_MAX_BATCH_QUERIES = 100
 
 _urls = (
     '/', 'Index',
     '/newEvent', 'CreateEvent',
-    '/getEvents', 'EventQuery'
+    '/newEvents', 'CreateEvents',
+    '/getEvents', 'EventQuery',
+    '/getEventsBatch', 'EventBatchQuery',
+    '/getEventCounts', 'EventCountQuery',
+    '/subscribe', 'Subscribe',
+    '/stats', 'Stats',
+    '/metrics', 'Metrics'
     )
 
+def init(purge=True, recent=True):
+    """Build the database and in-process components from the config.
+
+    Runs once per process, on its first request. Components that are
+    already set (e.g. a test database) are kept. With purge=False the
+    retention purge is left to another process (see _purge), with
+    recent=False the [recent] store is not built (see _check_workers).
+    """
+    global _db, _replicas, _ingest_queue, _recent_store, _query_cache
+    global _event_bus, _entity_index, _retention, _metrics
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        if _db is None:
+            _db = gupta.config.get_database()
+            _replicas = gupta.config.get_replica_set()
+            if _replicas is not None:
+                _replicas.start()
+        if _ingest_queue is None:
+            _ingest_queue = gupta.config.get_ingest_queue()
+        if _recent_store is None and recent:
+            _recent_store = gupta.config.get_recent_store()
+        if _query_cache is None:
+            _query_cache = gupta.config.get_query_cache()
+        if _event_bus is None:
+            _event_bus = gupta.config.get_event_bus()
+        if _entity_index is None:
+            _entity_index = gupta.config.get_entity_index()
+        if _retention is None and purge:
+            _retention = gupta.config.get_retention()
+            if (_retention is not None and
+                gupta.config.get_config().retention_background()):
+                _retention.start(_db)
+        if _metrics is None:
+            _metrics = gupta.config.get_metrics()
+        _initialized = True
+
+def shutdown():
+    """Flush and stop the ingest queue, end subscriptions, stop the
+    retention purge and replica checks and snapshot the entity index"""
+    if _ingest_queue is not None:
+        _ingest_queue.stop()
+    if _retention is not None:
+        _retention.stop()
+    if _replicas is not None:
+        _replicas.stop()
+    if _event_bus is not None:
+        _event_bus.close()
+    if _entity_index is not None:
+        _entity_index.save_snapshot()
+
+def _instrumented(handler):
+    """Decorate a handler method to record its latency and sizes.
+
+    Costs one global lookup per request while metrics are disabled.
+    """
+    def decorate(method):
+        def wrapper(*args):
+            m = gupta.metrics.current
+            if m is None:
+                return method(*args)
+            status = 'error'
+            t0 = time.time()
+            try:
+                body = method(*args)
+                status = 'ok'
+                return body
+            finally:
+                m.observe('gupta_request_seconds', time.time() - t0,
+                          handler=handler, status=status)
+                if status == 'ok' and isinstance(body, str):
+                    m.observe('gupta_response_bytes', len(body),
+                              handler=handler)
+        return wrapper
+    return decorate
+
+def _read_your_writes():
+    """Return True if the request must read from the primary"""
+    i = web.input(readYourWrites='false')
+    if i.readYourWrites not in ('true', 'false'):
+        raise ValueError("readYourWrites must be 'true' or 'false'")
+    return i.readYourWrites == 'true'
+
+@contextlib.contextmanager
+def _reading(pinned=False):
+    """Provide the database to read from: a replica, if there are
+    any and the request isn't pinned to the primary"""
+    if _replicas is None or pinned:
+        yield _db
+    else:
+        with _replicas.reading() as db:
+            yield db
+
 class Index:
     def GET(self):
         web.header('Content-Type', 'application/json')
-        return json.dumps({'status' : 'ok'})
+        return gupta.codec.dumps({'status' : 'ok'})
+
+class Stats:
+    """Counters of the in-process caches and connection pool"""
+    def GET(self):
+        web.header('Content-Type', 'application/json')
+        j = {'status' : 'ok'}
+        if _query_cache is not None:
+            j['queryCache'] = _query_cache.stats()
+        if _event_bus is not None:
+            j['eventBus'] = _event_bus.stats()
+        if _entity_index is not None:
+            j['entityIndex'] = _entity_index.stats()
+        if _retention is not None:
+            j['retention'] = _retention.stats()
+        pool = getattr(_db, 'pool', None)
+        if pool is not None:
+            j['connectionPool'] = pool.stats()
+        if _replicas is not None:
+            j['replicas'] = _replicas.stats()
+        keyCache = getattr(_db, 'key_cache', None)
+        if keyCache is not None:
+            j['keyCache'] = keyCache.stats()
+        return gupta.codec.dumps(j)
+
+class Metrics:
+    """Instrumentation in the Prometheus text format.
+
+    Needs a [metrics] config section.
+    """
+    def GET(self):
+        if _metrics is None:
+            web.header('Content-Type', 'application/json')
+            err_json = {'status' : 'error',
+                        'message' : 'Metrics are not enabled'}
+            raise web.notfound(gupta.codec.dumps(err_json))
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return _metrics.render()
 
 class EventQuery:
+    """Query events.
+
+    The response is one JSON object with an "events" list, unless
+    `format=ndjson' is passed or the Accept header asks for
+    application/x-ndjson. Then events are streamed one JSON object
+    per line as they are read from the database, so the first bytes
+    go out right away and memory stays bounded for any result size.
+    When a limit cuts the result short, the stream ends with a
+    {"nextCursor": ...} line.
+    """
+    @_instrumented('getEvents')
     def GET(self):
+        try:
+            params = _query_params()
+            pinned = _read_your_writes()
+            if _wants_ndjson(params.pop('format')):
+                web.header('Content-Type', 'application/x-ndjson')
+                return _stream_ndjson(params, pinned)
+            web.header('Content-Type', 'application/json')
+            if _query_cache is None:
+                with _reading(pinned) as db:
+                    return _query_json(params, db)
+            key = _query_cache.key(**params)
+            body = _query_cache.get(key)
+            if body is None:
+                generation = _query_cache.generation(key)
+                # fill the cache from the primary only: a lagging
+                # replica would put back results that a save has just
+                # invalidated, for the whole TTL
+                with _reading(pinned=True) as db:
+                    body = _query_json(params, db)
+                _query_cache.put(key, body, generation)
+            return body
+        except Exception as e:
+            web.header('Content-Type', 'application/json')
+            err_json = {'status' : 'error', 'message' : str(e)}
+            raise web.badrequest(gupta.codec.dumps(err_json))
+
+class EventBatchQuery:
+    """Run many event queries in one request.
+
+    The body is a JSON array of query specs, each an object with the
+    parameters of /getEvents (except format). Specs that only differ
+    in eventTypeId and entityIds share one SQL query (see
+    gupta.batch). The response has a "results" list with one
+    {"status": "ok", "events": [...], "nextCursor": ...} per spec, in
+    order. A malformed spec fails the whole request before anything
+    is read. Like /getEvents, it reads from a replica unless
+    readYourWrites=true is passed.
+    """
+    @_instrumented('getEventsBatch')
+    def POST(self):
         web.header('Content-Type', 'application/json')
         try:
-            i = web.input(eventTypeId=None, entityIds=None, end=None)
-            applicationId = int(i.applicationId)
-            start = long(i.start)
-            end = i.end
-            if end is not None:
-                end = long(end)
-            eventTypeId = i.eventTypeId
-            if eventTypeId is not None:
-                eventTypeId = long(eventTypeId)
-            entityIds = i.entityIds
-            if entityIds is not None:
-                entityIds = json.loads(entityIds)
-            eventList = Event.load_from_db(_db,
-                                           applicationId=applicationId,
-                                           start=start,
-                                           end=end,
-                                           eventTypeId=eventTypeId,
-                                           entityIds=entityIds)
-            eventJson = [evt.to_dict() for evt in eventList]
+            specs = gupta.codec.loads(web.data())
+            if not isinstance(specs, list):
+                raise ValueError("Expected a JSON array of queries")
+            if len(specs) > _MAX_BATCH_QUERIES:
+                raise ValueError("At most %d queries per batch" %
+                                 _MAX_BATCH_QUERIES)
+            params = []
+            for pos, spec in enumerate(specs):
+                try:
+                    if not isinstance(spec, dict):
+                        raise ValueError("Expected a JSON object")
+                    spec = _query_params(spec)
+                except Exception as e:
+                    raise ValueError("Query %d: %s" % (pos, e))
+                del spec['format']
+                params.append(spec)
+            with _reading(_read_your_writes()) as db:
+                results = gupta.batch.load_batch(db, params,
+                                                 recent=_recent_store)
+            for result in results:
+                result['status'] = 'ok'
+            return gupta.codec.dumps({'status' : 'ok', 'results' : results})
+        except Exception as e:
+            err_json = {'status' : 'error', 'message' : str(e)}
+            raise web.badrequest(gupta.codec.dumps(err_json))
+
+class EventCountQuery:
+    """Event counts per eventTypeId over fixed time buckets.
+
+    Served from the rollup tables, so it needs `rollups' in the
+    [database] config section. Parameters: applicationId, start, end,
+    resolution (minute, hour or day), and optionally eventTypeId and
+    byEntityType=true to also group by entity type.
+    """
+    @_instrumented('getEventCounts')
+    def GET(self):
+        web.header('Content-Type', 'application/json')
+        try:
+            rollups = getattr(_db, 'rollups', None)
+            if rollups is None:
+                raise ValueError("Event counts are not enabled")
+            i = web.input(eventTypeId=None, byEntityType='false')
+            if i.byEntityType not in ('true', 'false'):
+                raise ValueError("byEntityType must be 'true' or 'false'")
+            with _reading(_read_your_writes()) as db:
+                counts = rollups.counts(
+                    db, applicationId=int(i.applicationId),
+                    start=long(i.start), end=long(i.end),
+                    resolution=i.resolution, eventTypeId=i.eventTypeId,
+                    byEntityType=i.byEntityType == 'true')
             j = {'status' : 'ok',
-                 'events' : eventJson}
-            return json.dumps(j)
+                 'resolution' : i.resolution,
+                 'counts' : counts}
+            return gupta.codec.dumps(j)
         except Exception as e:
             err_json = {'status' : 'error', 'message' : str(e)}
-            raise web.badrequest(json.dumps(err_json))
-        
+            raise web.badrequest(gupta.codec.dumps(err_json))
+
+def _query_json(params, db):
+    """Return the JSON response body for query params, read from db"""
+    limit = params['limit']
+    # fetch one extra event to find out if there's a next page
+    params = dict(params, limit=_plus_one(limit))
+    m = gupta.metrics.current
+    if m is not None:
+        t0 = time.time()
+    eventJson = list(Event.iter_from_db(db, recent=_recent_store,
+                                        as_dicts=True, **params))
+    if m is not None:
+        t1 = time.time()
+        # SQL time is recorded separately under stage="sql"
+        m.observe('gupta_stage_seconds', t1 - t0, stage='query')
+        m.increment('gupta_events_total', len(eventJson), stage='query')
+    nextCursor = None
+    if limit is not None and len(eventJson) > limit:
+        eventJson = eventJson[:limit]
+        nextCursor = Event._cursor_of(eventJson[-1])
+    j = {'status' : 'ok',
+         'events' : eventJson,
+         'nextCursor' : nextCursor}
+    body = gupta.codec.dumps(j)
+    if m is not None:
+        m.observe('gupta_stage_seconds', time.time() - t1, stage='encode')
+    return body
+
+# optional query parameters and their defaults
+_QUERY_DEFAULTS = {'eventTypeId' : None,
+                   'entityIds' : None,
+                   'end' : None,
+                   'limit' : None,
+                   'cursor' : None,
+                   'format' : None,
+                   'entityMatch' : 'any',
+                   'fields' : None}
+
+def _query_params(spec=None):
+    """Return load_from_db keyword arguments parsed from web.input()
+
+    Also includes the requested response `format' (None by default).
+    With a spec dict of /getEventsBatch, parse that instead; its
+    entityIds may be a JSON object and its fields a list.
+    Raise an exception if a parameter is missing or malformed.
+    """
+    if spec is None:
+        i = web.input(**_QUERY_DEFAULTS)
+    else:
+        i = web.storage(_QUERY_DEFAULTS)
+        i.update(spec)
+    applicationId = int(i.applicationId)
+    start = long(i.start)
+    end = i.end
+    if end is not None:
+        end = long(end)
+    eventTypeId = i.eventTypeId
+    if eventTypeId is not None:
+        eventTypeId = long(eventTypeId)
+    entityIds = _entity_ids(i.entityIds)
+    limit = i.limit
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError("limit must be a positive integer")
+    if i.entityMatch not in ('any', 'all'):
+        raise ValueError("entityMatch must be 'any' or 'all'")
+    fields = i.fields
+    if isinstance(fields, basestring):
+        fields = fields.split(',')
+    if fields is not None:
+        # a sorted tuple, so it can be part of a cache key
+        fields = tuple(sorted(set(f.strip() for f in fields
+                                  if f.strip())))
+        Event._check_fields(fields)
+    if i.cursor is not None:
+        # fail before any output is streamed
+        Event._decode_cursor(i.cursor)
+    return {'applicationId' : applicationId,
+            'start' : start,
+            'end' : end,
+            'eventTypeId' : eventTypeId,
+            'entityIds' : entityIds,
+            'limit' : limit,
+            'cursor' : i.cursor,
+            'entityMatch' : i.entityMatch,
+            'fields' : fields,
+            'format' : i.format}
+
+def _entity_ids(entityIds):
+    """Return the entityIds parameter (a JSON object, or a dict of a
+    /getEventsBatch spec) checked to map entity types to lists of ids.
+
+    Raise ValueError if it is malformed.
+    """
+    if entityIds is None:
+        return None
+    if isinstance(entityIds, basestring):
+        entityIds = gupta.codec.loads(entityIds)
+    if type(entityIds) is not dict:
+        raise ValueError("entityIds must map entity types to lists of "
+                         "entity IDs")
+    for entityType, ids in entityIds.iteritems():
+        try:
+            int(entityType)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid entity type '%s'" % entityType)
+        if type(ids) is not list:
+            raise ValueError("Entity IDs of type '%s' must be a list"
+                             % entityType)
+        for entityId in ids:
+            if type(entityId) not in Event._INTEGER:
+                raise ValueError("Entity IDs of type '%s' must be "
+                                 "integers" % entityType)
+    return entityIds
+
+def _wants_ndjson(format):
+    if format is not None:
+        if format not in ('json', 'ndjson'):
+            raise ValueError("format must be 'json' or 'ndjson'")
+        return format == 'ndjson'
+    accept = web.ctx.env.get('HTTP_ACCEPT', '')
+    return 'application/x-ndjson' in accept
+
+def _stream_ndjson(params, pinned=False):
+    """Generate NDJSON lines for the events matching params.
+
+    Errors after the first line can't change the response status, so
+    they are reported as a final {"status": "error"} line.
+    """
+    limit = params['limit']
+    params['limit'] = _plus_one(limit)
+    count = 0
+    last = None
+    try:
+        with _reading(pinned) as db:
+            for evt in Event.stream_from_db(db, recent=_recent_store,
+                                            as_dicts=True, **params):
+                count += 1
+                if limit is not None and count > limit:
+                    nextCursor = Event._cursor_of(last)
+                    yield (gupta.codec.dumps({'nextCursor' : nextCursor}) +
+                           '\n')
+                    break
+                last = evt
+                yield gupta.codec.dumps(evt) + '\n'
+    except Exception as e:
+        err_json = {'status' : 'error', 'message' : str(e)}
+        yield gupta.codec.dumps(err_json) + '\n'
+
+class Subscribe:
+    """Stream new events as Server-Sent Events.
+
+    Needs a [subscribe] config section. Parameters: applicationId,
+    and optionally eventTypeId and entityIds (as for /getEvents,
+    matching any of the entities). Each event is sent as one SSE
+    message whose data is the event's JSON and whose id is its
+    cursor. Given a cursor (the `cursor' parameter, or the
+    Last-Event-ID header a reconnecting EventSource sends), the events
+    saved after it are first read from the database; after that new
+    events come from the in-process EventBus, so a waiting subscriber
+    costs no queries. A comment line is sent every heartbeat_s seconds
+    of silence, and the stream ends after max_stream_s seconds (or the
+    `timeout' parameter, if shorter); clients then reconnect with the
+    id of the last event they got.
+    """
+    def GET(self):
+        if _event_bus is None:
+            web.header('Content-Type', 'application/json')
+            err_json = {'status' : 'error',
+                        'message' : 'Subscriptions are not enabled'}
+            raise web.notfound(gupta.codec.dumps(err_json))
+        config = gupta.config.get_config()
+        try:
+            i = web.input(eventTypeId=None, entityIds=None, cursor=None,
+                          timeout=None)
+            cursor = i.cursor
+            if cursor is None:
+                cursor = web.ctx.env.get('HTTP_LAST_EVENT_ID') or None
+            if cursor is not None:
+                Event._decode_cursor(cursor)
+            duration = config.subscribe_max_seconds()
+            if i.timeout is not None:
+                duration = min(duration, float(i.timeout))
+            entityIds = _entity_ids(i.entityIds)
+            # subscribe before catching up, so nothing saved in
+            # between is missed
+            sub = _event_bus.subscribe(int(i.applicationId),
+                                       i.eventTypeId, entityIds)
+        except Exception as e:
+            web.header('Content-Type', 'application/json')
+            err_json = {'status' : 'error', 'message' : str(e)}
+            raise web.badrequest(gupta.codec.dumps(err_json))
+        web.header('Content-Type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+        return _stream_events(sub, cursor, config.subscribe_heartbeat(),
+                              duration)
+
+def _stream_events(sub, cursor, heartbeat, duration):
+    """Generate the SSE messages of subscription sub.
+
+    Events from the database and from the bus can overlap while
+    catching up, so the bus events right after a catch-up skip the
+    eventIds it sent.
+    """
+    deadline = time.time() + duration
+    if cursor is None:
+        # overflowing before any event is sent catches up from here
+        cursor = Event._make_cursor(gupta.util.millis(), 0)
+        caughtUp = set()
+    else:
+        caughtUp = None
+    try:
+        # web.py sends the headers with the first chunk: send them now,
+        # with the delay for EventSource to wait before reconnecting
+        yield 'retry: 1000\n\n'
+        while True:
+            if caughtUp is None:
+                caughtUp = set()
+                for evt in _catch_up(sub, cursor):
+                    caughtUp.add(evt['eventId'])
+                    cursor = Event._cursor_of(evt)
+                    yield _sse_message(evt, cursor)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events, overflowed = sub.get(min(heartbeat, remaining))
+            if sub.closed:
+                return
+            if overflowed:
+                # the dropped events are in the database
+                caughtUp = None
+                continue
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            for evt in events:
+                if evt.eventId in caughtUp:
+                    continue
+                cursor = evt.cursor()
+                yield _sse_message(evt.to_dict(), cursor)
+            caughtUp.clear()
+    finally:
+        _event_bus.unsubscribe(sub)
+
+def _catch_up(sub, cursor):
+    """Generate the event dicts of sub saved after cursor"""
+    cursorTime, cursorId = Event._decode_cursor(cursor)
+    entityIds = None
+    if sub.entities is not None:
+        entityIds = {}
+        for entityType, entityId in sub.entities:
+            entityIds.setdefault(entityType, []).append(entityId)
+    # from the primary: the bus only has events saved after the
+    # subscription, so a lagging replica could leave a gap
+    return Event.stream_from_db(_db, sub.applicationId, cursorTime - 1,
+                                eventTypeId=sub.eventTypeId,
+                                entityIds=entityIds, cursor=cursor,
+                                as_dicts=True)
+
+def _sse_message(evt, cursor):
+    return 'id: %s\ndata: %s\n\n' % (cursor, gupta.codec.dumps(evt))
+
+def _plus_one(limit):
+    if limit is None:
+        return None
+    return limit + 1
+
 class CreateEvent:
+    """Create one event.
+
+    With `mode = queue' in the [ingest] config section the event is
+    handed to the write-behind queue. The `ack' query parameter (or
+    the configured default) picks when to respond: 'commit' waits for
+    the event's transaction and returns its eventId, 'enqueue'
+    returns as soon as the event is queued, with a null eventId.
+
+    An event whose idempotencyKey was already saved isn't saved
+    again; the response has the original eventId and
+    "duplicate": true.
+    """
+    @_instrumented('newEvent')
     def POST(self):
         web.header('Content-Type', 'application/json')
         try:
             j = web.data()
             evt = Event.from_json(j)
-            evt.save(_db)
+        except Exception as e:
+            err_json = {'status' : 'error', 'message' : str(e)}
+            raise web.badrequest(gupta.codec.dumps(err_json))
+        try:
+            if _ingest_queue is None:
+                evt.save(_db)
+                eventId = evt.eventId
+            else:
+                eventId = _enqueue(evt)
             ok_json = {
                 'status'  : 'ok',
-                'eventId' : evt.eventId
+                'eventId' : eventId
             }
-            return json.dumps(ok_json)
+            if evt.duplicate:
+                ok_json['duplicate'] = True
+            return gupta.codec.dumps(ok_json)
+        except IngestError as e:
+            err_json = {'status' : 'error', 'message' : str(e)}
+            raise web.HTTPError('503 Service Unavailable',
+                                data=gupta.codec.dumps(err_json))
+        except Exception as e:
+            err_json = {'status' : 'error', 'message' : str(e)}
+            raise web.badrequest(gupta.codec.dumps(err_json))
+
+def _enqueue(evt):
+    """Queue evt for group commit; return its eventId if acking on commit"""
+    config = gupta.config.get_config()
+    i = web.input(_method='get', ack=config.ingest_ack())
+    if i.ack not in ('commit', 'enqueue'):
+        raise ValueError("ack must be 'commit' or 'enqueue'")
+    # a retry of a recently saved event needn't be queued at all
+    cache = getattr(_db, 'key_cache', None)
+    if cache is not None and evt.idempotencyKey is not None:
+        eventId = cache.get(evt.applicationId, evt.idempotencyKey)
+        if eventId is not None:
+            evt.eventId = eventId
+            evt.duplicate = True
+            return eventId
+    pending = _ingest_queue.submit(evt)
+    if i.ack == 'enqueue':
+        return None
+    return pending.wait(config.ingest_commit_timeout())
+
+class CreateEvents:
+    """Batch ingest: a JSON array of events, or one JSON event per line.
+
+    Every event is saved in a single transaction. The response has one
+    result per input event, in order, so that one bad record does not
+    reject the whole batch.
+    """
+    @_instrumented('newEvents')
+    def POST(self):
+        web.header('Content-Type', 'application/json')
+        try:
+            data = web.data()
+            m = gupta.metrics.current
+            if m is not None:
+                m.observe('gupta_request_bytes', len(data),
+                          handler='newEvents')
+            items = _parse_batch(data)
         except Exception as e:
             err_json = {'status' : 'error', 'message' : str(e)}
-            raise web.badrequest(json.dumps(err_json))
+            raise web.badrequest(gupta.codec.dumps(err_json))
+        results = [None] * len(items)
+        events = []
+        positions = []
+        for pos, item in enumerate(items):
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                events.append(Event.from_dict(item))
+                positions.append(pos)
+            except Exception as e:
+                results[pos] = {'status' : 'error', 'message' : str(e)}
+        errors = Event.save_batch(_db, events)
+        for pos, evt, err in zip(positions, events, errors):
+            if err is None:
+                results[pos] = {'status' : 'ok', 'eventId' : evt.eventId}
+                if evt.duplicate:
+                    results[pos]['duplicate'] = True
+            else:
+                results[pos] = {'status' : 'error', 'message' : str(err)}
+        return gupta.codec.dumps({'status' : 'ok', 'results' : results})
+
+def _parse_batch(data):
+    """Return a list of event dicts from a JSON array or NDJSON body.
+
+    Lines of an NDJSON body that aren't valid JSON are returned as
+    their ValueError, so they can be reported per item.
+    """
+    if data.lstrip().startswith('['):
+        items = gupta.codec.loads(data)
+        if not isinstance(items, list):
+            raise ValueError("Expected a JSON array of events")
+        return items
+    items = []
+    for line in data.splitlines():
+        if line.strip() == '':
+            continue
+        try:
+            items.append(gupta.codec.loads(line))
+        except ValueError as e:
+            items.append(e)
+    return items
+
+app = web.application(_urls, globals(), autoreload=False)
+app.add_processor(web.loadhook(init))
+application = app.wsgifunc()
+
+def _check_workers(workers):
+    """Raise ValueError if the config can't be served by this many
+    worker processes.
+
+    The [recent] store only sees the events saved by its own process,
+    so with several workers each one would answer from an incomplete
+    store.
+    """
+    if workers > 1 and gupta.config.get_config().has_section('recent'):
+        raise ValueError("the [recent] store only sees events saved by "
+                         "its own process; it can't be used with more "
+                         "than one worker")
+
+def _worker_application(workers):
+    # in a freshly forked worker: pick up config changes on reload.
+    # The master purges in a process of its own (see _purge)
+    gupta.config.reload()
+    recent = True
+    try:
+        _check_workers(workers)
+    except ValueError as e:
+        # added to the config since startup, which refused it
+        _log.error("Not using [recent]: %s", e)
+        recent = False
+    init(purge=False, recent=recent)
+    return application
+
+def _purge(stopping):
+    """Run the background retention purge until stopping is set.
+
+    Runs in the one background process of the pre-fork master, so
+    that workers don't purge the same batches at once.
+    """
+    gupta.config.reload()
+    config = gupta.config.get_config()
+    retention = config.get_retention()
+    if retention is None or not config.retention_background():
+        return
+    retention.start(config.get_database())
+    # wake up for SIGTERM, which sets stopping
+    while not stopping.is_set():
+        stopping.wait(1)
+    retention.stop()
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
-    app = web.application(_urls, globals())
-    app.run()
+    parser = argparse.ArgumentParser(
+        prog='event_server',
+        usage='%(prog)s [--config FILE] [--workers N [--threads T]] '
+              '[[host:]port]')
+    parser.add_argument('--config', default=None,
+                        help='config file (default: $GUPTA_CONFIG or '
+                             'event.cfg)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='pre-fork N worker processes')
+    parser.add_argument('--threads', type=int, default=10,
+                        help='request threads per worker (default: 10)')
+    parser.add_argument('--shutdown-timeout', type=int, default=30,
+                        help='seconds to finish requests on shutdown')
+    args, rest = parser.parse_known_args(argv[1:])
+    if args.config is not None:
+        # read now, so that a bad file fails before anything starts
+        gupta.config.init(args.config)
+    if args.workers is None:
+        # web.py's single-process development server, which reads
+        # the address (or fastcgi/scgi mode) from sys.argv
+        sys.argv = argv[:1] + rest
+        dev = web.application(_urls, globals())
+        dev.add_processor(web.loadhook(init))
+        dev.run()
+        return 0
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    try:
+        _check_workers(args.workers)
+    except ValueError as e:
+        parser.error(str(e))
+    from gupta.prefork import PreforkServer
+    web.config.debug = False
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(process)d] %(message)s')
+    address = web.validip(rest[0] if rest else '')
+    server = PreforkServer(lambda: _worker_application(args.workers),
+                           address,
+                           workers=args.workers, threads=args.threads,
+                           shutdown_timeout=args.shutdown_timeout,
+                           on_exit=shutdown, background=_purge)
+    server.serve()
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
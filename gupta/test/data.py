@@ -4,10 +4,16 @@ Usage:
     import gupta.event.data
     test_data_1 = gupta.event.data.TestData().json_objects()
     test_data_2 = gupta.event.data.TestData().json_strings()
+
+For benchmarks, SyntheticData generates any number of events with the
+same interface:
+    load = gupta.test.data.SyntheticData(count=100000, seed=1)
 """
 
+import bisect
 import json
 import copy
+import random
 
 class TestData:
     """Test data for Gupta Event API
@@ -65,3 +71,83 @@ class TestData:
     def json_strings(self):
         """Return string json representation of test events"""
         return [s for s in self.test_data_strings]
+
+class SyntheticData(TestData):
+    """Scalable, reproducible synthetic events for benchmarks
+
+    Events are spread over `applications' application ids and
+    `event_types' event types, with eventTimes spread evenly at random
+    over [time_start, time_start + time_spread). Each event links
+    about `entities_per_event' entities, drawn from `entity_types'
+    types and `entity_ids' ids per type. Entity popularity follows a
+    Zipf distribution with exponent `skew' (0 is uniform), so a few
+    entities are linked to most events, as in real traffic.
+
+    The same seed always gives the same events.
+
+    Methods (in addition to TestData's):
+      - iter_objects: generate the events one at a time
+    """
+    def __init__(self, count=1000, applications=10, event_types=20,
+                 time_start=1370000000000, time_spread=30 * 86400000,
+                 entities_per_event=3, entity_types=5, entity_ids=10000,
+                 skew=1.1, body_length=400, seed=0):
+        self.count = count
+        self.applications = applications
+        self.event_types = event_types
+        self.time_start = time_start
+        self.time_spread = time_spread
+        self.entities_per_event = entities_per_event
+        self.entity_types = entity_types
+        self.entity_ids = entity_ids
+        self.body_length = body_length
+        self.seed = seed
+        # cumulative Zipf weights for bisecting a uniform sample
+        self._cumulative = []
+        total = 0.0
+        for rank in range(1, entity_ids + 1):
+            total += 1.0 / rank ** skew
+            self._cumulative.append(total)
+        self._data = None
+
+    @property
+    def test_data(self):
+        if self._data is None:
+            self._data = list(self.iter_objects())
+        return self._data
+
+    @property
+    def test_data_strings(self):
+        return [json.dumps(d) for d in self.test_data]
+
+    def iter_objects(self):
+        """Generate the events as json objects (dicts), in order"""
+        rand = random.Random(self.seed)
+        filler = 'lorem ipsum dolor sit amet ' * (self.body_length // 27 + 1)
+        for i in range(self.count):
+            app = rand.randint(1, self.applications)
+            evt = rand.randint(1, self.event_types)
+            eventTime = self.time_start + rand.randrange(self.time_spread)
+            d = {'applicationId' : app,
+                 'eventTypeId' : evt,
+                 'eventTime' : eventTime,
+                 'headline' : 'synthetic event %d for app %d' % (i, app),
+                 'body' : filler[:self.body_length]}
+            entities = {}
+            for j in range(rand.randint(0, 2 * self.entities_per_event)):
+                entityType = str(rand.randint(1, self.entity_types))
+                entityId = self._popular_entity(rand)
+                ids = entities.setdefault(entityType, [])
+                if entityId not in ids:
+                    ids.append(entityId)
+            if entities:
+                d['relatedEntities'] = entities
+            yield d
+
+    def popular_entities(self, n=10):
+        """Return the ids of the n most often linked entities"""
+        return range(1, n + 1)
+
+    def _popular_entity(self, rand):
+        sample = rand.random() * self._cumulative[-1]
+        return bisect.bisect_left(self._cumulative, sample) + 1
@@ -0,0 +1,127 @@
+"""Unit tests for gupta.archive import and export"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import gupta.archive
+import gupta.test.data
+from gupta.archive import export_events, import_events
+from gupta.config import get_test_database
+from gupta.event import Event
+from gupta.util import nostderr
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = get_test_database()
+        self.test_data = gupta.test.data.TestData().json_objects()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, objects, mode='wb'):
+        opener = gzip.open if name.endswith('.gz') else open
+        f = opener(self.path(name), mode)
+        for o in objects:
+            if isinstance(o, dict):
+                o = json.dumps(o)
+            f.write(o + '\n')
+        f.close()
+        return self.path(name)
+
+    def count(self):
+        with nostderr():
+            return self.db.query('SELECT COUNT(*) AS n FROM event')[0].n
+
+    def test_export_import_round_trip(self):
+        with nostderr():
+            Event.save_many(self.db, [Event.from_dict(d)
+                                      for d in self.test_data])
+            n = export_events(self.db, self.path('out.ndjson.gz'), 1, 20, 40)
+            other = get_test_database()
+            imported, rejected = import_events(other,
+                                               self.path('out.ndjson.gz'),
+                                               batch_size=2)
+            original = Event.load_from_db(self.db, 1, 19, 40)
+            copied = Event.load_from_db(other, 1, 0)
+        # eventTime 20 is included, 40 is not
+        self.assertEqual([e.eventTime for e in original], [20, 20, 30, 30])
+        self.assertEqual((n, imported, rejected), (4, 4, 0))
+        strip = lambda e: dict(e.to_dict(), eventId=None)
+        self.assertEqual([strip(e) for e in original],
+                         [strip(e) for e in copied])
+
+    def test_rejects_bad_lines(self):
+        bad = dict(self.test_data[1])
+        del bad['headline']
+        null = dict(self.test_data[2], applicationId=None)
+        name = self.write('in.ndjson', [self.test_data[0], '{not json', bad,
+                                        '', null, self.test_data[3]])
+        with nostderr():
+            imported, rejected = import_events(self.db, name,
+                                               rejects=self.path('rejects'))
+        self.assertEqual((imported, rejected), (2, 3))
+        self.assertEqual(self.count(), 2)
+        with open(self.path('rejects')) as f:
+            self.assertEqual(f.read().splitlines(),
+                             ['{not json', json.dumps(bad), json.dumps(null)])
+
+    def test_resumes_from_checkpoint(self):
+        name = self.write('in.ndjson', self.test_data[:5])
+        with nostderr():
+            self.assertEqual(import_events(self.db, name, batch_size=2,
+                                           checkpoint='in'), (5, 0))
+            self.write('in.ndjson', self.test_data[5:8], 'ab')
+            self.assertEqual(import_events(self.db, name, batch_size=2,
+                                           checkpoint='in'), (8, 0))
+            self.assertEqual(self.count(), 8)
+            self.assertEqual(import_events(self.db, name, checkpoint='in',
+                                           restart=True), (8, 0))
+            self.assertEqual(self.count(), 16)
+
+    def test_listeners_hear_of_committed_batches_only(self):
+        name = self.write('in.ndjson', self.test_data[:4])
+        notified = []
+        save_checkpoint = gupta.archive._save_checkpoint
+        calls = []
+        def failing_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise IOError('checkpoint failed')
+            save_checkpoint(*args)
+        Event.add_save_listener(notified.extend)
+        gupta.archive._save_checkpoint = failing_once
+        try:
+            with nostderr():
+                self.assertEqual(import_events(self.db, name, batch_size=4,
+                                               checkpoint='in'), (4, 0))
+        finally:
+            gupta.archive._save_checkpoint = save_checkpoint
+            Event.remove_save_listener(notified.extend)
+        # the batch rolled back, then every event was saved on its own
+        with nostderr():
+            saved = [row.id for row in
+                     self.db.query('SELECT id FROM event ORDER BY id')]
+        self.assertEqual(sorted(evt.eventId for evt in notified), saved)
+        self.assertEqual(len(saved), 4)
+
+    def test_defer_indexes(self):
+        name = self.write('in.ndjson.gz', self.test_data)
+        with nostderr():
+            imported, rejected = import_events(self.db, name,
+                                               defer_indexes=True)
+            indexes = [row.name for row in self.db.query(
+                "SELECT name FROM sqlite_master WHERE type = 'index' " +
+                "AND name LIKE 'idx_%'")]
+        self.assertEqual(imported, len(self.test_data))
+        self.assertEqual(sorted(indexes), ['idx_app_time', 'idx_entity',
+                                           'idx_key_event', 'idx_time',
+                                           'idx_type_time'])
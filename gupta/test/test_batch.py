@@ -0,0 +1,101 @@
+"""Unit tests for gupta.batch"""
+
+import unittest
+
+from gupta.batch import load_batch, plan
+from gupta.config import get_test_database
+from gupta.event import Event
+from gupta.util import nostderr
+
+class BatchTest(unittest.TestCase):
+    """Check that merged queries answer every spec like a query of its own"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = get_test_database(seed=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db = None
+
+    def expected(self, spec):
+        with nostderr():
+            return list(Event.iter_from_db(self.db, as_dicts=True, **spec))
+
+    def check(self, specs):
+        with nostderr():
+            results = load_batch(self.db, specs)
+        self.assertEqual(len(results), len(specs))
+        for spec, result in zip(specs, results):
+            self.assertEqual(result['events'], self.expected(spec))
+            self.assertEqual(result['nextCursor'], None)
+
+    def test_merges_event_types(self):
+        specs = [{'applicationId' : 1, 'start' : 0, 'eventTypeId' : 1},
+                 {'applicationId' : 1, 'start' : 0, 'eventTypeId' : 2},
+                 {'applicationId' : 1, 'start' : 0, 'end' : 30,
+                  'eventTypeId' : 2}]
+        queries = plan(specs)
+        self.assertEqual([indexes for query, indexes in queries],
+                         [[0, 1], [2]])
+        self.assertEqual(queries[0][0]['eventTypeId'], [1, 2])
+        self.check(specs)
+
+    def test_merges_entities(self):
+        specs = [{'applicationId' : 1, 'start' : 0,
+                  'entityIds' : {'1' : [14]}},
+                 {'applicationId' : 1, 'start' : 0,
+                  'entityIds' : {'2' : [4]}},
+                 {'applicationId' : 1, 'start' : 0,
+                  'entityIds' : {'2' : [1, 4]}, 'entityMatch' : 'all'}]
+        queries = plan(specs)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(queries[0][0]['entityIds'],
+                         {'1' : [14], '2' : [1, 4]})
+        self.assertFalse('eventTypeId' in queries[0][0])
+        self.check(specs)
+
+    def test_mixed_filters_are_not_merged(self):
+        # merged, neither filter would be left: a scan of the app
+        specs = [{'applicationId' : 1, 'start' : 0, 'eventTypeId' : 2},
+                 {'applicationId' : 1, 'start' : 0,
+                  'entityIds' : {'1' : [14]}},
+                 {'applicationId' : 1, 'start' : 0, 'eventTypeId' : 1},
+                 {'applicationId' : 1, 'start' : 0, 'eventTypeId' : 1,
+                  'entityIds' : {'2' : [4]}},
+                 {'applicationId' : 1, 'start' : 0}]
+        queries = plan(specs)
+        self.assertEqual([indexes for query, indexes in queries],
+                         [[0, 2], [1], [3], [4]])
+        self.assertEqual(queries[0][0]['eventTypeId'], [1, 2])
+        self.assertFalse('eventTypeId' in queries[1][0])
+        self.assertEqual(queries[2][0], specs[3])
+        self.check(specs)
+
+    def test_fields_needed_to_fan_out_are_dropped(self):
+        specs = [{'applicationId' : 1, 'start' : 0, 'eventTypeId' : 1,
+                  'entityIds' : {'1' : [14]}, 'fields' : ('headline',)},
+                 {'applicationId' : 1, 'start' : 0, 'eventTypeId' : 2,
+                  'entityIds' : {'2' : [4]}, 'fields' : ('headline',)}]
+        queries = plan(specs)
+        self.assertEqual(queries[0][0]['fields'],
+                         ('eventTypeId', 'headline', 'relatedEntities'))
+        self.check(specs)
+
+    def test_limited_specs_run_alone(self):
+        specs = [{'applicationId' : 2, 'start' : 0, 'eventTypeId' : 1,
+                  'limit' : 2},
+                 {'applicationId' : 2, 'start' : 0, 'eventTypeId' : 2}]
+        self.assertEqual(len(plan(specs)), 2)
+        with nostderr():
+            results = load_batch(self.db, specs)
+            first = self.expected(dict(specs[0], limit=None))
+        self.assertEqual(results[0]['events'], first[:2])
+        self.assertEqual(results[0]['nextCursor'],
+                         Event._cursor_of(first[1]))
+        self.assertEqual(results[1]['events'], self.expected(specs[1]))
+
+    def test_raise_error_on_bad_spec(self):
+        specs = [{'applicationId' : 1, 'start' : 0, 'eventTypeId' : 1},
+                 {'applicationId' : 1, 'start' : 0, 'entityIds' : {}}]
+        self.assertRaises(ValueError, load_batch, self.db, specs)
@@ -0,0 +1,109 @@
+"""Unit tests for the synthetic data and benchmark suite"""
+
+import json
+import os
+import unittest
+
+from tempfile import NamedTemporaryFile
+
+from gupta.bench import micro, load
+from gupta.bench.results import percentile, summarize, write_results
+from gupta.config import get_test_database
+from gupta.test.data import SyntheticData
+from gupta.util import nostderr
+
+class SyntheticDataTest(unittest.TestCase):
+
+    def test_same_seed_same_events(self):
+        a = SyntheticData(count=50, seed=7).json_strings()
+        b = SyntheticData(count=50, seed=7).json_strings()
+        c = SyntheticData(count=50, seed=8).json_strings()
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_respects_ranges(self):
+        data = SyntheticData(count=200, applications=3, event_types=4,
+                             time_start=1000, time_spread=500,
+                             entity_types=2, entity_ids=50)
+        for d in data.json_objects():
+            self.assertTrue(1 <= d['applicationId'] <= 3)
+            self.assertTrue(1 <= d['eventTypeId'] <= 4)
+            self.assertTrue(1000 <= d['eventTime'] < 1500)
+            for entityType, ids in d.get('relatedEntities', {}).items():
+                self.assertTrue(entityType in ('1', '2'))
+                self.assertTrue(all(1 <= i <= 50 for i in ids))
+
+    def test_skew_favours_popular_entities(self):
+        data = SyntheticData(count=500, entity_ids=1000, skew=1.2)
+        counts = {}
+        for d in data.json_objects():
+            for ids in d.get('relatedEntities', {}).values():
+                for i in ids:
+                    counts[i] = counts.get(i, 0) + 1
+        top = sum(counts.get(i, 0) for i in data.popular_entities(10))
+        self.assertTrue(top > sum(counts.values()) / 3)
+
+class ResultsTest(unittest.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), None)
+
+    def test_summarize(self):
+        summary = summarize([0.001] * 9 + [0.1], elapsed=0.5, items=20)
+        self.assertEqual(summary['operations'], 10)
+        self.assertEqual(summary['opsPerSecond'], 20.0)
+        self.assertEqual(summary['itemsPerSecond'], 40.0)
+        self.assertEqual(summary['p50Ms'], 1.0)
+        self.assertEqual(summary['p99Ms'], 100.0)
+
+    def test_write_results(self):
+        f = NamedTemporaryFile(suffix='.json', delete=False)
+        f.close()
+        try:
+            write_results(f.name, 'micro', {'count' : 1}, {'x' : {}})
+            with open(f.name) as g:
+                doc = json.load(g)
+        finally:
+            os.unlink(f.name)
+        self.assertEqual(doc['benchmark'], 'micro')
+        self.assertEqual(doc['options'], {'count' : 1})
+        for key in ('revision', 'timestamp', 'python', 'platform'):
+            self.assertTrue(key in doc)
+
+class BenchmarkTest(unittest.TestCase):
+    """Run the benchmarks on a few events to check they work"""
+
+    def setUp(self):
+        self.db_file = NamedTemporaryFile(suffix='.db', delete=False)
+        self.db_file.close()
+        self.db = get_test_database(self.db_file.name)
+        self.data = SyntheticData(count=40, applications=2, seed=3)
+
+    def tearDown(self):
+        os.unlink(self.db_file.name)
+
+    def test_micro(self):
+        with nostderr():
+            results = micro.run(self.db, self.data, batch_size=10,
+                                queries=5)
+        self.assertEqual(results['save']['operations'], 20)
+        self.assertEqual(results['save_many']['items'], 20)
+        self.assertEqual(results['load_from_db_time']['operations'], 5)
+        self.assertEqual(results['encode_json']['items'], 40)
+
+    def test_load(self):
+        server = load.LocalServer(self.db)
+        with nostderr():
+            server.start()
+            try:
+                results = load.run(server.url, self.data, threads=2,
+                                   batch_size=10, queries=5)
+            finally:
+                server.stop()
+        self.assertEqual(results['newEvent']['operations'], 20)
+        self.assertEqual(results['newEvents']['operations'], 2)
+        for summary in results.values():
+            self.assertEqual(summary['errors'], 0)
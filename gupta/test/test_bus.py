@@ -0,0 +1,65 @@
+"""Unit tests for gupta.bus"""
+
+import threading
+import unittest
+
+from gupta.bus import EventBus
+from gupta.event import Event
+import gupta.test.data
+
+class EventBusTest(unittest.TestCase):
+    """Check filtering, waking and overflow of subscriptions"""
+
+    def setUp(self):
+        self.bus = EventBus(max_queue=3)
+        self.events = [Event.from_dict(d) for d in
+                       gupta.test.data.TestData().json_objects()]
+
+    def test_filters(self):
+        byApp = self.bus.subscribe(1)
+        byType = self.bus.subscribe(1, eventTypeId=2)
+        byEntity = self.bus.subscribe(1, entityIds={'1' : [15]})
+        self.bus.publish(self.events[:8])
+        for sub, wanted in ((byApp, lambda e: True),
+                            (byType, lambda e: e.eventTypeId == 2),
+                            (byEntity, lambda e: (u'1', 15) in
+                             [(ent.entityType, ent.entityId)
+                              for ent in e.relatedEntities])):
+            expected = [e for e in self.events[:8]
+                        if e.applicationId == 1 and wanted(e)][:3]
+            events, overflowed = sub.get(0)
+            self.assertEqual(events, expected)
+        self.assertEqual(self.bus.stats()['subscriptions'], 3)
+
+    def test_get_waits_for_publish(self):
+        sub = self.bus.subscribe(1)
+        timer = threading.Timer(0.05, self.bus.publish, [self.events[:1]])
+        timer.start()
+        events, overflowed = sub.get(5)
+        timer.join()
+        self.assertEqual(events, self.events[:1])
+        self.assertFalse(overflowed)
+        self.assertEqual(sub.get(0.01), ([], False))
+
+    def test_overflow(self):
+        sub = self.bus.subscribe(1)
+        appEvents = [e for e in self.events if e.applicationId == 1]
+        self.bus.publish(appEvents[:5])
+        events, overflowed = sub.get(0)
+        self.assertEqual(events, appEvents[:3])
+        self.assertTrue(overflowed)
+        self.assertEqual(self.bus.stats()['dropped'], 2)
+        self.assertEqual(sub.get(0), ([], False))
+
+    def test_unsubscribe_wakes_subscriber(self):
+        sub = self.bus.subscribe(1)
+        timer = threading.Timer(0.05, self.bus.unsubscribe, [sub])
+        timer.start()
+        sub.get()
+        timer.join()
+        self.assertTrue(sub.closed)
+        self.bus.publish(self.events)
+        self.assertEqual(self.bus.stats()['delivered'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""Unit tests for gupta.cache"""
+
+import unittest
+
+from gupta.cache import QueryCache
+from gupta.event import Event
+
+class QueryCacheTest(unittest.TestCase):
+    """Test LRU, TTL and write-driven invalidation"""
+
+    def setUp(self):
+        self.cache = QueryCache(max_bytes=100, ttl_ms=60000)
+
+    def put(self, body, **kw):
+        key = QueryCache.key(**kw)
+        self.cache.put(key, body, self.cache.generation(key))
+        return key
+
+    def saved(self, applicationId, eventTime):
+        return Event(applicationId, 1, 'headline', 'body', eventId=1,
+                     eventTime=eventTime)
+
+    def test_key_is_normalized(self):
+        a = QueryCache.key(applicationId='1', start='0',
+                           entityIds={'1' : [16, 14], '2' : [4]})
+        b = QueryCache.key(applicationId=1, start=0, limit=None,
+                           entityIds={2 : [4], 1 : [14, 16, 14]})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, QueryCache.key(applicationId=1, start=0,
+                                              limit=5))
+
+    def test_hit_and_miss(self):
+        key = self.put('x' * 10, applicationId=1, start=0)
+        self.assertEqual('x' * 10, self.cache.get(key))
+        self.assertEqual(None, self.cache.get(QueryCache.key(2, 0)))
+        stats = self.cache.stats()
+        self.assertEqual((1, 1), (stats['hits'], stats['misses']))
+
+    def test_lru_eviction_by_bytes(self):
+        first = self.put('a' * 40, applicationId=1, start=0)
+        second = self.put('b' * 40, applicationId=1, start=10)
+        self.cache.get(first)
+        third = self.put('c' * 40, applicationId=1, start=20)
+        self.assertEqual(None, self.cache.get(second))
+        self.assertNotEqual(None, self.cache.get(first))
+        self.assertNotEqual(None, self.cache.get(third))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+        self.assertTrue(self.cache.stats()['bytes'] <= 100)
+
+    def test_ttl_expiry(self):
+        self.cache.ttl = -1
+        key = self.put('x', applicationId=1, start=0)
+        self.assertEqual(None, self.cache.get(key))
+        self.assertEqual(1, self.cache.stats()['expirations'])
+
+    def test_invalidates_covering_ranges_only(self):
+        covering = self.put('a', applicationId=1, start=0, end=100)
+        before = self.put('b', applicationId=1, start=0, end=50)
+        open_ended = self.put('c', applicationId=1, start=60)
+        other_app = self.put('d', applicationId=2, start=0)
+        self.cache.invalidate_events([self.saved(1, 75)])
+        self.assertEqual(None, self.cache.get(covering))
+        self.assertEqual(None, self.cache.get(open_ended))
+        self.assertEqual('b', self.cache.get(before))
+        self.assertEqual('d', self.cache.get(other_app))
+        self.assertEqual(2, self.cache.stats()['invalidations'])
+
+    def test_put_skipped_after_concurrent_write(self):
+        key = QueryCache.key(applicationId=1, start=0)
+        generation = self.cache.generation(key)
+        self.cache.invalidate_events([self.saved(1, 5)])
+        self.cache.put(key, 'stale', generation)
+        self.assertEqual(None, self.cache.get(key))
+
+if __name__ == '__main__':
+    unittest.main()
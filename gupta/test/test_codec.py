@@ -0,0 +1,49 @@
+"""Unit tests for gupta.codec"""
+
+import unittest
+
+import gupta.codec
+
+class CodecTest(unittest.TestCase):
+    """Every installed JSON library must behave the same"""
+
+    def setUp(self):
+        self.previous = gupta.codec.name
+
+    def tearDown(self):
+        gupta.codec.use(self.previous)
+
+    def test_standard_library_is_always_available(self):
+        self.assertIn('json', gupta.codec.available())
+        self.assertEqual(gupta.codec.use('json'), 'json')
+        self.assertEqual(gupta.codec.name, 'json')
+
+    def test_auto_prefers_ujson(self):
+        expected = 'json'
+        if 'ujson' in gupta.codec.available():
+            expected = 'ujson'
+        self.assertEqual(gupta.codec.use(), expected)
+
+    def test_round_trip(self):
+        obj = {'status' : 'ok',
+               'events' : [{'eventId' : 2 ** 40, 'headline' : u'caf\xe9',
+                            'body' : 'a/b "quoted"',
+                            'relatedEntities' : {'1' : [14, 16]}}]}
+        for library in gupta.codec.available():
+            gupta.codec.use(library)
+            text = gupta.codec.dumps(obj)
+            self.assertNotIn('\\/', text)
+            self.assertEqual(gupta.codec.loads(text), obj)
+
+    def test_invalid_json_raises_value_error(self):
+        for library in gupta.codec.available():
+            gupta.codec.use(library)
+            self.assertRaises(ValueError, gupta.codec.loads, '{not json')
+            self.assertRaises(ValueError, gupta.codec.loads, '')
+
+    def test_unknown_library(self):
+        self.assertRaises(ValueError, gupta.codec.use, 'yaml')
+        self.assertEqual(gupta.codec.name, self.previous)
+
+if __name__ == '__main__':
+    unittest.main()
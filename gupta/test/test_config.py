@@ -0,0 +1,84 @@
+"""Unit tests for gupta.config"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import gupta.config
+from gupta.config import get_test_database
+from gupta.util import nostderr
+
+class ConfigTest(unittest.TestCase):
+    """Check lazy reading of the global config and test databases"""
+
+    def setUp(self):
+        self.saved = (gupta.config._default_config_file,
+                      gupta.config._default_config,
+                      os.environ.get('GUPTA_CONFIG'))
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        (gupta.config._default_config_file, gupta.config._default_config,
+         env) = self.saved
+        if env is None:
+            os.environ.pop('GUPTA_CONFIG', None)
+        else:
+            os.environ['GUPTA_CONFIG'] = env
+        shutil.rmtree(self.dir)
+
+    def write(self, name, db):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'w') as f:
+            f.write('[database]\ndbn = sqlite\ndb = %s\n' % db)
+        return filename
+
+    def test_import_reads_nothing(self):
+        # no event.cfg in the working directory
+        root = os.path.dirname(os.path.dirname(
+            os.path.abspath(gupta.config.__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        env.pop('GUPTA_CONFIG', None)
+        process = subprocess.Popen(
+            [sys.executable, '-c',
+             'import gupta, gupta.config; '
+             'assert gupta.config._default_config is None'],
+            cwd=self.dir, env=env, stderr=subprocess.PIPE)
+        err = process.communicate()[1]
+        self.assertEqual(process.returncode, 0, err)
+
+    def test_init_and_env(self):
+        first = self.write('first.cfg', 'first.db')
+        second = self.write('second.cfg', 'second.db')
+        gupta.config._default_config_file = None
+        os.environ['GUPTA_CONFIG'] = first
+        gupta.config.reload()
+        self.assertEqual(gupta.config._default_config, None)
+        self.assertEqual(gupta.config.get_config().get('database', 'db'),
+                         'first.db')
+        config = gupta.config.init(second)
+        self.assertTrue(gupta.config.get_config() is config)
+        self.assertEqual(config.get('database', 'db'), 'second.db')
+        # an explicit file wins over the environment from then on
+        gupta.config.reload()
+        self.assertEqual(gupta.config.get_config().get('database', 'db'),
+                         'second.db')
+        self.assertRaises(IOError, gupta.config.init,
+                          os.path.join(self.dir, 'missing.cfg'))
+
+    def test_test_databases_are_copies(self):
+        empty = get_test_database()
+        seeded = get_test_database(seed=True)
+        other = get_test_database(seed=True)
+        with nostderr():
+            seeded.query('delete from event where application_id = 1')
+            self.assertEqual(empty.query(
+                'select count(*) as n from event')[0].n, 0)
+            self.assertEqual(seeded.query(
+                'select count(*) as n from event')[0].n, 8)
+            self.assertEqual(other.query(
+                'select count(*) as n from event')[0].n, 16)
+            self.assertEqual(other.query(
+                'select count(*) as n from event_entity')[0].n, 10)
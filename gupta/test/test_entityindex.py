@@ -0,0 +1,186 @@
+"""Unit tests for gupta.entityindex"""
+
+import os
+import unittest
+
+from tempfile import NamedTemporaryFile
+
+import gupta.test.data
+from gupta.config import get_test_database
+from gupta.entityindex import EntityIndex
+from gupta.event import Event
+from gupta.partition import Partitioning
+from gupta.util import nostderr
+
+DAY = 24 * 60 * 60 * 1000
+
+# entity filters of the test data, with and without matches
+FILTERS = [{'1' : [14]},
+           {'1' : [14, 15]},
+           {'2' : [4]},
+           {'1' : [16], '2' : [5]},
+           {'1' : [99]}]
+
+class EntityIndexTest(unittest.TestCase):
+    """Check that queries through the index answer like the database"""
+
+    def setUp(self):
+        self.plain = get_test_database(seed=True)
+        self.db = get_test_database(seed=True)
+        self.test_data = gupta.test.data.TestData().json_objects()
+        with nostderr():
+            self.index = EntityIndex(refresh_s=None)
+            self.index.rebuild(self.db)
+        self.db.entity_index = self.index
+
+    def both(self, **kw):
+        with nostderr():
+            plain = list(Event.iter_from_db(self.plain, as_dicts=True, **kw))
+            indexed = list(Event.iter_from_db(self.db, as_dicts=True, **kw))
+        return plain, indexed
+
+    def check(self, **kw):
+        plain, indexed = self.both(**kw)
+        self.assertEqual(plain, indexed)
+        return indexed
+
+    def test_filters_match_database(self):
+        for entityIds in FILTERS:
+            for entityMatch in ('any', 'all'):
+                for appId in (1, 2):
+                    self.check(applicationId=appId, start=0,
+                               entityIds=entityIds, entityMatch=entityMatch)
+                self.check(applicationId=1, start=10, end=40,
+                           entityIds=entityIds, entityMatch=entityMatch)
+                self.check(applicationId=1, start=0, eventTypeId=1,
+                           entityIds=entityIds, entityMatch=entityMatch)
+                self.check(applicationId=1, start=0, eventTypeId=[1, 2],
+                           entityIds=entityIds, entityMatch=entityMatch)
+        self.check(applicationId=1, start=0, entityIds={'1' : [14, 15]},
+                   fields=['headline'])
+
+    def test_pages_match_database(self):
+        kw = {'applicationId' : 1, 'start' : 0,
+              'entityIds' : {'1' : [14, 15, 16], '2' : [4, 5]}}
+        events = self.check(limit=2, **kw)
+        self.assertEqual(len(events), 2)
+        cursor = Event._cursor_of(events[-1])
+        self.check(limit=2, cursor=cursor, **kw)
+
+    def test_saved_events_are_indexed(self):
+        Event.add_save_listener(self.index.add)
+        try:
+            evt = Event.from_dict(dict(self.test_data[1],
+                                       relatedEntities={'7' : [1]}))
+            with nostderr():
+                evt.save(self.db)
+        finally:
+            Event.remove_save_listener(self.index.add)
+        events = self.both(applicationId=1, start=0,
+                           entityIds={'7' : [1]})[1]
+        self.assertEqual([e['eventId'] for e in events], [evt.eventId])
+
+    def test_refresh_reads_newer_events(self):
+        # saved by "another process": not seen by the listener
+        count = len(self.index)
+        with nostderr():
+            Event.save_many(self.db, [Event.from_dict(d)
+                                      for d in self.test_data])
+            self.assertEqual(self.index.refresh(self.db), count)
+        self.assertEqual(len(self.index), 2 * count)
+        with nostderr():
+            self.assertEqual(self.index.refresh(self.db), 0)
+
+    def test_refresh_reads_late_commits(self):
+        def insert(eventId):
+            # saved by another process, with an id of its choice
+            with nostderr():
+                self.db.query("INSERT INTO event (id, application_id, "
+                              "event_time, event_type_id, headline) "
+                              "VALUES (%d, 1, 50, 1, 'late')" % eventId)
+                self.db.query("INSERT INTO event_entity (event_id, "
+                              "entity_type, entity_id) "
+                              "VALUES (%d, 7, 1)" % eventId)
+        def refresh(index):
+            with nostderr():
+                return index.refresh(self.db)
+        with nostderr():
+            last = self.db.query('SELECT MAX(id) AS last FROM event')[0].last
+        late = EntityIndex(refresh_s=None, refresh_lag_s=None)
+        refresh(late)
+        insert(last + 5)
+        self.assertEqual(refresh(self.index), 1)
+        self.assertEqual(refresh(late), 1)
+        # a transaction holding a lower id commits after the refresh
+        insert(last + 2)
+        self.assertEqual(refresh(self.index), 1)
+        self.assertEqual(refresh(self.index), 0)
+        events = self.both(applicationId=1, start=0,
+                           entityIds={'7' : [1]})[1]
+        self.assertEqual([e['eventId'] for e in events],
+                         [last + 2, last + 5])
+        # without the lag window it is never indexed
+        self.assertEqual(refresh(late), 0)
+        self.assertEqual(len(late), len(self.index) - 1)
+
+    def test_deleted_events_are_discarded(self):
+        kw = {'applicationId' : 1, 'start' : 0, 'entityIds' : {'2' : [4]}}
+        first = self.both(**kw)[1][0]
+        with nostderr():
+            self.db.query('delete from event where id = %d' %
+                          first['eventId'])
+        count = len(self.index)
+        events = self.both(limit=1, **kw)[1]
+        self.assertEqual(len(events), 1)
+        self.assertNotEqual(events[0]['eventId'], first['eventId'])
+        self.assertEqual(len(self.index), count - 1)
+
+    def test_snapshot(self):
+        f = NamedTemporaryFile(suffix='.snapshot', delete=False)
+        f.close()
+        # another process in the middle of writing its snapshot
+        other = '%s.%d.tmp' % (f.name, os.getpid() + 1)
+        try:
+            self.assertFalse(EntityIndex(snapshot=f.name).load_snapshot())
+            with open(other, 'wb') as tmp:
+                tmp.write('half')
+            self.index.snapshot = f.name
+            self.assertTrue(self.index.save_snapshot())
+            with open(other, 'rb') as tmp:
+                self.assertEqual(tmp.read(), 'half')
+            loaded = EntityIndex(snapshot=f.name, refresh_s=None)
+            self.assertTrue(loaded.load_snapshot())
+        finally:
+            os.unlink(f.name)
+            if os.path.exists(other):
+                os.unlink(other)
+        stats = self.index.stats()
+        self.assertEqual(loaded.stats()['postings'], stats['postings'])
+        self.assertTrue(stats['bytes'] > 0)
+        self.db.entity_index = loaded
+        for entityIds in FILTERS:
+            self.check(applicationId=1, start=0, entityIds=entityIds)
+        with nostderr():
+            self.assertEqual(loaded.refresh(self.db), 0)
+
+    def test_partitioned(self):
+        db = get_test_database()
+        db.partitioning = Partitioning('day')
+        for d in self.test_data:
+            d['eventTime'] = d['eventTime'] * DAY // 10 + 5
+        with nostderr():
+            Event.save_many(db, [Event.from_dict(d)
+                                 for d in self.test_data])
+            index = EntityIndex(refresh_s=None)
+            index.rebuild(db)
+            kw = {'applicationId' : 1, 'start' : 0,
+                  'entityIds' : {'1' : [14, 15, 16], '2' : [4, 5]}}
+            plain = list(Event.iter_from_db(db, as_dicts=True, **kw))
+            db.entity_index = index
+            self.assertEqual(plain,
+                             list(Event.iter_from_db(db, as_dicts=True,
+                                                     **kw)))
+            db.partitioning.drop_before(db, 2 * DAY)
+            self.assertEqual(plain[1:],
+                             list(Event.iter_from_db(db, as_dicts=True,
+                                                     **kw)))
@@ -40,6 +40,38 @@ class JsonTest(unittest.TestCase):
         del self.json['body']
         self.check_value_error()
 
+    def test_raise_error_on_wrong_types(self):
+        for key, value in (('applicationId', '1'), ('eventTypeId', True),
+                           ('headline', None), ('body', 3),
+                           ('eventTime', 1.5), ('relatedEntities', [])):
+            self.json = gupta.test.data.TestData().json_objects()[0]
+            self.json[key] = value
+            self.check_value_error()
+
+    def test_raise_error_on_long_text(self):
+        self.json['headline'] = 'x' * 201
+        self.check_value_error()
+        self.json['headline'] = 'x' * 200
+        self.json['body'] = 'x' * 4193
+        self.check_value_error()
+
+    def test_raise_error_on_bad_entities(self):
+        for entities in ({'a' : [1]}, {'1' : 1}, {'1' : ['2']}):
+            self.json['relatedEntities'] = entities
+            self.check_value_error()
+
+    def test_raise_error_on_non_object(self):
+        self.assertRaises(ValueError, Event.from_json, '[1, 2]')
+
+    def test_optional_attributes(self):
+        for key in ('eventTime', 'relatedEntities'):
+            del self.json[key]
+        self.json['body'] = None
+        evt = Event.from_json(json.dumps(self.json))
+        self.assertTrue(evt.eventTime > 0)
+        self.assertEqual(evt.relatedEntities, [])
+        self.assertEqual(evt.body, None)
+
     def test_from_json(self):
         evt = Event.from_json(json.dumps(self.json))
         self.assertEqual(evt.applicationId, self.json['applicationId'])
@@ -58,33 +90,17 @@ class EventTest(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        # get test database connection
-        cls.db = get_test_database()
         # get test seed data
         cls.test_data = gupta.test.data.TestData().json_strings()
 
     def setUp(self):
-        self.save_test_data()
-
-    def tearDown(self):
-        self.clear()
-
-    @classmethod
-    def tearDownClass(cls):
-        # close temporary sqlite db
-        cls.db = None
+        # a fresh copy of the seeded test database
+        self.db = get_test_database(seed=True)
 
     ###############################
     # EventTest: Helper functions #
     ###############################
 
-    def save_test_data(self):
-        """save test data to db"""
-        with nostderr():
-            for d in self.test_data:
-                evt = Event.from_json(d)
-                evt.save(self.db)
-
     def clear(self):
         """clear test db for new test"""
         with nostderr():
@@ -117,6 +133,76 @@ class EventTest(unittest.TestCase):
             evt.save(self.db)
         self.assertRaises(EventError, evt.save, self.db)
 
+    # batch save tests
+    def test_save_many_returns_ids_in_order(self):
+        self.clear()
+        events = [Event.from_json(d) for d in self.test_data]
+        with nostderr():
+            eventIds = Event.save_many(self.db, events)
+            loaded = Event.load_from_db(self.db, applicationId=1, start=0)
+        self.assertEqual(eventIds, [evt.eventId for evt in events])
+        self.assertEqual(len(set(eventIds)), len(events))
+        byId = dict((evt.eventId, evt) for evt in loaded)
+        self.assertEqual(8, len(byId))
+        for evt in events[:8]:
+            self.assertEqual(byId[evt.eventId].headline, evt.headline)
+            self.assertEqual(len(byId[evt.eventId].relatedEntities),
+                             len(evt.relatedEntities))
+    def test_save_many_without_consecutive_ids(self):
+        # as on MySQL with innodb_autoinc_lock_mode = 2
+        self.clear()
+        self.db.consecutive_ids = False
+        inserts = []
+        entityInserts = []
+        lastIds = []
+        query = self.db.query
+        def counted(sql, *args, **kw):
+            if str(sql).startswith('INSERT INTO event '):
+                inserts.append(sql)
+            elif str(sql).startswith('INSERT INTO event_entity '):
+                entityInserts.append(sql)
+            elif 'last_insert' in str(sql):
+                lastIds.append(sql)
+            return query(sql, *args, **kw)
+        self.db.query = counted
+        events = [Event.from_json(d) for d in self.test_data]
+        try:
+            with nostderr():
+                Event.save_many(self.db, events)
+        finally:
+            del self.db.query
+        self.assertEqual(len(inserts), len(events))
+        # ids of entity rows aren't needed: one multi-row INSERT
+        self.assertEqual(len(entityInserts), 1)
+        self.assertEqual(len(lastIds), len(events))
+        with nostderr():
+            loaded = Event.load_from_db(self.db, applicationId=1, start=0)
+        byId = dict((evt.eventId, evt) for evt in loaded)
+        for evt in events[:8]:
+            self.assertEqual(byId[evt.eventId].to_dict(), evt.to_dict())
+    def test_save_many_raises_before_writing(self):
+        self.clear()
+        saved = Event.from_json(self.test_data[0])
+        with nostderr():
+            saved.save(self.db)
+        fresh = Event.from_json(self.test_data[1])
+        self.assertRaises(EventError, Event.save_many, self.db,
+                          [fresh, saved])
+        self.assertFalse(fresh.is_saved())
+    def test_save_batch_isolates_failures(self):
+        self.clear()
+        saved = Event.from_json(self.test_data[0])
+        with nostderr():
+            saved.save(self.db)
+            events = [Event.from_json(self.test_data[1]), saved,
+                      Event.from_json(self.test_data[2])]
+            errors = Event.save_batch(self.db, events)
+        self.assertEqual(errors[0], None)
+        self.assertTrue(isinstance(errors[1], EventError))
+        self.assertEqual(errors[2], None)
+        self.assertTrue(events[0].is_saved())
+        self.assertTrue(events[2].is_saved())
+
     # query tests
     def test_app_query(self):
         with nostderr():
@@ -131,6 +217,16 @@ class EventTest(unittest.TestCase):
                 end=35
             )
         self.assertEqual(4, len(events))
+    def test_event_type_list_query(self):
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=2, start=0,
+                                        eventTypeId=[1, 2])
+            one = Event.load_from_db(self.db, applicationId=2, start=0,
+                                     eventTypeId=[2])
+        self.assertEqual(8, len(events))
+        self.assertEqual(4, len(one))
+        self.assertRaises(ValueError, Event.load_from_db, self.db,
+                          applicationId=2, start=0, eventTypeId=[])
     def test_entity_query_1(self):
         with nostderr():
             events = Event.load_from_db(
@@ -140,6 +236,168 @@ class EventTest(unittest.TestCase):
                 entityIds={'1' : [14, 15]}
             )
         self.assertEqual(3, len(events))
+    def test_entity_query_any_types(self):
+        with nostderr():
+            events = Event.load_from_db(
+                self.db,
+                applicationId=1,
+                start=0,
+                entityIds={'1' : [16], '2' : [5]}
+            )
+        self.assertEqual(3, len(events))
+    def test_entity_query_all(self):
+        with nostderr():
+            events = Event.load_from_db(
+                self.db,
+                applicationId=1,
+                start=0,
+                entityIds={'1' : [15, 16]},
+                entityMatch='all'
+            )
+            events2 = Event.load_from_db(
+                self.db,
+                applicationId=1,
+                start=0,
+                entityIds={'1' : [14], '2' : [4]},
+                entityMatch='all'
+            )
+        self.assertEqual([(2, 30)],
+                         [(evt.eventTypeId, evt.eventTime) for evt in events])
+        self.assertEqual([(1, 10)],
+                         [(evt.eventTypeId, evt.eventTime) for evt in events2])
+        # every entity of the matching event is still returned
+        self.assertEqual(4, len(events2[0].relatedEntities))
+    def test_entity_query_many_ids(self):
+        # more pairs than SQLite allows terms in one compound SELECT
+        many = range(1000, 1700)
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=1, start=5,
+                                        entityIds={'1' : [14, 15] + many})
+            evt = Event.from_dict(dict(
+                json.loads(self.test_data[0]),
+                relatedEntities={'9' : many}))
+            evt.save(self.db)
+            linked = Event.load_from_db(self.db, applicationId=1, start=0,
+                                        entityIds={'9' : many},
+                                        entityMatch='all')
+            unlinked = Event.load_from_db(self.db, applicationId=1, start=0,
+                                          entityIds={'9' : many + [1]},
+                                          entityMatch='all')
+        self.assertEqual(3, len(events))
+        self.assertEqual([evt.eventId], [e.eventId for e in linked])
+        self.assertEqual(700, len(linked[0].relatedEntities))
+        self.assertEqual([], unlinked)
+    def test_raise_error_on_bad_entity_match(self):
+        self.assertRaises(ValueError, Event.load_from_db, self.db,
+                          applicationId=1, start=0, entityIds={'1' : [14]},
+                          entityMatch='some')
+    def test_entities_grouped_per_event(self):
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=1, start=0)
+        byTime = dict(((evt.eventTypeId, evt.eventTime), evt.to_dict())
+                      for evt in events)
+        self.assertEqual(byTime[(1, 10)]['relatedEntities'],
+                         {'1' : [14, 16], '2' : [1, 4]})
+        self.assertEqual(byTime[(2, 30)]['relatedEntities'],
+                         {'1' : [1, 15, 16]})
+        self.assertFalse('relatedEntities' in byTime[(1, 20)])
+    def test_results_ordered_by_time_and_id(self):
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=1, start=0)
+        keys = [(evt.eventTime, evt.eventId) for evt in events]
+        self.assertEqual(keys, sorted(keys))
+
+    # pagination tests
+    def test_limit_query(self):
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=1, start=0,
+                                        limit=3)
+        self.assertEqual(3, len(events))
+        # limit counts events, not joined entity rows
+        self.assertEqual(4, len(events[0].relatedEntities))
+    def test_cursor_pages_cover_results(self):
+        with nostderr():
+            expected = Event.load_from_db(self.db, applicationId=1, start=0)
+            pages = []
+            cursor = None
+            while True:
+                page = Event.load_from_db(self.db, applicationId=1, start=0,
+                                          limit=3, cursor=cursor)
+                if len(page) == 0:
+                    break
+                pages.append(page)
+                cursor = page[-1].cursor()
+        self.assertEqual([3, 3, 2], [len(page) for page in pages])
+        self.assertEqual([evt.eventId for evt in expected],
+                         [evt.eventId for page in pages for evt in page])
+    def test_raise_error_on_bad_cursor(self):
+        self.assertRaises(ValueError, Event.load_from_db, self.db,
+                          applicationId=1, start=0, cursor='bogus')
+    def test_stream_from_db_matches_load(self):
+        with nostderr():
+            expected = Event.load_from_db(self.db, applicationId=1, start=0)
+            streamed = list(Event.stream_from_db(self.db, applicationId=1,
+                                                 start=0, chunk_size=3))
+            limited = list(Event.stream_from_db(self.db, applicationId=1,
+                                                start=0, limit=5,
+                                                chunk_size=2))
+        self.assertEqual([evt.to_dict() for evt in expected],
+                         [evt.to_dict() for evt in streamed])
+        self.assertEqual([evt.eventId for evt in expected[:5]],
+                         [evt.eventId for evt in limited])
+    def test_dicts_match_to_dict(self):
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=1, start=0)
+            dicts = list(Event.iter_from_db(self.db, applicationId=1,
+                                            start=0, as_dicts=True))
+            streamed = list(Event.stream_from_db(self.db, applicationId=1,
+                                                 start=0, as_dicts=True,
+                                                 chunk_size=3))
+        self.assertEqual([evt.to_dict() for evt in events], dicts)
+        self.assertEqual(json.dumps(dicts), json.dumps(streamed))
+    def test_events_have_no_dict(self):
+        evt = Event.from_json(self.test_data[0])
+        self.assertFalse(hasattr(evt, '__dict__'))
+        self.assertFalse(hasattr(evt.relatedEntities[0], '__dict__'))
+    def test_iter_from_db_is_lazy(self):
+        with nostderr():
+            events = Event.iter_from_db(self.db, applicationId=2, start=0)
+            first = next(events)
+            rest = list(events)
+        self.assertEqual(2, first.applicationId)
+        self.assertEqual(7, len(rest))
+
+    # field projection tests
+    def test_fields_projection(self):
+        fields = ['eventTypeId']
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=1, start=0,
+                                        fields=fields)
+            dicts = list(Event.iter_from_db(self.db, applicationId=1,
+                                            start=0, limit=3, as_dicts=True,
+                                            fields=fields))
+            full = Event.load_from_db(self.db, applicationId=1, start=0)
+        self.assertEqual([evt.eventId for evt in full],
+                         [evt.eventId for evt in events])
+        # entities aren't joined, unwanted columns are left None
+        self.assertEqual([], events[0].relatedEntities)
+        self.assertEqual(None, events[0].body)
+        self.assertEqual(1, events[0].eventTypeId)
+        self.assertEqual([evt.to_dict(['eventId', 'eventTime',
+                                       'eventTypeId'])
+                          for evt in full[:3]], dicts)
+        self.assertEqual(['eventId', 'eventTime', 'eventTypeId'],
+                         sorted(dicts[0].keys()))
+    def test_fields_with_entities(self):
+        with nostderr():
+            events = Event.load_from_db(self.db, applicationId=1, start=0,
+                                        limit=1,
+                                        fields=['relatedEntities'])
+        self.assertEqual(4, len(events[0].relatedEntities))
+        self.assertEqual(None, events[0].headline)
+    def test_raise_error_on_unknown_field(self):
+        self.assertRaises(ValueError, Event.load_from_db, self.db,
+                          applicationId=1, start=0, fields=['bogus'])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,163 @@
+"""Unit tests for idempotent saves and gupta.idempotency"""
+
+import unittest
+
+from gupta.event import Event
+from gupta.idempotency import KeyCache
+from gupta.retention import Retention, RetentionPolicy
+from gupta.util import millis, nostderr
+import gupta.test.data
+from gupta.config import get_test_database
+
+DAY = 24 * 60 * 60 * 1000
+
+class KeyCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_evicted(self):
+        cache = KeyCache(max_keys=2)
+        cache.put(1, 'a', 10)
+        cache.put(1, 'b', 11)
+        self.assertEqual(cache.get(1, 'a'), 10)
+        cache.put(2, 'a', 12)
+        self.assertEqual(cache.get(1, 'b'), None)
+        self.assertEqual(cache.get('1', 'a'), 10)
+        self.assertEqual(cache.get(2, 'a'), 12)
+        self.assertEqual(cache.stats(), {'keys' : 2, 'hits' : 3,
+                                         'misses' : 1})
+
+    def test_keys_forgotten_once_purgeable(self):
+        retention = Retention([RetentionPolicy(60 * 1000),
+                               RetentionPolicy(DAY, 1, 5)])
+        cache = KeyCache(retention=retention)
+        old = millis() - 2 * 60 * 1000
+        cache.put(1, 'a', 10, 4, old)
+        cache.put(1, 'b', 11, 5, old)
+        cache.put(1, 'c', 12, 4, millis())
+        # the times of the event are needed
+        cache.put(1, 'd', 13)
+        self.assertEqual(cache.get(1, 'a'), None)
+        self.assertEqual(cache.get(1, 'b'), 11)
+        self.assertEqual(cache.get(1, 'c'), 12)
+        self.assertEqual(cache.get(1, 'd'), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_forget_before(self):
+        cache = KeyCache()
+        cache.put(1, 'a', 10, 4, 100)
+        cache.put(1, 'b', 11, 4, 300)
+        cache.put(1, 'c', 12)
+        cache.forget_before(200)
+        self.assertEqual(cache.get(1, 'a'), None)
+        self.assertEqual(cache.get(1, 'b'), 11)
+        self.assertEqual(cache.get(1, 'c'), None)
+
+class IdempotentSaveTest(unittest.TestCase):
+    """Events with an idempotencyKey are saved once per application"""
+
+    def setUp(self):
+        self.db = get_test_database()
+        self.test_data = gupta.test.data.TestData().json_objects()
+        for i, d in enumerate(self.test_data):
+            d['idempotencyKey'] = 'key-%d' % i
+        self.notified = []
+        Event.add_save_listener(self.notified.extend)
+
+    def tearDown(self):
+        Event.remove_save_listener(self.notified.extend)
+
+    def events(self, indexes):
+        return [Event.from_dict(self.test_data[i]) for i in indexes]
+
+    def count(self, table='event'):
+        with nostderr():
+            return self.db.query('SELECT COUNT(*) AS n FROM %s' %
+                                 table)[0].n
+
+    def test_retry_returns_original(self):
+        with nostderr():
+            first = Event.save_many(self.db, self.events([0, 1]))
+            retried = self.events([1, 2])
+            second = Event.save_many(self.db, retried)
+        self.assertEqual(second[0], first[1])
+        self.assertTrue(retried[0].duplicate)
+        self.assertFalse(retried[1].duplicate)
+        self.assertEqual(self.count(), 3)
+        self.assertEqual(self.count('event_key'), 3)
+        self.assertEqual(len(self.notified), 3)
+
+    def test_duplicates_in_one_batch(self):
+        events = self.events([0, 0, 1])
+        with nostderr():
+            eventIds = Event.save_many(self.db, events)
+        self.assertEqual(eventIds[0], eventIds[1])
+        self.assertEqual([evt.duplicate for evt in events],
+                         [False, True, False])
+        self.assertEqual(self.count(), 2)
+
+    def test_keys_are_per_application(self):
+        other = dict(self.test_data[0], applicationId=3)
+        with nostderr():
+            eventIds = Event.save_many(self.db, self.events([0]) +
+                                       [Event.from_dict(other)])
+        self.assertNotEqual(eventIds[0], eventIds[1])
+        self.assertEqual(self.count(), 2)
+
+    def test_events_without_key(self):
+        for d in self.test_data:
+            del d['idempotencyKey']
+        with nostderr():
+            Event.save_many(self.db, self.events([0, 0]))
+        self.assertEqual(self.count(), 2)
+        self.assertEqual(self.count('event_key'), 0)
+
+    def test_cached_retry_skips_database(self):
+        self.db.key_cache = KeyCache()
+        with nostderr():
+            first = Event.save_many(self.db, self.events([0]))
+
+        class NoDatabase(object):
+            # any database access raises AttributeError
+            key_cache = self.db.key_cache
+
+        retried = self.events([0])
+        self.assertEqual(Event.save_many(NoDatabase(), retried), first)
+        self.assertTrue(retried[0].duplicate)
+        self.assertEqual(self.db.key_cache.stats()['hits'], 1)
+
+    def test_concurrent_save_of_key(self):
+        with nostderr():
+            first = Event.save_many(self.db, self.events([0]))
+        # the first lookup misses the key, as if it was saved by another
+        # process after the lookup: the insert fails and is retried
+        select = self.db.select
+        misses = []
+        def stale_select(*args, **kw):
+            if not misses:
+                misses.append(args)
+                return []
+            return select(*args, **kw)
+        self.db.select = stale_select
+        retried = self.events([0, 1])
+        try:
+            with nostderr():
+                eventIds = Event.save_many(self.db, retried)
+        finally:
+            del self.db.select
+        self.assertEqual(len(misses), 1)
+        self.assertEqual(eventIds[0], first[0])
+        self.assertTrue(retried[0].duplicate)
+        self.assertEqual(self.count(), 2)
+
+    def test_key_validated(self):
+        self.test_data[0]['idempotencyKey'] = 'x' * 129
+        self.assertRaises(ValueError, self.events, [0])
+        # 128 characters, but 256 bytes in the event_key column
+        self.test_data[0]['idempotencyKey'] = u'\xe9' * 128
+        self.assertRaises(ValueError, self.events, [0])
+        self.test_data[0]['idempotencyKey'] = u'\xe9' * 64
+        self.assertEqual(len(self.events([0])), 1)
+        self.test_data[0]['idempotencyKey'] = 5
+        self.assertRaises(ValueError, self.events, [0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""Unit tests for gupta.ingest"""
+
+import os
+import threading
+import unittest
+
+from tempfile import NamedTemporaryFile
+from gupta.event import Event
+from gupta.ingest import IngestQueue, IngestError
+from gupta.util import nostderr
+import gupta.test.data
+from gupta.config import get_test_database
+
+class IngestQueueTest(unittest.TestCase):
+    """Test group commit through the write-behind queue"""
+
+    def setUp(self):
+        # the flusher thread opens its own connection, so the test
+        # database has to live in a file
+        self.db_file = NamedTemporaryFile(suffix='.db', delete=False)
+        self.db_file.close()
+        self.db = get_test_database(self.db_file.name)
+        self.test_data = gupta.test.data.TestData().json_strings()
+        self.queue = None
+
+    def tearDown(self):
+        if self.queue is not None:
+            with nostderr():
+                self.queue.stop()
+        os.unlink(self.db_file.name)
+
+    def test_wait_returns_committed_ids(self):
+        self.queue = IngestQueue(self.db, batch_size=4, flush_interval_ms=5)
+        self.queue.start()
+        with nostderr():
+            pendings = [self.queue.submit(Event.from_json(d))
+                        for d in self.test_data]
+            eventIds = [p.wait(5) for p in pendings]
+            events = Event.load_from_db(self.db, applicationId=1, start=0)
+        self.assertEqual(len(set(eventIds)), len(self.test_data))
+        self.assertEqual(8, len(events))
+
+    def test_stop_flushes_queued_events(self):
+        self.queue = IngestQueue(self.db, flush_interval_ms=200)
+        self.queue.start()
+        with nostderr():
+            pending = self.queue.submit(Event.from_json(self.test_data[0]))
+            self.queue.stop()
+        self.assertTrue(pending.done())
+        self.assertTrue(pending.event.is_saved())
+        self.assertRaises(IngestError, self.queue.submit,
+                          Event.from_json(self.test_data[1]))
+
+    def test_save_error_is_reported_to_waiter(self):
+        self.queue = IngestQueue(self.db, flush_interval_ms=5)
+        self.queue.start()
+        evt = Event.from_json(self.test_data[0])
+        evt.headline = None # violates NOT NULL
+        with nostderr():
+            pending = self.queue.submit(evt)
+            self.assertRaises(Exception, pending.wait, 5)
+
+    def test_full_queue_pushes_back(self):
+        release = threading.Event()
+        class StuckQueue(IngestQueue):
+            def _flush(self, batch):
+                release.wait(5)
+                IngestQueue._flush(self, batch)
+        self.queue = StuckQueue(self.db, batch_size=1, flush_interval_ms=1,
+                                max_queue=1, enqueue_timeout_ms=10)
+        self.queue.start()
+        with nostderr():
+            events = [Event.from_json(d) for d in self.test_data[:3]]
+            self.queue.submit(events[0])
+            # wait for the flusher to pick up the first event
+            while self.queue.qsize() > 0:
+                release.wait(0.001)
+            self.queue.submit(events[1])
+            self.assertRaises(IngestError, self.queue.submit, events[2])
+            release.set()
+
+if __name__ == '__main__':
+    unittest.main()
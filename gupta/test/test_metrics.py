@@ -0,0 +1,80 @@
+"""Unit tests for gupta.metrics instrumentation"""
+
+import logging
+import unittest
+
+import gupta.metrics
+import gupta.test.data
+from gupta.config import get_test_database
+from gupta.event import Event
+from gupta.metrics import Metrics
+from gupta.util import nostderr
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram_render(self):
+        m = Metrics()
+        m.observe('gupta_stage_seconds', 0.002, stage='sql')
+        m.observe('gupta_stage_seconds', 0.3, stage='sql')
+        m.increment('gupta_rows_total', 5)
+        text = m.render()
+        self.assertTrue('# TYPE gupta_stage_seconds histogram' in text)
+        self.assertTrue('# TYPE gupta_rows_total counter' in text)
+        self.assertTrue('gupta_rows_total 5\n' in text)
+        self.assertTrue(
+            'gupta_stage_seconds_bucket{stage="sql",le="0.001"} 0\n' in text)
+        self.assertTrue(
+            'gupta_stage_seconds_bucket{stage="sql",le="0.0025"} 1\n' in text)
+        self.assertTrue(
+            'gupta_stage_seconds_bucket{stage="sql",le="+Inf"} 2\n' in text)
+        self.assertTrue('gupta_stage_seconds_count{stage="sql"} 2\n' in text)
+
+    def test_slow_query_logged(self):
+        m = Metrics(slow_query_ms=100)
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        handler = Handler()
+        logging.getLogger('gupta.slowquery').addHandler(handler)
+        try:
+            m.query('SELECT 1', 0.01)
+            m.query('SELECT 2', 0.5)
+        finally:
+            logging.getLogger('gupta.slowquery').removeHandler(handler)
+        self.assertEqual(records, ['Slow query (500.0 ms): SELECT 2'])
+        self.assertTrue('gupta_slow_queries_total 1\n' in m.render())
+
+class InstrumentationTest(unittest.TestCase):
+    """Event model hooks record into the installed Metrics"""
+
+    def setUp(self):
+        self.db = get_test_database()
+        self.strings = gupta.test.data.TestData().json_strings()
+
+    def tearDown(self):
+        gupta.metrics.uninstall()
+
+    def test_disabled_records_nothing(self):
+        m = Metrics()
+        with nostderr():
+            Event.save_many(self.db,
+                            [Event.from_json(s) for s in self.strings])
+        self.assertEqual(m.render(), '\n')
+
+    def test_event_stages(self):
+        m = Metrics()
+        gupta.metrics.install(m)
+        with nostderr():
+            events = [Event.from_json(s) for s in self.strings]
+            Event.save_many(self.db, events)
+            loaded = Event.load_from_db(self.db, 1, 0)
+        text = m.render()
+        for stage in ('from_json', 'save', 'sql', 'load_from_db'):
+            self.assertTrue('gupta_stage_seconds_count{stage="%s"}' % stage
+                            in text, stage)
+        self.assertTrue('gupta_events_total{stage="save"} %d\n' %
+                        len(events) in text)
+        self.assertTrue('gupta_events_total{stage="load_from_db"} %d\n' %
+                        len(loaded) in text)
+        self.assertTrue('gupta_rows_total ' in text)
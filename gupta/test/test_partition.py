@@ -0,0 +1,106 @@
+"""Unit tests for gupta.partition"""
+
+import unittest
+
+from gupta.event import Event
+from gupta.idempotency import KeyCache
+from gupta.partition import Partitioning
+from gupta.util import nostderr
+import gupta.test.data
+from gupta.config import get_test_database
+
+DAY = 24 * 60 * 60 * 1000
+
+class PartitioningTest(unittest.TestCase):
+    """Check that a partitioned database answers like a plain one"""
+
+    def setUp(self):
+        self.plain = get_test_database()
+        self.db = get_test_database()
+        self.db.partitioning = Partitioning('day')
+        self.db.key_cache = KeyCache()
+        # test times 10, 20, 30, 40 become days 1, 2, 3 and 4
+        self.test_data = gupta.test.data.TestData().json_objects()
+        for i, d in enumerate(self.test_data):
+            d['eventTime'] = d['eventTime'] * DAY // 10 + 5
+            d['idempotencyKey'] = 'key-%d' % i
+        with nostderr():
+            for db in (self.plain, self.db):
+                Event.save_many(db, [Event.from_dict(d)
+                                     for d in self.test_data])
+
+    def both(self, **kw):
+        with nostderr():
+            plain = Event.load_from_db(self.plain, **kw)
+            partitioned = Event.load_from_db(self.db, **kw)
+        return ([evt.to_dict() for evt in plain],
+                [evt.to_dict() for evt in partitioned])
+
+    def test_names_and_bounds(self):
+        days = Partitioning('day')
+        self.assertEqual('p19700102', days.name_for(DAY + 5))
+        self.assertEqual((DAY, 2 * DAY), days.bounds('p19700102'))
+        months = Partitioning('month')
+        self.assertEqual('p197002', months.name_for(40 * DAY))
+        self.assertEqual((31 * DAY, 59 * DAY), months.bounds('p197002'))
+        self.assertRaises(ValueError, Partitioning, 'week')
+
+    def test_partitions_created_on_write(self):
+        with nostderr():
+            names = self.db.partitioning.overlapping(self.db, 0)
+        self.assertEqual(['p19700102', 'p19700103', 'p19700104',
+                          'p19700105'], names)
+
+    def test_queries_match_plain_tables(self):
+        queries = [
+            dict(applicationId=1, start=0),
+            dict(applicationId=2, start=DAY + 5, end=4 * DAY),
+            dict(applicationId=1, start=0, eventTypeId=2),
+            dict(applicationId=1, start=0, entityIds={'1' : [15, 16]}),
+            dict(applicationId=1, start=0, entityIds={'1' : [15, 16]},
+                 entityMatch='all'),
+            dict(applicationId=1, start=0, limit=3),
+        ]
+        for kw in queries:
+            plain, partitioned = self.both(**kw)
+            self.assertEqual(plain, partitioned)
+
+    def test_pages_cross_partitions(self):
+        with nostderr():
+            first = Event.load_from_db(self.db, applicationId=1, start=0,
+                                       limit=3)
+            second = Event.load_from_db(self.db, applicationId=1, start=0,
+                                        limit=3, cursor=first[-1].cursor())
+        plain, partitioned = self.both(applicationId=1, start=0)
+        self.assertEqual(plain[:6],
+                         [evt.to_dict() for evt in first + second])
+
+    def test_only_overlapping_partitions_are_read(self):
+        with nostderr():
+            names = self.db.partitioning.overlapping(self.db, 2 * DAY,
+                                                     3 * DAY)
+        self.assertEqual(['p19700103'], names)
+
+    def test_drop_before(self):
+        with nostderr():
+            dropped = self.db.partitioning.drop_before(self.db, 3 * DAY)
+            events = Event.load_from_db(self.db, applicationId=1, start=0)
+        self.assertEqual(['p19700102', 'p19700103'], dropped)
+        self.assertEqual(4, len(events))
+        self.assertTrue(all(evt.eventTime > 3 * DAY for evt in events))
+        # the keys of dropped events go with them
+        with nostderr():
+            keys = self.db.select('event_key')
+        keys = set((row.application_id, row.idempotency_key) for row in keys)
+        for i, d in enumerate(self.test_data):
+            key = (d['applicationId'], d['idempotencyKey'])
+            cached = self.db.key_cache.get(*key)
+            if d['eventTime'] < 3 * DAY:
+                self.assertFalse(key in keys)
+                self.assertEqual(cached, None)
+            else:
+                self.assertTrue(key in keys)
+                self.assertNotEqual(cached, None)
+
+if __name__ == '__main__':
+    unittest.main()
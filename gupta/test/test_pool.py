@@ -0,0 +1,111 @@
+"""Unit tests for gupta.pool"""
+
+import os
+import shutil
+import threading
+import unittest
+
+from tempfile import mkdtemp
+from gupta.config import EventConfig
+from gupta.event import Event
+from gupta.pool import ConnectionPool, PoolTimeout
+from gupta.util import nostderr
+import gupta.test.data
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+    def rollback(self):
+        self.rollbacks += 1
+    def close(self):
+        self.closed = True
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Test checkout, overflow, timeout and recycling"""
+
+    def setUp(self):
+        self.opened = []
+        def connect():
+            conn = FakeConnection()
+            self.opened.append(conn)
+            return conn
+        self.pool = ConnectionPool(connect, size=1, max_overflow=1,
+                                   timeout=0.01, recycle=0)
+
+    def test_connections_are_reused(self):
+        conn = self.pool.connection()
+        conn.close()
+        self.pool.connection().close()
+        self.assertEqual(1, len(self.opened))
+        self.assertEqual(2, self.opened[0].rollbacks)
+
+    def test_overflow_is_closed_on_return(self):
+        first = self.pool.connection()
+        second = self.pool.connection()
+        self.assertRaises(PoolTimeout, self.pool.connection)
+        first.close()
+        second.close()
+        self.assertEqual([False, True], [c.closed for c in self.opened])
+        self.assertEqual({'idle' : 1, 'checkedOut' : 0}, self.pool.stats())
+
+    def test_dropped_proxy_returns_connection(self):
+        self.pool.connection()
+        self.assertEqual({'idle' : 1, 'checkedOut' : 0}, self.pool.stats())
+
+    def test_old_connections_are_recycled(self):
+        self.pool.recycle = 1e-9 # everything is too old
+        self.pool.connection().close()
+        self.pool.connection().close()
+        self.assertEqual(2, len(self.opened))
+        self.assertTrue(self.opened[0].closed)
+
+class PooledSqliteTest(unittest.TestCase):
+    """Test a tuned, pooled SQLite database built from config"""
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        db_file = os.path.join(self.dir, 'event.db')
+        cfg_file = os.path.join(self.dir, 'event.cfg')
+        with open(cfg_file, 'w') as f:
+            f.write('[database]\n'
+                    'dbn = sqlite\n'
+                    'db = %s\n'
+                    'pool_size = 2\n'
+                    'sqlite_tuned = true\n' % db_file)
+        self.db = EventConfig(cfg_file).get_database()
+        with open('db/sqlite_tables.sql') as f:
+            script = f.read()
+        with nostderr():
+            self.db._getctx().db.executescript(script)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_wal_mode(self):
+        with nostderr():
+            mode = self.db.query('PRAGMA journal_mode')[0].journal_mode
+        self.assertEqual('wal', mode)
+
+    def test_concurrent_writers_and_readers(self):
+        test_data = gupta.test.data.TestData().json_strings()
+        errors = []
+        def work():
+            try:
+                for d in test_data:
+                    Event.from_json(d).save(self.db)
+                    Event.load_from_db(self.db, applicationId=1, start=0)
+            except Exception as e:
+                errors.append(e)
+        with nostderr():
+            threads = [threading.Thread(target=work) for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            events = Event.load_from_db(self.db, applicationId=1, start=0)
+        self.assertEqual([], errors)
+        self.assertEqual(32, len(events))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Unit tests for gupta.prefork"""
+
+import os
+import signal
+import socket
+import subprocess
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import requests
+
+# a master serving a WSGI app that answers with the worker's pid,
+# with a background process logging its start and stop
+_MASTER = """
+import os
+from gupta.prefork import PreforkServer
+
+def log(what):
+    with open(%r, 'a') as f:
+        f.write('%%s %%d\\n' %% (what, os.getpid()))
+
+def background(stopping):
+    log('start')
+    while not stopping.is_set():
+        stopping.wait(0.1)
+    log('stop')
+
+def load_app():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [str(os.getpid())]
+    return app
+
+PreforkServer(load_app, ('127.0.0.1', %d), workers=2, threads=2,
+              shutdown_timeout=5, background=background).serve()
+"""
+
+class PreforkServerTest(unittest.TestCase):
+
+    def setUp(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        self.port = s.getsockname()[1]
+        s.close()
+        self.url = 'http://127.0.0.1:%d/' % self.port
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'background.log')
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        self.master = subprocess.Popen([sys.executable, '-c',
+                                        _MASTER % (self.log, self.port)],
+                                       env=env)
+
+    def tearDown(self):
+        if self.master.poll() is None:
+            self.master.kill()
+            self.master.wait()
+        shutil.rmtree(self.dir)
+
+    def background_log(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [line.split() for line in f]
+
+    def worker_pids(self, tries=40):
+        """Return the set of pids answering tries requests"""
+        pids = set()
+        deadline = time.time() + 10
+        while len(pids) < 2 and time.time() < deadline:
+            for i in range(tries):
+                try:
+                    pids.add(int(requests.get(self.url).content))
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+        return pids
+
+    def test_reload_and_shutdown(self):
+        pids = self.worker_pids()
+        self.assertEqual(len(pids), 2)
+        self.assertFalse(self.master.pid in pids)
+        self.assertEqual([what for what, pid in self.background_log()],
+                         ['start'])
+        self.master.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        new_pids = self.worker_pids()
+        self.assertEqual(len(new_pids), 2)
+        self.assertFalse(pids & new_pids)
+        # one background process at a time, replaced on reload
+        log = self.background_log()
+        self.assertEqual([what for what, pid in log],
+                         ['start', 'stop', 'start'])
+        self.assertEqual(log[0][1], log[1][1])
+        self.assertNotEqual(log[0][1], log[2][1])
+        self.master.send_signal(signal.SIGTERM)
+        deadline = time.time() + 10
+        while self.master.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(self.master.returncode, 0)
+        self.assertEqual(self.background_log()[-1], ['stop', log[2][1]])
+        self.assertRaises(requests.ConnectionError, requests.get, self.url)
@@ -0,0 +1,98 @@
+"""Unit tests for gupta.recent"""
+
+import json
+import unittest
+
+from gupta.event import Event
+from gupta.recent import RecentEventStore
+from gupta.util import millis, nostderr
+import gupta.test.data
+from gupta.config import get_test_database
+
+class RecentEventStoreTest(unittest.TestCase):
+    """Check that the store answers exactly like the database"""
+
+    def setUp(self):
+        self.db = get_test_database()
+        self.store = RecentEventStore(window_ms=60000, max_events=1000)
+        Event.add_save_listener(self.store.add)
+        # test data, shifted into the last few seconds
+        self.now = millis()
+        self.test_data = gupta.test.data.TestData().json_objects()
+        for d in self.test_data:
+            d['eventTime'] += self.now - 100
+        # half of the events are saved before the store loads
+        with nostderr():
+            Event.save_many(self.db, [Event.from_dict(d)
+                                      for d in self.test_data[:8]])
+
+    def tearDown(self):
+        Event.remove_save_listener(self.store.add)
+
+    def both(self, **kw):
+        """Return (store result, db result) as JSON for a query"""
+        with nostderr():
+            stored = self.store.query(self.db, **kw)
+            loaded = Event.load_from_db(self.db, **kw)
+        self.assertNotEqual(stored, None)
+        return (json.dumps([evt.to_dict() for evt in stored]),
+                json.dumps([evt.to_dict() for evt in loaded]))
+
+    def save_rest(self):
+        with nostderr():
+            self.store.query(self.db, applicationId=2, start=self.now - 1000)
+            for d in self.test_data[8:]:
+                Event.from_dict(d).save(self.db)
+
+    def test_loads_window_on_first_query(self):
+        stored, loaded = self.both(applicationId=1, start=self.now - 1000)
+        self.assertEqual(stored, loaded)
+        self.assertEqual(8, len(json.loads(stored)))
+
+    def test_saved_events_are_added(self):
+        self.save_rest()
+        self.assertEqual(8, len(self.store))
+        stored, loaded = self.both(applicationId=2, start=self.now - 1000)
+        self.assertEqual(stored, loaded)
+        self.assertEqual(8, len(json.loads(stored)))
+
+    def test_filters_match_database(self):
+        self.save_rest()
+        start = self.now - 1000
+        queries = [
+            dict(applicationId=1, start=start, eventTypeId=2),
+            dict(applicationId=1, start=start, end=self.now - 65),
+            dict(applicationId=1, start=start, entityIds={'1' : [15, 16]}),
+            dict(applicationId=1, start=start, entityIds={'1' : [15, 16]},
+                 entityMatch='all'),
+            dict(applicationId=2, start=self.now - 75, limit=3),
+        ]
+        for kw in queries:
+            stored, loaded = self.both(**kw)
+            self.assertEqual(stored, loaded)
+
+    def test_cursor_matches_database(self):
+        with nostderr():
+            page = Event.load_from_db(self.db, applicationId=1,
+                                      start=self.now - 1000, limit=3)
+        stored, loaded = self.both(applicationId=1, start=self.now - 1000,
+                                   limit=3, cursor=page[-1].cursor())
+        self.assertEqual(stored, loaded)
+
+    def test_old_range_falls_back(self):
+        with nostderr():
+            stored = self.store.query(self.db, applicationId=1,
+                                      start=self.now - 120000)
+        self.assertEqual(stored, None)
+
+    def test_eviction_raises_floor(self):
+        self.store.max_events = 4
+        with nostderr():
+            self.store.query(self.db, applicationId=1, start=self.now - 1000)
+            stored = self.store.query(self.db, applicationId=1,
+                                      start=self.now - 1000)
+        self.assertTrue(len(self.store) <= 4)
+        self.assertEqual(stored, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+"""Unit tests for gupta.replica"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import web
+
+import gupta.test.data
+from gupta.config import EventConfig, get_test_database
+from gupta.entityindex import EntityIndex
+from gupta.event import Event
+from gupta.replica import ReplicaSet
+from gupta.util import nostderr
+
+class ReplicaSetTest(unittest.TestCase):
+    """Route reads over SQLite files standing in for replicas"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.primary_file = self.path('primary.db')
+        self.primary = get_test_database(self.primary_file, seed=True)
+        # replicas as copies of the primary
+        self.replicas = []
+        for name in ('r1', 'r2'):
+            shutil.copy(self.primary_file, self.path(name + '.db'))
+            self.replicas.append(
+                (name, web.database(dbn='sqlite', db=self.path(name + '.db'))))
+        self.r1 = self.replicas[0][1]
+        self.r2 = self.replicas[1][1]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_round_robin(self):
+        replicas = ReplicaSet(self.primary, self.replicas)
+        picked = [replicas.acquire() for i in range(4)]
+        self.assertEqual(picked, [self.r1, self.r2, self.r1, self.r2])
+        for db in picked:
+            replicas.release(db)
+        stats = replicas.stats()['replicas']
+        self.assertEqual(stats['r1']['reads'], 2)
+        self.assertEqual(stats['r1']['inFlight'], 0)
+
+    def test_least_loaded(self):
+        replicas = ReplicaSet(self.primary, self.replicas,
+                              policy='least_loaded')
+        first = replicas.acquire()
+        second = replicas.acquire()
+        self.assertEqual([first, second], [self.r1, self.r2])
+        replicas.release(first)
+        # r1 has nothing in flight, r2 has one read
+        self.assertTrue(replicas.acquire() is self.r1)
+        # one each: ties go round
+        self.assertTrue(replicas.acquire() is self.r2)
+        self.assertTrue(replicas.acquire() is self.r1)
+        self.assertRaises(ValueError, ReplicaSet, self.primary,
+                          self.replicas, policy='random')
+
+    def test_check_drops_unhealthy_replicas(self):
+        # a replica without tables fails its check
+        broken = web.database(dbn='sqlite', db=self.path('broken.db'))
+        replicas = ReplicaSet(self.primary, [('broken', broken)] +
+                              self.replicas[:1])
+        with nostderr():
+            self.assertEqual(replicas.check(), {'broken' : False,
+                                                'r1' : True})
+        self.assertEqual([replicas.acquire() for i in range(3)],
+                         [self.r1] * 3)
+        replicas.failed(self.r1, 'gone')
+        # no healthy replica left: the primary answers
+        self.assertTrue(replicas.acquire() is self.primary)
+        self.assertEqual(replicas.stats()['primaryReads'], 1)
+        with nostderr():
+            self.assertEqual(replicas.check(), {'broken' : False,
+                                                'r1' : True})
+
+    def test_reading_marks_failures(self):
+        replicas = ReplicaSet(self.primary, self.replicas[:1])
+        def read(error):
+            with replicas.reading() as db:
+                raise error
+        def query(sql):
+            with replicas.reading() as db:
+                with nostderr():
+                    db.query(sql)
+        # errors of the request leave the replica in rotation
+        self.assertRaises(ValueError, read, ValueError('bad cursor'))
+        self.assertRaises(TypeError, read, TypeError('bad entityIds'))
+        self.assertTrue(replicas.stats()['replicas']['r1']['healthy'])
+        self.assertRaises(self.r1.db_module.DatabaseError, query,
+                          'SELECT * FROM missing')
+        stats = replicas.stats()['replicas']['r1']
+        self.assertFalse(stats['healthy'])
+        self.assertTrue('missing' in stats['lastError'])
+        self.assertEqual(stats['inFlight'], 0)
+
+    def test_reads_see_the_replica(self):
+        with nostderr():
+            Event.from_dict(gupta.test.data.TestData().json_objects()[0]) \
+                .save(self.primary)
+        replicas = ReplicaSet(self.primary, self.replicas[:1])
+        with nostderr():
+            with replicas.reading() as db:
+                stale = Event.load_from_db(db, 1, 0)
+            fresh = Event.load_from_db(self.primary, 1, 0)
+        self.assertEqual(len(fresh), len(stale) + 1)
+
+    def test_entity_queries_use_the_index(self):
+        with nostderr():
+            index = EntityIndex(refresh_s=None)
+            index.rebuild(self.primary)
+        self.primary.entity_index = index
+        lookups = []
+        lookup = index.lookup
+        def counted(db, *args):
+            lookups.append(db)
+            return lookup(db, *args)
+        index.lookup = counted
+        kw = {'applicationId' : 1, 'start' : 0, 'entityIds' : {'2' : [4]}}
+        with nostderr():
+            expected = list(Event.iter_from_db(self.r1, as_dicts=True, **kw))
+        for name, db in self.replicas:
+            db.primary = self.primary
+        replicas = ReplicaSet(self.primary, self.replicas)
+        with nostderr():
+            with replicas.reading() as db:
+                self.assertTrue(db is self.r1)
+                events = list(Event.iter_from_db(db, as_dicts=True, **kw))
+            # queries without entities stay on the replica
+            with replicas.reading() as db:
+                Event.load_from_db(db, 1, 0)
+        self.assertEqual(events, expected)
+        self.assertEqual(lookups, [self.primary])
+
+    def test_config(self):
+        filename = self.path('event.cfg')
+        with open(filename, 'w') as f:
+            f.write('[database]\ndbn = sqlite\ndb = %s\n'
+                    'read_policy = least_loaded\npartition_by = day\n'
+                    '[database:r1]\ndbn = sqlite\ndb = %s\n'
+                    '[database:r2]\ndbn = sqlite\ndb = %s\n' %
+                    (self.primary_file, self.path('r1.db'),
+                     self.path('r2.db')))
+        config = EventConfig(filename)
+        replicas = config.get_replica_set()
+        self.assertEqual(replicas.policy, 'least_loaded')
+        self.assertEqual(sorted(replicas.stats()['replicas']), ['r1', 'r2'])
+        db = replicas.acquire()
+        self.assertTrue(db.primary is config.get_database())
+        self.assertEqual(db.partitioning.period, 'day')
+        self.assertEqual(EventConfig(self.write_plain()).get_replica_set(),
+                         None)
+
+    def write_plain(self):
+        filename = self.path('plain.cfg')
+        with open(filename, 'w') as f:
+            f.write('[database]\ndbn = sqlite\ndb = %s\n' % self.primary_file)
+        return filename
@@ -0,0 +1,136 @@
+"""Unit tests for gupta.retention"""
+
+import os
+import time
+import unittest
+
+from tempfile import NamedTemporaryFile
+
+from gupta.event import Event
+from gupta.partition import Partitioning
+from gupta.retention import Retention, RetentionPolicy, parse_age
+from gupta.util import nostderr
+import gupta.test.data
+from gupta.config import EventConfig, get_test_database
+
+DAY = 24 * 60 * 60 * 1000
+
+class RetentionTest(unittest.TestCase):
+    """Purge the test events at time 50 with overlapping policies"""
+
+    def setUp(self):
+        self.db = get_test_database()
+        self.test_data = gupta.test.data.TestData().json_objects()
+        self.retention = self.policies()
+
+    def policies(self, scale=1):
+        # app 1 keeps 25 ms, except type 2 which keeps 45 ms; every
+        # other application keeps 35 ms
+        return Retention([RetentionPolicy(25 * scale, 1),
+                          RetentionPolicy(45 * scale, 1, 2),
+                          RetentionPolicy(35 * scale)],
+                         batch_size=1, pause_ms=0)
+
+    def save(self, db, scale=1):
+        for d in self.test_data:
+            d['eventTime'] *= scale
+        with nostderr():
+            Event.save_many(db, [Event.from_dict(d)
+                                 for d in self.test_data])
+
+    def remaining(self, db, eventTable='event', entityTable='event_entity'):
+        with nostderr():
+            events = [(row.application_id, row.event_type_id,
+                       row.event_time) for row in
+                      db.select(eventTable, order='id')]
+            orphans = db.query(('SELECT COUNT(*) AS n FROM %s WHERE ' +
+                                'event_id NOT IN (SELECT id FROM %s)') %
+                               (entityTable, eventTable))[0].n
+        self.assertEqual(orphans, 0)
+        return events
+
+    def expected(self, scale=1):
+        cutoffs = {(1, 1) : 25, (1, 2) : 5, (2, 1) : 15, (2, 2) : 15}
+        return [(d['applicationId'], d['eventTypeId'], d['eventTime'])
+                for d in self.test_data
+                if d['eventTime'] >= cutoffs[d['applicationId'],
+                                             d['eventTypeId']] * scale]
+
+    def test_parse_age(self):
+        self.assertEqual(parse_age('90d'), 90 * DAY)
+        self.assertEqual(parse_age('12h'), 12 * 60 * 60 * 1000)
+        self.assertEqual(parse_age('1500'), 1500)
+        self.assertRaises(ValueError, parse_age, '3 years')
+
+    def test_invalid_policies(self):
+        self.assertRaises(ValueError, RetentionPolicy, 10, None, 2)
+        self.assertRaises(ValueError, Retention,
+                          [RetentionPolicy(10, 1), RetentionPolicy(20, 1)])
+
+    def test_config(self):
+        with NamedTemporaryFile(suffix='.cfg') as f:
+            f.write('[database]\ndbn = sqlite\ndb = :memory:\n'
+                    '[retention]\nmax_age = 90d\napp.1 = 30d\n'
+                    'app.1.type.5 = 12h\nbatch_size = 10\n')
+            f.flush()
+            retention = EventConfig(f.name).get_retention()
+        ages = dict((str(p), p.max_age) for p in retention.policies)
+        self.assertEqual(ages, {'default' : 90 * DAY, 'app 1' : 30 * DAY,
+                                'app 1 type 5' : DAY // 2})
+        self.assertEqual(retention.batch_size, 10)
+        self.assertEqual(retention.max_age(1, 5), DAY // 2)
+        self.assertEqual(retention.max_age('1', 6), 30 * DAY)
+        self.assertEqual(retention.max_age(2, 5), 90 * DAY)
+        self.assertEqual(Retention([RetentionPolicy(DAY, 1)]).max_age(2, 5),
+                         None)
+
+    def test_purge(self):
+        self.save(self.db)
+        with nostderr():
+            counts = self.retention.count(self.db, now=50)
+            purged = self.retention.purge(self.db, now=50)
+        self.assertEqual(counts, {'app 1' : 2, 'app 1 type 2' : 0,
+                                  'default' : 2})
+        self.assertEqual(purged, 4)
+        self.assertEqual(self.remaining(self.db), self.expected())
+        self.assertEqual(self.retention.stats()['purged'], counts)
+        with nostderr():
+            self.assertEqual(self.retention.purge(self.db, now=50), 0)
+
+    def test_purge_partitions(self):
+        self.db.partitioning = Partitioning('day')
+        self.save(self.db, scale=DAY)
+        with nostderr():
+            purged = self.policies(DAY).purge(self.db, now=50 * DAY)
+            names = self.db.partitioning.overlapping(self.db, 0)
+        self.assertEqual(purged, 4)
+        events = []
+        for name in names:
+            events.extend(self.remaining(self.db,
+                                         *Partitioning.tables(name)))
+        self.assertEqual(sorted(events), sorted(self.expected(DAY)))
+
+    def test_background(self):
+        # the purge thread has its own connection, so use a file
+        db_file = NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        try:
+            db = get_test_database(db_file.name)
+            # every test event is long expired by now
+            self.save(db)
+            with nostderr():
+                self.retention.start(db)
+                try:
+                    for i in range(100):
+                        if self.retention.stats()['lastRun'] is not None:
+                            break
+                        time.sleep(0.01)
+                finally:
+                    self.retention.stop()
+            self.assertEqual(self.remaining(db), [])
+        finally:
+            os.unlink(db_file.name)
+        self.assertFalse(self.retention.stats()['running'])
+
+if __name__ == '__main__':
+    unittest.main()
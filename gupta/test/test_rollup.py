@@ -0,0 +1,83 @@
+"""Unit tests for gupta.rollup"""
+
+import unittest
+
+from gupta.event import Event
+from gupta.partition import Partitioning
+from gupta.rollup import Rollups
+from gupta.util import nostderr
+import gupta.test.data
+from gupta.config import get_test_database
+
+HOUR = 60 * 60 * 1000
+
+class RollupsTest(unittest.TestCase):
+    """Test incremental counts and rebuilds"""
+
+    def setUp(self):
+        self.db = get_test_database()
+        self.db.rollups = Rollups(['minute', 'hour'])
+        # test times 10, 20, 30, 40 become 10, 20, 30 and 40 minutes
+        self.test_data = gupta.test.data.TestData().json_objects()
+        for d in self.test_data:
+            d['eventTime'] = d['eventTime'] * 60 * 1000 + 5
+        with nostderr():
+            Event.save_many(self.db, [Event.from_dict(d)
+                                      for d in self.test_data[:8]])
+            for d in self.test_data[8:]:
+                Event.from_dict(d).save(self.db)
+
+    def counts(self, *args, **kw):
+        with nostderr():
+            return self.db.rollups.counts(self.db, *args, **kw)
+
+    def test_hourly_counts(self):
+        self.assertEqual([{'bucketTime' : 0, 'eventTypeId' : 1, 'count' : 4},
+                          {'bucketTime' : 0, 'eventTypeId' : 2, 'count' : 4}],
+                         self.counts(1, 0, HOUR, 'hour'))
+
+    def test_minute_counts_in_range(self):
+        counts = self.counts(2, 20 * 60 * 1000, 40 * 60 * 1000, 'minute',
+                             eventTypeId=1)
+        self.assertEqual([20 * 60 * 1000, 30 * 60 * 1000],
+                         [c['bucketTime'] for c in counts])
+        self.assertEqual([1, 1], [c['count'] for c in counts])
+
+    def test_counts_by_entity_type(self):
+        counts = self.counts(1, 0, HOUR, 'hour', byEntityType=True)
+        self.assertEqual([(1, 1, 1), (1, 2, 2), (2, 1, 2)],
+                         [(c['eventTypeId'], c['entityType'], c['count'])
+                          for c in counts])
+
+    def test_repeated_saves_accumulate(self):
+        with nostderr():
+            Event.save_many(self.db, [Event.from_dict(self.test_data[0])])
+        counts = self.counts(1, 0, HOUR, 'hour', eventTypeId=1)
+        self.assertEqual(5, counts[0]['count'])
+
+    def test_unknown_resolution(self):
+        self.assertRaises(ValueError, self.counts, 1, 0, HOUR, 'day')
+        self.assertRaises(ValueError, Rollups, ['week'])
+
+    def test_rebuild_matches_incremental(self):
+        before = [self.counts(1, 0, HOUR, 'minute'),
+                  self.counts(1, 0, HOUR, 'hour', byEntityType=True)]
+        with nostderr():
+            self.db.rollups.rebuild(self.db)
+        after = [self.counts(1, 0, HOUR, 'minute'),
+                 self.counts(1, 0, HOUR, 'hour', byEntityType=True)]
+        self.assertEqual(before, after)
+
+    def test_rebuild_partitioned(self):
+        db = get_test_database()
+        db.partitioning = Partitioning('day')
+        with nostderr():
+            Event.save_many(db, [Event.from_dict(d)
+                                 for d in self.test_data])
+            db.rollups = self.db.rollups
+            db.rollups.rebuild(db)
+            counts = db.rollups.counts(db, 1, 0, HOUR, 'hour')
+        self.assertEqual([4, 4], [c['count'] for c in counts])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,369 @@
+"""Unit tests for gupta.server handlers"""
+
+import os
+import shutil
+import threading
+import unittest
+import web
+import json
+
+from tempfile import NamedTemporaryFile
+
+import gupta.metrics
+import gupta.server
+import gupta.test.data
+from gupta.bus import EventBus
+from gupta.cache import QueryCache
+from gupta.config import get_test_database
+from gupta.event import Event
+from gupta.ingest import IngestQueue
+from gupta.metrics import Metrics
+from gupta.replica import ReplicaSet
+from gupta.rollup import Rollups
+from gupta.util import nostderr
+
+class ServerTest(unittest.TestCase):
+    """Exercise the web.py handlers against a test database"""
+
+    @classmethod
+    def setUpClass(cls):
+        # web.py drops thread-local connections after every request, so
+        # an in-memory database would vanish; use a temporary file
+        cls.db_file = NamedTemporaryFile(suffix='.db', delete=False)
+        cls.db_file.close()
+        cls.saved_db = gupta.server._db
+        gupta.server._db = get_test_database(cls.db_file.name)
+        cls.app = web.application(gupta.server._urls, vars(gupta.server))
+        cls.test_data = gupta.test.data.TestData().json_objects()
+
+    @classmethod
+    def tearDownClass(cls):
+        gupta.server._db = cls.saved_db
+        os.unlink(cls.db_file.name)
+
+    def tearDown(self):
+        with nostderr():
+            gupta.server._db.query('delete from event where id > 0')
+            gupta.server._db.query('delete from event_entity where id > 0')
+            gupta.server._db.query('delete from event_key')
+
+    def request(self, path, **kw):
+        with nostderr():
+            response = self.app.request(path, **kw)
+        return response.status, json.loads(response.data)
+
+    def test_new_events_json_array(self):
+        status, j = self.request('/newEvents', method='POST',
+                                 data=json.dumps(self.test_data))
+        self.assertEqual(status, '200 OK')
+        results = j['results']
+        self.assertEqual(len(results), len(self.test_data))
+        self.assertTrue(all(r['status'] == 'ok' for r in results))
+        eventIds = [r['eventId'] for r in results]
+        self.assertEqual(eventIds, sorted(eventIds))
+
+    def test_new_events_ndjson_reports_per_item(self):
+        bad = dict(self.test_data[1])
+        del bad['headline']
+        lines = [json.dumps(self.test_data[0]), json.dumps(bad),
+                 '{not json', json.dumps(self.test_data[2])]
+        status, j = self.request('/newEvents', method='POST',
+                                 data='\n'.join(lines))
+        self.assertEqual(status, '200 OK')
+        statuses = [r['status'] for r in j['results']]
+        self.assertEqual(statuses, ['ok', 'error', 'error', 'ok'])
+        status, j = self.request('/getEvents?applicationId=1&start=0')
+        self.assertEqual(len(j['events']), 2)
+
+    def test_new_events_rejects_malformed_array(self):
+        status, j = self.request('/newEvents', method='POST',
+                                 data='[{"applicationId": 1')
+        self.assertEqual(status, '400 Bad Request')
+        self.assertEqual(j['status'], 'error')
+
+    def test_new_event_with_idempotency_key(self):
+        evt = dict(self.test_data[0], idempotencyKey='retry-me')
+        status, first = self.request('/newEvent', method='POST',
+                                     data=json.dumps(evt))
+        self.assertEqual(status, '200 OK')
+        self.assertFalse('duplicate' in first)
+        status, j = self.request('/newEvents', method='POST',
+                                 data=json.dumps([evt, self.test_data[1]]))
+        self.assertEqual(j['results'][0], {'status' : 'ok',
+                                           'eventId' : first['eventId'],
+                                           'duplicate' : True})
+        self.assertFalse('duplicate' in j['results'][1])
+
+    def test_new_event_rejects_invalid_event(self):
+        bad = dict(self.test_data[0], headline='x' * 201)
+        status, j = self.request('/newEvent', method='POST',
+                                 data=json.dumps(bad))
+        self.assertEqual(status, '400 Bad Request')
+        self.assertIn('headline', j['message'])
+        with nostderr():
+            count = gupta.server._db.query('select count(*) as n from event')
+        self.assertEqual(count[0].n, 0)
+
+    def test_get_events_pages_with_next_cursor(self):
+        self.request('/newEvents', method='POST',
+                     data=json.dumps(self.test_data))
+        path = '/getEvents?applicationId=2&start=0&limit=5'
+        status, j = self.request(path)
+        self.assertEqual(5, len(j['events']))
+        status, j = self.request(path + '&cursor=' + j['nextCursor'])
+        self.assertEqual(3, len(j['events']))
+        self.assertEqual(None, j['nextCursor'])
+
+    def test_get_events_ndjson(self):
+        self.request('/newEvents', method='POST',
+                     data=json.dumps(self.test_data))
+        status, j = self.request('/getEvents?applicationId=1&start=0')
+        with nostderr():
+            response = self.app.request(
+                '/getEvents?applicationId=1&start=0',
+                headers={'Accept' : 'application/x-ndjson'})
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/x-ndjson')
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(j['events'], lines)
+        with nostderr():
+            response = self.app.request(
+                '/getEvents?applicationId=1&start=0&format=ndjson&limit=3')
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(j['events'][:3], lines[:3])
+        self.assertTrue('nextCursor' in lines[3])
+
+    def test_get_events_fields(self):
+        self.request('/newEvents', method='POST',
+                     data=json.dumps(self.test_data))
+        path = '/getEvents?applicationId=1&start=0&limit=2'
+        status, j = self.request(path + '&fields=eventTypeId,headline')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(['eventId', 'eventTime', 'eventTypeId', 'headline'],
+                         sorted(j['events'][0].keys()))
+        self.assertTrue(j['nextCursor'] is not None)
+        status, j = self.request(path + '&fields=body,nope')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_get_events_batch(self):
+        self.request('/newEvents', method='POST',
+                     data=json.dumps(self.test_data))
+        specs = [{'applicationId' : 1, 'start' : 0, 'eventTypeId' : 1},
+                 {'applicationId' : 1, 'start' : '0', 'eventTypeId' : 2,
+                  'fields' : ['headline']},
+                 {'applicationId' : 2, 'start' : 0, 'limit' : 5,
+                  'entityIds' : '{"1" : [14]}'}]
+        status, j = self.request('/getEventsBatch', method='POST',
+                                 data=json.dumps(specs))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(len(j['results']), 3)
+        paths = ['/getEvents?applicationId=1&start=0&eventTypeId=1',
+                 '/getEvents?applicationId=1&start=0&eventTypeId=2' +
+                 '&fields=headline',
+                 '/getEvents?applicationId=2&start=0&limit=5' +
+                 '&entityIds={"1":[14]}']
+        for path, result in zip(paths, j['results']):
+            status, expected = self.request(path)
+            self.assertEqual(result, expected)
+        specs.append({'applicationId' : 1})
+        status, j = self.request('/getEventsBatch', method='POST',
+                                 data=json.dumps(specs))
+        self.assertEqual(status, '400 Bad Request')
+        self.assertTrue(j['message'].startswith('Query 3'))
+
+    def test_read_your_writes(self):
+        self.request('/newEvents', method='POST',
+                     data=json.dumps(self.test_data[:1]))
+        # a replica lagging behind the next write
+        replica_file = self.db_file.name + '.replica'
+        shutil.copy(self.db_file.name, replica_file)
+        replica = web.database(dbn='sqlite', db=replica_file)
+        gupta.server._replicas = ReplicaSet(gupta.server._db,
+                                            [('lagging', replica)])
+        try:
+            self.request('/newEvents', method='POST',
+                         data=json.dumps(self.test_data[1:2]))
+            path = '/getEvents?applicationId=1&start=0'
+            status, j = self.request(path)
+            self.assertEqual(len(j['events']), 1)
+            status, j = self.request(path + '&readYourWrites=true')
+            self.assertEqual(len(j['events']), 2)
+            status, j = self.request(path + '&readYourWrites=maybe')
+            self.assertEqual(status, '400 Bad Request')
+            # malformed queries don't take the replica out of rotation
+            for entityIds in ('{"1":5}', '[1,2]', '{"a":[1]}'):
+                status, j = self.request(path + '&entityIds=' + entityIds)
+                self.assertEqual(status, '400 Bad Request')
+            self.assertTrue(gupta.server._replicas.stats()
+                            ['replicas']['lagging']['healthy'])
+            status, j = self.request('/stats')
+            self.assertEqual(j['replicas']['replicas']['lagging']['reads'],
+                             1)
+        finally:
+            gupta.server._replicas = None
+            os.unlink(replica_file)
+
+    def test_query_cache_with_replicas(self):
+        self.request('/newEvents', method='POST',
+                     data=json.dumps(self.test_data[:1]))
+        replica_file = self.db_file.name + '.replica'
+        shutil.copy(self.db_file.name, replica_file)
+        replica = web.database(dbn='sqlite', db=replica_file)
+        cache = QueryCache(ttl_ms=60000)
+        Event.add_save_listener(cache.invalidate_events)
+        gupta.server._replicas = ReplicaSet(gupta.server._db,
+                                            [('lagging', replica)])
+        gupta.server._query_cache = cache
+        try:
+            path = '/getEvents?applicationId=1&start=0'
+            status, j = self.request(path)
+            self.assertEqual(len(j['events']), 1)
+            # invalidates the entry; the replica doesn't have the event
+            self.request('/newEvents', method='POST',
+                         data=json.dumps(self.test_data[1:2]))
+            for i in range(2):
+                status, j = self.request(path)
+                self.assertEqual(len(j['events']), 2)
+            self.assertEqual(cache.stats()['hits'], 1)
+        finally:
+            Event.remove_save_listener(cache.invalidate_events)
+            gupta.server._query_cache = None
+            gupta.server._replicas = None
+            os.unlink(replica_file)
+
+    def test_recent_store_needs_one_worker(self):
+        cfg = NamedTemporaryFile(suffix='.cfg', delete=False)
+        cfg.write('[database]\ndbn = sqlite\ndb = %s\n[recent]\n' %
+                  self.db_file.name)
+        cfg.close()
+        saved = (gupta.config._default_config_file,
+                 gupta.config._default_config)
+        try:
+            gupta.config.init(cfg.name)
+            gupta.server._check_workers(1)
+            self.assertRaises(ValueError, gupta.server._check_workers, 2)
+            with nostderr():
+                self.assertRaises(SystemExit, gupta.server.main,
+                                  ['event_server', '--config', cfg.name,
+                                   '--workers', '2'])
+        finally:
+            (gupta.config._default_config_file,
+             gupta.config._default_config) = saved
+            os.unlink(cfg.name)
+
+    def test_get_event_counts(self):
+        status, j = self.request('/getEventCounts?applicationId=1&start=0'
+                                 '&end=100&resolution=minute')
+        self.assertEqual(status, '400 Bad Request')
+        gupta.server._db.rollups = Rollups(['minute'])
+        try:
+            self.request('/newEvents', method='POST',
+                         data=json.dumps(self.test_data))
+            status, j = self.request('/getEventCounts?applicationId=1'
+                                     '&start=0&end=100&resolution=minute'
+                                     '&byEntityType=true')
+        finally:
+            del gupta.server._db.rollups
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([1, 2, 2], [c['count'] for c in j['counts']])
+
+    def test_new_event_through_ingest_queue(self):
+        queue = IngestQueue(gupta.server._db, flush_interval_ms=5)
+        queue.start()
+        gupta.server._ingest_queue = queue
+        try:
+            status, j = self.request('/newEvent?ack=commit', method='POST',
+                                     data=json.dumps(self.test_data[0]))
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(j['eventId'] is not None)
+            status, j = self.request('/newEvent?ack=enqueue', method='POST',
+                                     data=json.dumps(self.test_data[1]))
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(j['eventId'], None)
+        finally:
+            gupta.server._ingest_queue = None
+            with nostderr():
+                queue.stop()
+        status, j = self.request('/getEvents?applicationId=1&start=0')
+        self.assertEqual(len(j['events']), 2)
+
+    def subscribe(self, path, **kw):
+        bus = EventBus()
+        Event.add_save_listener(bus.publish)
+        gupta.server._event_bus = bus
+        try:
+            with nostderr():
+                response = self.app.request(path, **kw)
+        finally:
+            gupta.server._event_bus = None
+            Event.remove_save_listener(bus.publish)
+        self.assertEqual(response.status, '200 OK')
+        messages = []
+        for block in response.data.split('\n\n'):
+            lines = dict(line.split(': ', 1) for line in block.splitlines()
+                         if not line.startswith(':'))
+            if 'data' in lines:
+                messages.append((lines['id'], json.loads(lines['data'])))
+        return messages
+
+    def test_subscribe_disabled(self):
+        status, j = self.request('/subscribe?applicationId=1')
+        self.assertEqual(status, '404 Not Found')
+
+    def test_subscribe_catches_up_from_cursor(self):
+        self.request('/newEvents', method='POST',
+                     data=json.dumps(self.test_data))
+        status, j = self.request('/getEvents?applicationId=1&start=0')
+        cursor = Event._make_cursor(0, 0)
+        messages = self.subscribe('/subscribe?applicationId=1&timeout=0.1'
+                                  '&cursor=' + cursor)
+        self.assertEqual([evt for _, evt in messages], j['events'])
+        # the id of each message resumes after it
+        messages = self.subscribe('/subscribe?applicationId=1&timeout=0.1',
+                                  env={'HTTP_LAST_EVENT_ID' : messages[2][0]})
+        self.assertEqual([evt for _, evt in messages], j['events'][3:])
+
+    def test_subscribe_streams_new_events(self):
+        def post():
+            with nostderr():
+                self.app.request('/newEvents', method='POST',
+                                 data=json.dumps(self.test_data[:8]))
+        timer = threading.Timer(0.1, post)
+        timer.start()
+        try:
+            messages = self.subscribe('/subscribe?applicationId=1'
+                                      '&eventTypeId=2&timeout=0.5')
+        finally:
+            timer.join()
+        expected = [d['headline'] for d in self.test_data[:8]
+                    if d['applicationId'] == 1 and d['eventTypeId'] == 2]
+        self.assertEqual([evt['headline'] for _, evt in messages], expected)
+        self.assertTrue(expected)
+
+    def test_metrics(self):
+        status, j = self.request('/metrics')
+        self.assertEqual(status, '404 Not Found')
+        metrics = Metrics()
+        gupta.metrics.install(metrics)
+        gupta.server._metrics = metrics
+        try:
+            self.request('/newEvents', method='POST',
+                         data=json.dumps(self.test_data))
+            self.request('/getEvents?applicationId=1&start=0')
+            with nostderr():
+                response = self.app.request('/metrics')
+        finally:
+            gupta.server._metrics = None
+            gupta.metrics.uninstall()
+        self.assertEqual(response.status, '200 OK')
+        text = response.data
+        for stage in ('sql', 'query', 'encode', 'save'):
+            self.assertTrue('gupta_stage_seconds_count{stage="%s"}' % stage
+                            in text, stage)
+        self.assertTrue('gupta_request_seconds_count'
+                        '{handler="getEvents",status="ok"} 1\n' in text)
+        self.assertTrue('gupta_response_bytes_count{handler="newEvents"} 1\n'
+                        in text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,23 +2,73 @@
 
 Functions (see docs for more details):
 * millis: epoch time in milliseconds
+* transaction: a web.py transaction that joins an open one
+* committing: a web.py transaction with hooks run after it commits
+* after_commit: run a hook once the open transaction commits
 """
 
 import contextlib
 import sys
+from datetime import datetime
 
 def millis(dt=None):
     """Return epoch time in milliseconds.
 
-    Optionally takes a datetime parameter. Default is to return
+    Optionally takes a (UTC) datetime parameter. Default is to return
     current epoch time in milliseconds.
     """
     if dt is None:
-        dt = datetime.now()
+        dt = datetime.utcnow()
     epoch = datetime.utcfromtimestamp(0)
     delta = dt - epoch
     return int(delta.total_seconds() * 1000)
 
+def transaction(db):
+    """Return db.transaction(), or join the transaction already open.
+
+    web.py nests transactions with savepoints, which Python 2's sqlite3
+    module breaks by committing before every SAVEPOINT statement. Code
+    that may run inside a caller's transaction joins it instead, so
+    that the caller's commit or rollback covers its writes too.
+    """
+    if db.ctx.transactions:
+        return _joined()
+    return db.transaction()
+
+@contextlib.contextmanager
+def _joined():
+    yield
+
+@contextlib.contextmanager
+def committing(db):
+    """Run the with block in db.transaction(), then call the hooks
+    registered with after_commit inside it.
+
+    The hooks are dropped if the transaction rolls back. A committing
+    block inside another one joins it, like transaction(db).
+    """
+    if getattr(db.ctx, 'after_commit', None) is not None:
+        with transaction(db):
+            yield
+        return
+    hooks = db.ctx.after_commit = []
+    try:
+        with db.transaction():
+            yield
+    finally:
+        db.ctx.after_commit = None
+    for hook in hooks:
+        hook()
+
+def after_commit(db, hook):
+    """Call hook() once the committing block open on db commits, or
+    now if there is none"""
+    hooks = getattr(db.ctx, 'after_commit', None)
+    if hooks is None:
+        hook()
+    else:
+        hooks.append(hook)
+
 @contextlib.contextmanager
 def nostderr():
     """Suppress output to stderr (useful in tests)"""